@@ -1,6 +1,7 @@
 import re
 
 from bluecloud.endpoints import read_token
+from bluecloud.tasks import generations
 from restapi import decorators
 from restapi.config import DATA_PATH
 from restapi.exceptions import NotFound, Unauthorized
@@ -51,6 +52,26 @@ def get(self, token: str) -> Response:
 
         log.info("Request download for path: {}", zippath)
 
-        return Downloader.send_file_streamed(
-            zip_filename, subfolder=subfolder, out_filename=filename
-        )
+        # Outputs are symlinks to the current generation of the archives,
+        # resolved to keep sending the same file if a new one is published.
+        # The generation is leased until the file is sent, then the
+        # generations superseded meanwhile are deleted
+        zippath, lease = generations.lease(zippath)
+        if lease is None:
+            return Downloader.send_file_streamed(
+                zippath.name, subfolder=zippath.parent, out_filename=filename
+            )
+
+        def release() -> None:
+            lease.close()
+            generations.collect(subfolder)
+
+        try:
+            response = Downloader.send_file_streamed(
+                zippath.name, subfolder=zippath.parent, out_filename=filename
+            )
+        except BaseException:
+            release()
+            raise
+        response.call_on_close(release)
+        return response
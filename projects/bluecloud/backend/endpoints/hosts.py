@@ -0,0 +1,36 @@
+from bluecloud.tasks import host_health
+from restapi import decorators
+from restapi.models import Schema, fields
+from restapi.rest.definition import EndpointResource, Response
+from restapi.services.authentication import User
+
+
+class HostHealth(Schema):
+    host = fields.Str()
+    # closed, open or half-open
+    state = fields.Str()
+    failures = fields.Int()
+    opened_at = fields.Float()
+    last_failure = fields.Float()
+    last_success = fields.Float()
+    last_error = fields.Str()
+
+
+class HostsList(Schema):
+    hosts = fields.List(fields.Nested(HostHealth))
+
+
+class Hosts(EndpointResource):
+
+    labels = ["hosts"]
+
+    @decorators.auth.require()
+    @decorators.marshal_with(HostsList, code=200)
+    @decorators.endpoint(
+        path="/hosts",
+        summary="List the health of the download hosts",
+        responses={200: "List of hosts with their circuit breaker state"},
+    )
+    def get(self, user: User) -> Response:
+
+        return self.response({"hosts": host_health.get_hosts()})
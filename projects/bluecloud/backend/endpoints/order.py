@@ -3,6 +3,7 @@
 from typing import List
 
 from bluecloud.endpoints.schemas import DownloadType, OrderInputSchema
+from bluecloud.tasks import generations
 from restapi import decorators
 from restapi.config import DATA_PATH
 from restapi.connectors import celery
@@ -38,6 +39,9 @@ def get(self, user: User) -> Response:
         orders: List[str] = []
 
         for p in DATA_PATH.glob("*/*"):
+            # hidden folders are not orders (e.g. the shared download cache)
+            if p.parent.name.startswith("."):
+                continue
             # marine_id = p.parent.name
             order_number = p.name
             orders.append(order_number)
@@ -161,6 +165,17 @@ def patch(self, marine_id: str, order_number: str, user: User) -> Response:
                     log.info("Removing {}", f.resolve())
                     f.unlink()
 
+        # incomplete downloads
+        partial = path.joinpath("partial")
+        if partial.exists():
+            for f in partial.iterdir():
+                if f.is_file():
+                    log.info("Removing {}", f.resolve())
+                    f.unlink()
+
+        # superseded archives not being downloaded
+        generations.collect(path)
+
         close_file.touch()
         log.info("Order {} closed", order_number)
 
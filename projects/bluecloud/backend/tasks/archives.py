@@ -0,0 +1,503 @@
+"""
+Index of the datafiles included in the zip archives of an order.
+
+The index (archives.json) records the chunk of each archived datafile, with the
+size and the modification time of the cached file. When a request is merged in
+an existing order only the new and changed datafiles are archived: new
+datafiles are appended to the last chunk (or to new chunks, once MAX_ZIP_SIZE
+is reached) and changed datafiles are removed from their chunks by copying the
+other entries, without recompressing them. The other chunks are not modified.
+Datafiles downloaded again with the same content (same sha256 in the order
+manifest) are not archived again, so unchanged caches are not archived at all.
+
+Datafiles with the same content under different names are archived once:
+the other names are listed in the chunk of the archived copy (DUPLICATES_FILE,
+with a line "<archived name>  <duplicate name>" for each duplicate).
+"""
+
+import json
+import re
+import shutil
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Set, Tuple, TypedDict
+
+from bluecloud.tasks import generations, manifest, zip_planner, zip_writer
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+INDEX_FILE = "archives.json"
+DUPLICATES_FILE = "duplicates.txt"
+
+
+class ArchivedFile(TypedDict, total=False):
+    # of the cached file, a datafile downloaded again is archived again
+    size: int
+    mtime: int
+    # from the order manifest, if available: identical downloads are skipped
+    sha256: str
+
+
+class ArchiveChunk(TypedDict):
+    files: Dict[str, ArchivedFile]
+    # the chunk is dedicated to an oversize datafile (a zip file published as
+    # it is, or a part of a split datafile), deleted if the datafile changes
+    raw: bool
+    # names not archived, by archived name with the same content
+    duplicates: Dict[str, str]
+
+
+# chunks in the order of the published outputs
+Index = List[ArchiveChunk]
+
+
+def get_output_chunks(path: Path) -> List[Path]:
+    """Published zip archives of the order (or staged, if updating them)"""
+
+    folder = generations.get_folder(path)
+    whole_zip = folder.joinpath("output.zip")
+    if whole_zip.exists():
+        return [whole_zip]
+
+    chunks: List[Tuple[int, Path]] = []
+    for z in folder.glob("output*.zip"):
+        if m := re.match(r"output([0-9]+)\.zip$", z.name):
+            chunks.append((int(m.group(1)), z))
+    return [z for _, z in sorted(chunks)]
+
+
+def publish(path: Path, chunks: List[Path]) -> List[Path]:
+    """
+    Rename the chunks as outputs of the order: output.zip if single,
+    output1.zip ... outputN.zip otherwise. Other outputs are removed
+    """
+
+    published: List[Path] = []
+    with generations.stage(path) as folder:
+        # Outputs are only moved to lower numbers (or are new), targets are free
+        for number, z in enumerate(chunks, start=1):
+            name = "output.zip" if len(chunks) == 1 else f"output{number}.zip"
+            dest = folder.joinpath(name)
+            if z != dest:
+                z.replace(dest)
+            published.append(path.joinpath(name))
+
+        names = {z.name for z in published}
+        for z in folder.glob("output*.zip"):
+            if z.name not in names:
+                z.unlink()
+
+    return published
+
+
+def load(path: Path) -> Optional[Index]:
+
+    index_path = generations.get_folder(path).joinpath(INDEX_FILE)
+    if not index_path.exists():
+        return None
+
+    try:
+        with open(index_path) as index_file:
+            index: Index = json.load(index_file)
+            return index
+    except Exception as e:  # pragma: no cover
+        log.warning("Invalid archives index {}: {}", index_path, e)
+        return None
+
+
+def save(path: Path, index: Optional[Index]) -> None:
+    """Save the index, or delete it to rebuild the archives from scratch"""
+
+    index_path = generations.get_folder(path).joinpath(INDEX_FILE)
+    if index is None:
+        index_path.unlink(missing_ok=True)
+        return
+
+    tmp_path = index_path.with_name(f".{INDEX_FILE}.tmp")
+    with open(tmp_path, "w") as index_file:
+        index_file.write(json.dumps(index))
+    tmp_path.replace(index_path)
+
+
+def get_checksums(path: Path) -> Dict[str, str]:
+    """sha256 of the downloaded datafiles, from the order manifest"""
+
+    return {
+        name: entry["sha256"]
+        for name, entry in manifest.load(path).items()
+        if entry.get("sha256")
+    }
+
+
+def get_state(f: Path, sha256: Optional[str] = None) -> ArchivedFile:
+    stat = f.stat()
+    state: ArchivedFile = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if sha256:
+        state["sha256"] = sha256
+    return state
+
+
+def is_archived(archived: ArchivedFile, state: ArchivedFile) -> bool:
+    """The archived datafile has the content of the cached one"""
+
+    if archived["size"] != state["size"]:
+        return False
+    if "sha256" in archived and "sha256" in state:
+        return archived["sha256"] == state["sha256"]
+    return archived["mtime"] == state["mtime"]
+
+
+def is_outdated(path: Path, datadir: Path) -> bool:
+    """The cache has datafiles not archived yet, or archived with another content"""
+
+    datafiles: Dict[str, Path] = {}
+    # the cached files replace the oversize files with the same name
+    for folder in (datadir.parent.joinpath("cache_oversize"), datadir):
+        if folder.exists():
+            datafiles.update({f.name: f for f in folder.iterdir() if f.is_file()})
+
+    index = load(path)
+    if index is None:
+        return bool(datafiles)
+
+    archived = {
+        name: state for chunk in index for name, state in chunk["files"].items()
+    }
+    checksums = get_checksums(path)
+    return any(
+        name not in archived
+        or not is_archived(archived[name], get_state(f, checksums.get(name)))
+        for name, f in datafiles.items()
+    )
+
+
+def move_oversize_files(datadir: Path, max_size: int) -> Path:
+    """Move the files larger than max_size in the oversize cache"""
+
+    oversize_cache = datadir.parent.joinpath("cache_oversize")
+    for f in datadir.glob("*"):
+        if f.stat().st_size > max_size:
+            oversize_cache.mkdir(exist_ok=True)
+            log.warning("Too large file found: {}, moving to oversize cache", f)
+            f.rename(oversize_cache.joinpath(f.name))
+    return oversize_cache
+
+
+def get_datafiles(datadir: Path) -> Dict[str, Path]:
+    """Cached datafiles by filename, oversize files included"""
+
+    datafiles: Dict[str, Path] = {}
+    oversize_cache = datadir.parent.joinpath("cache_oversize")
+    for folder in (oversize_cache, datadir):
+        if folder.exists():
+            for f in folder.iterdir():
+                if f.is_file():
+                    if f.name in datafiles:
+                        # downloaded again, the oversize file is outdated
+                        datafiles[f.name].unlink()
+                    datafiles[f.name] = f
+    return datafiles
+
+
+def is_datafile(path: Path, z: Path) -> bool:
+    """z is an oversize zip datafile hardlinked as a chunk"""
+
+    oversize_cache = path.joinpath("cache_oversize")
+    if not oversize_cache.exists():
+        return False
+    return any(f.samefile(z) for f in oversize_cache.iterdir())
+
+
+def find_duplicates(
+    datafiles: Mapping[str, Path], checksums: Mapping[str, str], max_size: int
+) -> Dict[str, str]:
+    """
+    Datafiles with the same sha256 and size of another datafile, with the
+    name of the datafile to be archived. Oversize datafiles are not included
+    """
+
+    archived: Dict[Tuple[str, int], str] = {}
+    duplicates: Dict[str, str] = {}
+    for name, f in sorted(datafiles.items()):
+        size = f.stat().st_size
+        if name not in checksums or size > max_size:
+            continue
+        key = (checksums[name], size)
+        if key in archived:
+            duplicates[name] = archived[key]
+        else:
+            archived[key] = name
+    return duplicates
+
+
+def add_duplicates(chunks: List[Path], duplicates: Mapping[str, str]) -> None:
+    """List the duplicates in the chunks of the archived datafiles"""
+
+    for z in chunks:
+        if zip_writer.is_linked(z):
+            continue
+        with zipfile.ZipFile(z, "r") as zip_archive:
+            names = set(zip_archive.namelist())
+        lines = [
+            f"{archived}  {name}\n"
+            for name, archived in sorted(duplicates.items())
+            if archived in names
+        ]
+        if lines:
+            with zip_writer.open_append(z, replaced={DUPLICATES_FILE}) as zip_archive:
+                zip_archive.writestr(DUPLICATES_FILE, "".join(lines))
+
+
+def read_duplicates(zip_archive: zipfile.ZipFile) -> Dict[str, str]:
+    if DUPLICATES_FILE not in zip_archive.namelist():
+        return {}
+    duplicates: Dict[str, str] = {}
+    for line in zip_archive.read(DUPLICATES_FILE).decode().splitlines():
+        archived, _, name = line.partition("  ")
+        duplicates[name] = archived
+    return duplicates
+
+
+def build(path: Path, datadir: Path) -> Optional[Index]:
+    """
+    Index of the archives built from scratch by make_zip_archives.
+    Returns None if the chunks can't be matched with the cached datafiles
+    """
+
+    datafiles = get_datafiles(datadir)
+    checksums = get_checksums(path)
+
+    index: Index = []
+    for z in get_output_chunks(path):
+        with zipfile.ZipFile(z, "r") as zip_archive:
+            names = {
+                n for n in zip_archive.namelist() if n not in manifest.CHECKSUM_FILES
+            }
+            duplicates = read_duplicates(zip_archive)
+
+        archived = (names - {DUPLICATES_FILE}) | duplicates.keys()
+        if archived <= datafiles.keys():
+            files = {
+                name: get_state(datafiles[name], checksums.get(name))
+                for name in archived
+            }
+            index.append({"files": files, "raw": False, "duplicates": duplicates})
+            continue
+
+        # Parts of a split datafile
+        split_name = zip_writer.get_split_name(names)
+        if split_name in datafiles:
+            state = get_state(datafiles[split_name], checksums.get(split_name))
+            index.append({"files": {split_name: state}, "raw": True, "duplicates": {}})
+            continue
+
+        # Oversize zip datafiles are linked as chunks
+        for name, f in datafiles.items():
+            if name.endswith(".zip") and zipfile.is_zipfile(f):
+                with zipfile.ZipFile(f, "r") as zip_archive:
+                    if set(zip_archive.namelist()) == names:
+                        state = get_state(f, checksums.get(name))
+                        index.append(
+                            {"files": {name: state}, "raw": True, "duplicates": {}}
+                        )
+                        break
+        else:
+            log.warning("{}: can't index {}", path, z.name)
+            return None
+
+    return index
+
+
+def update(path: Path, datadir: Path, max_size: int) -> bool:
+    """
+    Archive the new and changed datafiles of the cache in the existing chunks.
+    Returns False if the archives have to be built from scratch
+    """
+
+    move_oversize_files(datadir, max_size)
+    datafiles = get_datafiles(datadir)
+    checksums = get_checksums(path)
+
+    index = load(path)
+    outputs = get_output_chunks(path)
+    if not index or len(index) != len(outputs):
+        return False
+
+    # split datafiles are in more chunks
+    location: Dict[str, List[int]] = {}
+    for i, chunk in enumerate(index):
+        for name in chunk["files"]:
+            location.setdefault(name, []).append(i)
+    added: List[str] = []
+    removed: Dict[int, Set[str]] = {}
+    refreshed = 0
+    # Datafiles no longer cached (e.g. closed orders) are kept in the archives
+    for name, f in sorted(datafiles.items()):
+        state = get_state(f, checksums.get(name))
+        positions = location.get(name, [])
+        if positions and is_archived(index[positions[0]]["files"][name], state):
+            if index[positions[0]]["files"][name] != state:
+                for i in positions:
+                    index[i]["files"][name] = state
+                refreshed += 1
+            continue
+        added.append(name)
+        for i in positions:
+            removed.setdefault(i, set()).add(name)
+
+    # Archived content shared by more names is archived again from scratch
+    deduplicated = {
+        n
+        for chunk in index
+        for item in chunk.get("duplicates", {}).items()
+        for n in item
+    }
+    if deduplicated.intersection(added):
+        log.info("{}: duplicated datafiles changed, archiving from scratch", path)
+        return False
+
+    if not added:
+        if refreshed:
+            save(path, index)
+        log.info(
+            "{}: archives already up to date ({} datafile(s) downloaded again)",
+            path,
+            refreshed,
+        )
+        return True
+
+    # An interrupted update is recovered by rebuilding the archives
+    save(path, None)
+
+    with generations.stage(path):
+        outputs = get_output_chunks(path)
+        for i, names in removed.items():
+            for name in names:
+                index[i]["files"].pop(name)
+            # Raw chunks (and chunks left empty) are deleted once the update is done
+            if not index[i]["raw"]:
+                zip_writer.remove_entries(outputs[i], names)
+
+        chunks = list(zip(outputs, index))
+        new_chunks = add_datafiles(
+            path, chunks, [datafiles[name] for name in added], checksums, max_size
+        )
+
+        publish(path, [z for z, chunk in chunks if chunk["files"]])
+
+    save(path, [chunk for _, chunk in chunks if chunk["files"]])
+    shutil.rmtree(path.joinpath("zip_update"), ignore_errors=True)
+
+    log.info(
+        "{}: {} datafile(s) archived, {} new chunk(s)",
+        path,
+        len(added),
+        len(new_chunks),
+    )
+    return True
+
+
+def add_datafiles(
+    path: Path,
+    chunks: List[Tuple[Path, ArchiveChunk]],
+    datafiles: List[Path],
+    checksums: Mapping[str, str],
+    max_size: int,
+) -> List[Path]:
+    """
+    Append the datafiles to the last chunk (if not raw), then to new chunks.
+    Oversize datafiles are archived in dedicated chunks.
+    New chunks are added to chunks and returned, to be published
+    """
+
+    staging = path.joinpath("zip_update")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+
+    new_chunks: List[Path] = []
+    copied = 0
+
+    def new_chunk(raw: bool = False) -> Tuple[Path, ArchiveChunk]:
+        chunk_path = staging.joinpath(f"chunk{len(new_chunks) + 1}.zip")
+        chunk: ArchiveChunk = {"files": {}, "raw": raw, "duplicates": {}}
+        chunks.append((chunk_path, chunk))
+        new_chunks.append(chunk_path)
+        return chunk_path, chunk
+
+    target: Optional[Tuple[Path, ArchiveChunk]] = None
+    if chunks and not chunks[-1][1]["raw"]:
+        target = chunks[-1]
+    target_zip: Optional[zipfile.ZipFile] = None
+    # estimated size of the target chunk
+    size = target[0].stat().st_size if target else 0
+
+    try:
+        for f in datafiles:
+            state = get_state(f, checksums.get(f.name))
+
+            if state["size"] > max_size and Env.get_bool("ZIP_SPLIT_OVERSIZE"):
+                writer = zip_writer.ChunkedZipWriter(
+                    staging.joinpath(f"{f.name}.parts"),
+                    max_size,
+                    zip_planner.get_level(),
+                )
+                compress_type, _ = zip_planner.get_compression(f)
+                writer.add_parts(f, compress_type)
+                for part in writer.close():
+                    chunk_path, chunk = new_chunk(raw=True)
+                    chunk["files"][f.name] = state
+                    part.replace(chunk_path)
+                continue
+
+            if state["size"] > max_size:
+                chunk_path, chunk = new_chunk(raw=f.name.endswith(".zip"))
+                chunk["files"][f.name] = state
+                if chunk["raw"]:
+                    log.warning("{} is a zip file, directly linked as a chunk", f)
+                    copied += zip_writer.link_file(f, chunk_path)
+                else:
+                    with zipfile.ZipFile(
+                        chunk_path,
+                        "w",
+                        compression=zipfile.ZIP_DEFLATED,
+                        compresslevel=zip_planner.get_level(),
+                    ) as zip_archive:
+                        compress_type, _ = zip_planner.get_compression(f)
+                        zip_archive.write(
+                            f, arcname=f.name, compress_type=compress_type
+                        )
+                continue
+
+            required = zip_writer.get_entry_size(f.name, state["size"])
+            if target is None or size + required > max_size:
+                if target_zip:
+                    target_zip.close()
+                target = new_chunk()
+                target_zip = zipfile.ZipFile(
+                    target[0],
+                    "w",
+                    compression=zipfile.ZIP_DEFLATED,
+                    compresslevel=zip_planner.get_level(),
+                )
+                size = zip_writer.END_OVERHEAD
+            elif target_zip is None:
+                # Published chunks are not modified, they are copied if shared
+                copied += generations.detach(target[0])
+                # The checksum manifests are added again once updated
+                target_zip = zip_writer.open_append(
+                    target[0], replaced=manifest.CHECKSUM_FILES
+                )
+                target_zip.compresslevel = zip_planner.get_level()
+
+            compress_type, _ = zip_planner.get_compression(f)
+            target_zip.write(f, arcname=f.name, compress_type=compress_type)
+            target[1]["files"][f.name] = state
+            size += zip_writer.get_entry_size(
+                f.name, target_zip.getinfo(f.name).compress_size
+            )
+    finally:
+        if target_zip:
+            target_zip.close()
+
+    log.info("{}: {} bytes copied for oversize zip files", path, copied)
+    return new_chunks
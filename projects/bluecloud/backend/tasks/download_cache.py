@@ -0,0 +1,213 @@
+"""
+Download cache shared by all the orders.
+
+Downloaded datafiles are stored once, keyed by the hash of their URL, and
+hardlinked into the cache folder of each order requesting them.
+Entries are revalidated with the server once older than DOWNLOAD_CACHE_TTL
+and the least recently used entries are evicted when the total size
+exceeds DOWNLOAD_CACHE_SIZE (0 to disable the cache).
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, TypedDict
+
+from restapi.config import DATA_PATH
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+# Hidden folder, to be skipped when listing the orders.
+# Hardlinks require the cache to be on the same filesystem of the orders
+CACHE_PATH = DATA_PATH.joinpath(".shared_cache")
+
+
+class CacheEntry(TypedDict, total=False):
+    url: str
+    size: int
+    etag: str
+    last_modified: str
+    sha256: str
+    md5: str
+    # timestamp of the last download or revalidation
+    validated: float
+
+
+# Threads of the same process can't be serialized by flock
+thread_locks: Dict[str, threading.Lock] = {}
+thread_locks_guard = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return Env.get_int("DOWNLOAD_CACHE_SIZE", 0) > 0
+
+
+def get_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def get_data_path(key: str) -> Path:
+    return CACHE_PATH.joinpath("data", key)
+
+
+def get_entry_path(key: str) -> Path:
+    return CACHE_PATH.joinpath("data", f"{key}.json")
+
+
+@contextmanager
+def lock(url: str) -> Iterator[None]:
+    """
+    Serialize the operations on the same url (across threads and workers),
+    so that concurrent orders requesting the same url share a single transfer
+    """
+
+    key = get_key(url)
+    locks_dir = CACHE_PATH.joinpath("locks")
+    locks_dir.mkdir(parents=True, exist_ok=True)
+
+    with thread_locks_guard:
+        thread_lock = thread_locks.setdefault(key, threading.Lock())
+
+    with thread_lock:
+        with open(locks_dir.joinpath(key), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load(url: str) -> Optional[CacheEntry]:
+
+    key = get_key(url)
+    data_path = get_data_path(key)
+    entry_path = get_entry_path(key)
+
+    if not data_path.exists() or not entry_path.exists():
+        return None
+
+    try:
+        with open(entry_path) as entry_file:
+            entry: CacheEntry = json.load(entry_file)
+    except Exception as e:  # pragma: no cover
+        log.warning("Invalid download cache entry {}: {}", entry_path, e)
+        return None
+
+    if entry.get("url") != url:  # pragma: no cover
+        return None
+
+    return entry
+
+
+def is_fresh(entry: CacheEntry) -> bool:
+    DOWNLOAD_CACHE_TTL = Env.get_int("DOWNLOAD_CACHE_TTL", 3600)
+    return time.time() - entry.get("validated", 0) < DOWNLOAD_CACHE_TTL
+
+
+def save(url: str, entry: CacheEntry) -> None:
+    entry["url"] = url
+    entry_path = get_entry_path(get_key(url))
+    tmp_path = entry_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as entry_file:
+        entry_file.write(json.dumps(entry))
+    tmp_path.replace(entry_path)
+
+
+def link(source: Path, dest: Path) -> None:
+    """Hardlink source into dest (replaced if existing), copy if not possible"""
+
+    # Created outside the destination folder, to never leave incomplete
+    # files in the order cache
+    tmp_name = f"{dest.name}.{os.getpid()}.{threading.get_ident()}.link"
+    tmp_dest = dest.parent.parent.joinpath("partial", tmp_name)
+    tmp_dest.parent.mkdir(exist_ok=True)
+    tmp_dest.unlink(missing_ok=True)
+    try:
+        os.link(source, tmp_dest)
+    except OSError as e:  # pragma: no cover
+        log.warning("Can't hardlink {}, copying it: {}", source, e)
+        shutil.copy(source, tmp_dest)
+    tmp_dest.replace(dest)
+
+
+def store(url: str, path: Path, entry: CacheEntry) -> None:
+    """Add a downloaded file to the cache"""
+
+    key = get_key(url)
+    get_data_path(key).parent.mkdir(parents=True, exist_ok=True)
+
+    entry["size"] = path.stat().st_size
+    entry["validated"] = time.time()
+
+    link(path, get_data_path(key))
+    save(url, entry)
+
+    evict()
+
+
+def refresh(url: str, entry: CacheEntry) -> None:
+    """Mark an entry as revalidated with the server"""
+    entry["validated"] = time.time()
+    save(url, entry)
+
+
+def retrieve(url: str, dest: Path) -> bool:
+    """Link a cached file into dest, returns False if no longer available"""
+
+    key = get_key(url)
+    try:
+        link(get_data_path(key), dest)
+    except FileNotFoundError:  # pragma: no cover
+        return False
+
+    # The entry file mtime is used to evict the least recently used entries
+    get_entry_path(key).touch()
+    log.info("{} retrieved from the download cache", url)
+    return True
+
+
+def evict() -> None:
+
+    DOWNLOAD_CACHE_SIZE = Env.get_int("DOWNLOAD_CACHE_SIZE", 0)
+
+    entries: List[Tuple[float, int, str]] = []
+    total_size = 0
+    for entry_path in CACHE_PATH.joinpath("data").glob("*.json"):
+        key = entry_path.stem
+        try:
+            size = get_data_path(key).stat().st_size
+            last_access = entry_path.stat().st_mtime
+        except FileNotFoundError:  # pragma: no cover
+            continue
+        entries.append((last_access, size, key))
+        total_size += size
+
+    if total_size <= DOWNLOAD_CACHE_SIZE:
+        return
+
+    for _, size, key in sorted(entries):
+        if total_size <= DOWNLOAD_CACHE_SIZE:
+            break
+
+        lock_path = CACHE_PATH.joinpath("locks", key)
+        with open(lock_path, "a") as lock_file:
+            # Entries in use are skipped
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            try:
+                get_entry_path(key).unlink(missing_ok=True)
+                # Orders still using this file keep their own hardlink
+                get_data_path(key).unlink(missing_ok=True)
+                total_size -= size
+                log.info("Evicted {} from the download cache ({} bytes)", key, size)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
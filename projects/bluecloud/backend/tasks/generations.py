@@ -0,0 +1,218 @@
+"""
+Generations of the published zip archives of an order.
+
+Published archives are never modified. Each update of the archives is staged
+in a new generation folder (generations/N) where the outputs of the current
+generation (with their index) are hardlinked, to be replaced (or copied
+before modifying them in place). The generation is published by atomically
+switching the `current` symlink: the outputs of the order (output.zip,
+output1.zip ... outputN.zip) are symlinks to current/<output>, so that
+downloads never see incomplete archives. Downloads in progress hold a lease
+(a shared lock of the READERS file) on the generation they are reading:
+superseded generations are deleted once no download is reading them, when
+publishing, closing the order or completing a download.
+"""
+
+import fcntl
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+from bluecloud.tasks import zip_writer
+from restapi.utilities.logs import log
+
+GENERATIONS = "generations"
+CURRENT = "current"
+OUTPUTS = "output*.zip"
+# outputs of the order, with the archives index (archives.INDEX_FILE)
+PUBLISHED = (OUTPUTS, "archives.json")
+# locked by the downloads reading a generation
+READERS = ".readers"
+# staging folders left by crashed workers are deleted after a day
+STAGING_EXPIRATION = 86400
+
+# staging folders of the orders being updated by this thread
+local = threading.local()
+
+
+def get_staging(path: Path) -> Optional[Path]:
+    staging: Dict[Path, Path] = getattr(local, "staging", {})
+    return staging.get(path)
+
+
+def get_current(path: Path) -> Optional[Path]:
+    current = path.joinpath(CURRENT)
+    if not current.is_symlink():
+        return None
+    return path.joinpath(os.readlink(current))
+
+
+def get_folder(path: Path) -> Path:
+    """
+    Folder of the archives of the order: the staged generation if updating,
+    the current generation or the order folder (if published before them)
+    """
+    return get_staging(path) or get_current(path) or path
+
+
+def get_published(folder: Path) -> List[Path]:
+    return [f for pattern in PUBLISHED for f in folder.glob(pattern) if f.is_file()]
+
+
+def get_state(folder: Path) -> Dict[str, Tuple[int, int]]:
+    return {f.name: (f.stat().st_dev, f.stat().st_ino) for f in get_published(folder)}
+
+
+@contextmanager
+def stage(path: Path) -> Iterator[Path]:
+    """
+    Stage a new generation of the outputs, published if changed when exiting.
+    Nested stages of the same order update the outer generation
+    """
+
+    if (staging := get_staging(path)) is not None:
+        yield staging
+        return
+
+    staging = path.joinpath(GENERATIONS, f".staging-{uuid.uuid4().hex}")
+    staging.mkdir(parents=True)
+    staging.joinpath(READERS).touch()
+    for f in get_published(get_current(path) or path):
+        os.link(f, staging.joinpath(f.name))
+
+    registry: Dict[Path, Path] = local.__dict__.setdefault("staging", {})
+    registry[path] = staging
+    try:
+        yield staging
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    else:
+        publish(path, staging)
+    finally:
+        registry.pop(path, None)
+
+
+def detach(z: Path) -> int:
+    """
+    Copy a staged output shared with other generations, to modify it in place.
+    Returns the copied bytes
+    """
+
+    if z.stat().st_nlink == 1:
+        return 0
+    tmp_path = z.with_name(f".{z.name}.tmp")
+    copied = zip_writer.clone_file(z, tmp_path)
+    tmp_path.replace(z)
+    return copied
+
+
+def switch(link: Path, target: str) -> None:
+    """Atomically create or replace a symlink"""
+
+    tmp_link = link.with_name(f".{link.name}.{uuid.uuid4().hex}")
+    tmp_link.symlink_to(target)
+    tmp_link.replace(link)
+
+
+def publish(path: Path, staging: Path) -> None:
+
+    previous = get_current(path)
+    if get_state(previous or path) == get_state(staging):
+        shutil.rmtree(staging, ignore_errors=True)
+        return
+
+    folder = staging.parent
+    numbers = [int(g.name) for g in folder.iterdir() if re.match(r"[0-9]+$", g.name)]
+    generation = folder.joinpath(str(max(numbers, default=0) + 1))
+    staging.rename(generation)
+
+    switch(path.joinpath(CURRENT), f"{GENERATIONS}/{generation.name}")
+
+    names = {z.name for z in generation.glob(OUTPUTS)}
+    for name in sorted(names):
+        link = path.joinpath(name)
+        target = f"{CURRENT}/{name}"
+        if not link.is_symlink() or os.readlink(link) != target:
+            switch(link, target)
+    for link in path.glob(OUTPUTS):
+        if link.name not in names:
+            link.unlink()
+    # published before the generations
+    for f in get_published(path):
+        if not f.is_symlink():
+            f.unlink()
+
+    log.info("{}: published generation {}", path, generation.name)
+
+    collect(path)
+
+
+def lease(output: Path) -> Tuple[Path, Optional[IO[str]]]:
+    """
+    Resolve an output of the order, locking the generation it belongs to
+    until the returned lease is closed. The lease is None if the output was
+    published before the generations or if it is missing (e.g. a stale link)
+    """
+
+    target = output.resolve()
+    while target.parent.parent.name == GENERATIONS:
+        generation = target.parent
+        readers: Optional[IO[str]] = None
+        try:
+            readers = open(generation.joinpath(READERS), "a")
+            fcntl.flock(readers, fcntl.LOCK_SH)
+        except FileNotFoundError:
+            pass
+        if target.exists() and readers is not None:
+            return target, readers
+        if readers is not None:
+            readers.close()
+
+        # Collected after resolving the output: retried if superseded meanwhile
+        superseded = output.resolve()
+        if superseded.parent == generation:
+            break
+        target = superseded
+
+    return target, None
+
+
+def collect(path: Path) -> None:
+    """
+    Delete the superseded generations not read by any download.
+    Safe without locking the order: the current generation and the
+    following ones are never deleted
+    """
+
+    current = get_current(path)
+    folder = path.joinpath(GENERATIONS)
+    if current is None or not folder.exists():
+        return
+
+    for generation in folder.iterdir():
+        if generation.name.startswith(".staging-"):
+            if time.time() - generation.stat().st_mtime > STAGING_EXPIRATION:
+                log.debug("{}: deleting {}", path, generation.name)
+                shutil.rmtree(generation, ignore_errors=True)
+            continue
+        if not re.match(r"[0-9]+$", generation.name):
+            continue
+        if int(generation.name) >= int(current.name):
+            continue
+        try:
+            with open(generation.joinpath(READERS), "a") as readers:
+                fcntl.flock(readers, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                log.debug("{}: deleting generation {}", path, generation.name)
+                shutil.rmtree(generation, ignore_errors=True)
+        except BlockingIOError:
+            log.debug("{}: generation {} is being read", path, generation.name)
+        except FileNotFoundError:  # pragma: no cover
+            # deleted by a concurrent collection
+            pass
@@ -0,0 +1,176 @@
+"""
+Circuit breaker on the download hosts, shared by all the workers through Redis.
+
+After CIRCUIT_BREAKER_FAILURES consecutive failures the circuit of a host is
+opened and the following downloads from that host fail immediately.
+After CIRCUIT_BREAKER_RESET seconds the circuit is half-opened: a single
+download is allowed to probe the host, closing the circuit if successful
+or opening it again if failed.
+"""
+
+import threading
+import time
+from typing import List, Optional, TypedDict, Union
+
+from redis import StrictRedis
+from redis.exceptions import RedisError
+from restapi.connectors import redis
+from restapi.env import Env
+from restapi.exceptions import ServiceUnavailable
+from restapi.utilities.logs import log
+
+KEY_PREFIX = "bluecloud:hosts:"
+PROBE_PREFIX = "bluecloud:probes:"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class HostHealth(TypedDict, total=False):
+    host: str
+    state: str
+    # consecutive failures
+    failures: int
+    opened_at: float
+    last_failure: float
+    last_success: float
+    last_error: str
+
+
+# Shared by all the downloads executed by this worker process,
+# lazily created to be instanced after the fork of the celery workers
+client: Optional[StrictRedis] = None
+client_lock = threading.Lock()
+
+
+def get_redis() -> StrictRedis:
+    global client
+
+    with client_lock:
+        if client is None:
+            client = redis.get_instance().r
+        return client
+
+
+def is_enabled() -> bool:
+    return Env.get_int("CIRCUIT_BREAKER_FAILURES", 0) > 0
+
+
+def get_key(host: str) -> str:
+    return f"{KEY_PREFIX}{host}"
+
+
+def decode(value: Union[bytes, str]) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def get_state(health: HostHealth) -> str:
+
+    if health.get("failures", 0) < Env.get_int("CIRCUIT_BREAKER_FAILURES", 0):
+        return CLOSED
+
+    CIRCUIT_BREAKER_RESET = Env.get_int("CIRCUIT_BREAKER_RESET", 300)
+    if time.time() - health.get("opened_at", 0) < CIRCUIT_BREAKER_RESET:
+        return OPEN
+
+    return HALF_OPEN
+
+
+def load(host: str) -> HostHealth:
+
+    r = get_redis()
+    data = {decode(k): decode(v) for k, v in r.hgetall(get_key(host)).items()}
+
+    health: HostHealth = {"host": host}
+    if "failures" in data:
+        health["failures"] = int(data["failures"])
+    if "opened_at" in data:
+        health["opened_at"] = float(data["opened_at"])
+    if "last_failure" in data:
+        health["last_failure"] = float(data["last_failure"])
+    if "last_success" in data:
+        health["last_success"] = float(data["last_success"])
+    if "last_error" in data:
+        health["last_error"] = data["last_error"]
+    health["state"] = get_state(health)
+    return health
+
+
+def allow(host: str) -> bool:
+    """Verify if a download from host can be attempted"""
+
+    if not host or not is_enabled():
+        return True
+
+    # The breaker is an optimization, downloads are not blocked if Redis fails
+    try:
+        health = load(host)
+
+        if health["state"] == CLOSED:
+            return True
+
+        if health["state"] == OPEN:
+            return False
+
+        # Only one worker probes the host, the others keep failing fast
+        # (until the probe completes or, at most, the reset timeout expires)
+        probe_timeout = max(1, Env.get_int("CIRCUIT_BREAKER_RESET", 300))
+        r = get_redis()
+        if r.set(f"{PROBE_PREFIX}{host}", 1, nx=True, ex=probe_timeout):
+            log.info("Circuit of {} is half-open, probing the host", host)
+            return True
+        return False
+    except (RedisError, ServiceUnavailable) as e:  # pragma: no cover
+        log.error("Can't verify the health of {}: {}", host, e)
+        return True
+
+
+def record_success(host: str) -> None:
+
+    if not host or not is_enabled():
+        return
+
+    try:
+        r = get_redis()
+        key = get_key(host)
+        with r.pipeline() as pipe:
+            pipe.hdel(key, "failures", "opened_at")
+            pipe.hset(key, "last_success", time.time())
+            pipe.delete(f"{PROBE_PREFIX}{host}")
+            pipe.execute()
+    except (RedisError, ServiceUnavailable) as e:  # pragma: no cover
+        log.error("Can't update the health of {}: {}", host, e)
+
+
+def record_failure(host: str, error: str) -> None:
+
+    if not host or not is_enabled():
+        return
+
+    try:
+        r = get_redis()
+        key = get_key(host)
+        now = time.time()
+        with r.pipeline() as pipe:
+            pipe.hincrby(key, "failures", 1)
+            pipe.hset(key, mapping={"last_failure": now, "last_error": error})
+            pipe.delete(f"{PROBE_PREFIX}{host}")
+            failures = pipe.execute()[0]
+
+        # Opened when the threshold is reached and again at each failed probe
+        CIRCUIT_BREAKER_FAILURES = Env.get_int("CIRCUIT_BREAKER_FAILURES", 0)
+        if failures >= CIRCUIT_BREAKER_FAILURES:
+            log.warning("{} failures from {}, opening the circuit", failures, host)
+            r.hset(key, "opened_at", now)
+    except (RedisError, ServiceUnavailable) as e:  # pragma: no cover
+        log.error("Can't update the health of {}: {}", host, e)
+
+
+def get_hosts() -> List[HostHealth]:
+
+    r = get_redis()
+    hosts: List[HostHealth] = []
+    for key in r.scan_iter(match=f"{KEY_PREFIX}*"):
+        hosts.append(load(decode(key)[len(KEY_PREFIX) :]))
+    return sorted(hosts, key=lambda h: h["host"])
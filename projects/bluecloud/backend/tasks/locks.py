@@ -0,0 +1,169 @@
+"""
+Locks of the zip archives of the orders, shared by all the workers through Redis.
+
+The lock of an order is a lease of ORDER_LOCK_TTL seconds, renewed by a
+heartbeat while held, so that the locks of crashed workers expire. Waiting
+workers are notified as soon as the lock is released (and retry every
+LOCK_SLEEP_TIME seconds, in case of lost notifications).
+If Redis is not available, the order is locked with a file lock, only
+effective among the workers of the same node.
+"""
+
+import fcntl
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from bluecloud.tasks.host_health import get_redis
+from redis import StrictRedis
+from redis.exceptions import RedisError
+from restapi.env import Env
+from restapi.exceptions import ServiceUnavailable
+from restapi.utilities.logs import log
+
+KEY_PREFIX = "bluecloud:locks:"
+CHANNEL_PREFIX = "bluecloud:released:"
+
+# Executed atomically by Redis: only the holder can renew or release the lock
+RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('PUBLISH', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Locks acquired by this worker process, with the time spent waiting for them
+waits = {"count": 0, "total": 0.0, "max": 0.0}
+waits_lock = threading.Lock()
+
+
+def get_key(path: Path) -> str:
+    return f"{KEY_PREFIX}{path}"
+
+
+def get_channel(path: Path) -> str:
+    return f"{CHANNEL_PREFIX}{path}"
+
+
+def get_ttl() -> int:
+    """Lease of the locks, in milliseconds"""
+    return max(1, Env.get_int("ORDER_LOCK_TTL", 60)) * 1000
+
+
+def connect() -> Optional[StrictRedis]:
+    try:
+        r = get_redis()
+        r.ping()
+        return r
+    except (RedisError, ServiceUnavailable) as e:
+        log.error("Can't lock the orders with Redis: {}", e)
+        return None
+
+
+def acquire(r: StrictRedis, path: Path, token: str) -> None:
+
+    LOCK_SLEEP_TIME = Env.get_int("LOCK_SLEEP_TIME", 30)
+
+    # Subscribed before trying, to not miss a release
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(get_channel(path))
+    try:
+        while not r.set(get_key(path), token, nx=True, px=get_ttl()):
+            # expired locks are not notified
+            timeout: float = LOCK_SLEEP_TIME
+            if (expire := r.pttl(get_key(path))) > 0:
+                timeout = min(timeout, expire / 1000)
+            log.debug("{}: order locked, waiting", path)
+            pubsub.get_message(timeout=timeout)
+    finally:
+        pubsub.close()
+
+
+def renew(r: StrictRedis, path: Path, token: str, stop: threading.Event) -> None:
+    """Heartbeat of a held lock, renewing its lease"""
+
+    ttl = get_ttl()
+    while not stop.wait(ttl / 3000):
+        try:
+            if not r.eval(RENEW, 1, get_key(path), token, ttl):
+                log.error("{}: order lock expired while held", path)
+                return
+        except RedisError as e:  # pragma: no cover
+            log.error("{}: can't renew the order lock: {}", path, e)
+
+
+def add_wait(path: Path, start: float, kind: str) -> None:
+    wait = time.monotonic() - start
+    with waits_lock:
+        waits["count"] += 1
+        waits["total"] += wait
+        waits["max"] = max(waits["max"], wait)
+    log.info("{}: order locked{}, waited {:.1f} seconds", path, kind, wait)
+
+
+def log_stats() -> None:
+    """Log and reset the time spent waiting for the order locks"""
+
+    with waits_lock:
+        if waits["count"]:
+            log.info(
+                "Order locks: waited {:.1f} seconds ({} times, max {:.1f})",
+                waits["total"],
+                waits["count"],
+                waits["max"],
+            )
+        waits.update(count=0, total=0.0, max=0.0)
+
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    # released by the kernel if the worker crashes
+    with open(path.joinpath("lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def order_lock(path: Path) -> Iterator[None]:
+    """Serialize the updates of the zip archives of an order"""
+
+    start = time.monotonic()
+    r = connect()
+    if r is None:
+        with file_lock(path):
+            add_wait(path, start, " on this node")
+            yield
+        return
+
+    token = uuid.uuid4().hex
+    acquire(r, path, token)
+    add_wait(path, start, "")
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=renew, args=(r, path, token, stop), daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        heartbeat.join()
+        try:
+            r.eval(RELEASE, 2, get_key(path), get_channel(path), token)
+        except RedisError as e:  # pragma: no cover
+            # released once expired
+            log.error("{}: can't release the order lock: {}", path, e)
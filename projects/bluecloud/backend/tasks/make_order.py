@@ -1,20 +1,54 @@
+import asyncio
 import ftplib
+import hashlib
 import json
+import math
+import os
 import re
 import shutil
 import socket
+import threading
 import time
+import uuid
 import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Tuple, TypedDict
-from urllib.parse import urlparse
-
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+)
+from urllib.parse import unquote, urlparse
+
+import aioftp
+import aiohttp
 import requests
 import urllib3
 from bluecloud.endpoints.schemas import DownloadType
-from plumbum import local  # type: ignore
-from plumbum.commands.processes import ProcessExecutionError  # type: ignore
+from bluecloud.tasks import (
+    archives,
+    download_cache,
+    generations,
+    host_health,
+    locks,
+    manifest,
+    merges,
+    rate_limit,
+    zip_planner,
+    zip_writer,
+)
+from celery.utils.time import get_exponential_backoff_interval
+from requests.adapters import HTTPAdapter
 from restapi.config import DATA_PATH
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.env import Env
@@ -49,6 +83,26 @@ class ResponseType(TypedDict):
 }
 
 
+class ResumeInfo(TypedDict, total=False):
+    url: str
+    # ETag or Last-Modified of the remote file, sent with If-Range
+    validator: str
+    # Only for segmented downloads
+    size: int
+    segments: List[Tuple[int, int]]
+    completed: List[int]
+
+
+class DownloadMetadata(TypedDict, total=False):
+    etag: str
+    last_modified: str
+    not_modified: bool
+    # computed while downloading, if possible
+    sha256: str
+    md5: str
+    size: int
+
+
 class ErrorCodes:
     UNREACHABLE_DOWNLOAD_PATH = ("001", "Download path is unreachable")
     INVALID_RESPONSE = ("002", "Invalid response, received status different than 200")
@@ -57,248 +111,2202 @@ class ErrorCodes:
     UNEXPECTED_ERROR = ("999", "An unexpected error occurred")
 
 
-def http_download(url: str, out_path: Path) -> Optional[Tuple[str, str]]:
+# Shared by all the downloads executed by this worker process,
+# lazily created to be instanced after the fork of the celery workers
+http_session: Optional[requests.Session] = None
+http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    global http_session
+
+    with http_session_lock:
+        if http_session is None:
+            # Number of hosts with a pool kept alive
+            HTTP_POOL_CONNECTIONS = Env.get_int("HTTP_POOL_CONNECTIONS", 10)
+            # Each transfer in progress on a host (see HostSlots) uses
+            # one connection, kept alive for the following transfers
+            pool_maxsize = get_host_workers()
+
+            log.info(
+                "Creating HTTP session (pools: {}, connections per pool: {})",
+                HTTP_POOL_CONNECTIONS,
+                pool_maxsize,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=pool_maxsize,
+                # wait for a free connection instead of opening
+                # connections that would be discarded afterwards
+                pool_block=True,
+            )
+            http_session = requests.Session()
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+
+        return http_session
+
+
+def log_http_pool_stats() -> None:
+
+    if http_session is None:
+        return
+
+    # The same adapter is mounted for both http:// and https://
+    adapter = http_session.get_adapter("https://")
+    if not isinstance(adapter, HTTPAdapter):  # pragma: no cover
+        return
+
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools[key]
+        if pool is None:  # pragma: no cover
+            continue
+        log.info(
+            "HTTP pool {}://{}:{}: {} connection(s) opened, {} request(s) sent",
+            key.key_scheme,
+            key.key_host,
+            key.key_port,
+            pool.num_connections,
+            pool.num_requests,
+        )
+
+
+def get_host(url: str) -> str:
+    # credentials are excluded, hosts are logged and exposed by the API
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    return f"{host}:{parsed.port}" if parsed.port else host
+
+
+def get_host_workers() -> int:
+    return max(1, Env.get_int("DOWNLOAD_WORKERS_PER_HOST", 1))
+
+
+class HostSlots:
+    """
+    Transfers in progress on each host in this worker process, taken by the
+    order lines and by the additional segments of their downloads, so that
+    no more than DOWNLOAD_WORKERS_PER_HOST connections are opened to a host
+    """
+
+    def __init__(self) -> None:
+        self.running: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host: str, count: int = 1) -> int:
+        """Take up to count free slots of the host, returns the number taken"""
+
+        with self.lock:
+            running = self.running.get(host, 0)
+            taken = max(0, min(count, get_host_workers() - running))
+            if taken:
+                self.running[host] = running + taken
+            return taken
+
+    def release(self, host: str, count: int = 1) -> None:
+        if not count:
+            return
+        with self.lock:
+            self.running[host] -= count
+            if self.running[host] <= 0:
+                del self.running[host]
+
+
+host_slots = HostSlots()
+
+
+def get_partial_path(out_path: Path) -> Path:
+    # Incomplete downloads are kept outside the cache folder
+    # to prevent them from being included in the zip archives
+    partial_dir = out_path.parent.parent.joinpath("partial")
+    partial_dir.mkdir(exist_ok=True)
+    return partial_dir.joinpath(f"{out_path.name}.part")
+
+
+def get_resume_info_path(partial: Path) -> Path:
+    return partial.with_name(f"{partial.name}.json")
+
+
+def write_resume_info(partial: Path, info: ResumeInfo) -> None:
+    with open(get_resume_info_path(partial), "w") as info_file:
+        info_file.write(json.dumps(info))
+
+
+def save_resume_info(
+    url: str, partial: Path, headers: Mapping[str, str]
+) -> Optional[ResumeInfo]:
+
+    info_path = get_resume_info_path(partial)
+
+    etag = headers.get("ETag", "")
+    # Weak etags can't be used with If-Range
+    validator = etag if etag and not etag.startswith("W/") else None
+    validator = validator or headers.get("Last-Modified")
+
+    # Compressed responses are decoded on the fly, so that the written bytes
+    # can't be matched with the ranges of the remote content
+    encoding = headers.get("Content-Encoding", "identity")
+
+    if (
+        not validator
+        or encoding != "identity"
+        or headers.get("Accept-Ranges") == "none"
+    ):
+        info_path.unlink(missing_ok=True)
+        return None
+
+    info: ResumeInfo = {"url": url, "validator": validator}
+    write_resume_info(partial, info)
+    return info
+
+
+def load_resume_info(url: str, partial: Path) -> Optional[ResumeInfo]:
+
+    info_path = get_resume_info_path(partial)
+
+    if not partial.exists() or not info_path.exists():
+        return None
 
     try:
-        r = requests.get(
-            url,
-            stream=True,
-            verify=False,
-            headers=DOWNLOAD_HEADERS,
-            timeout=120,
+        with open(info_path) as info_file:
+            info: ResumeInfo = json.load(info_file)
+    except Exception as e:  # pragma: no cover
+        log.warning("Invalid resume info {}: {}", info_path, e)
+        return None
+
+    if info.get("url") != url or not info.get("validator"):
+        return None
+
+    return info
+
+
+def get_resume_headers(url: str, partial: Path) -> Dict[str, str]:
+    """
+    Return the headers needed to resume a previous incomplete download
+    or an empty dict if the download is to be restarted from scratch
+    """
+
+    info = load_resume_info(url, partial)
+
+    # Segmented downloads are preallocated, the size of the partial file
+    # is not the number of downloaded bytes
+    if not info or "segments" in info:
+        return {}
+
+    offset = partial.stat().st_size
+    if offset == 0:
+        return {}
+
+    return {
+        "Range": f"bytes={offset}-",
+        # If the remote file changed the whole content will be returned
+        "If-Range": info["validator"],
+        "Accept-Encoding": "identity",
+    }
+
+
+def is_resumed(partial: Path, status: int, headers: Mapping[str, str]) -> bool:
+
+    if status != 206 or not partial.exists():
+        return False
+
+    offset = partial.stat().st_size
+    return headers.get("Content-Range", "").startswith(f"bytes {offset}-")
+
+
+def discard_partial(partial: Path) -> None:
+    partial.unlink(missing_ok=True)
+    get_resume_info_path(partial).unlink(missing_ok=True)
+
+
+def complete_partial(partial: Path, out_path: Path) -> None:
+    # Atomic rename, the file is available in the cache only when completed
+    partial.replace(out_path)
+    get_resume_info_path(partial).unlink(missing_ok=True)
+
+
+class RestartDownload(Exception):
+    pass
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+def get_segments(size: int, count: int) -> List[Tuple[int, int]]:
+    step = math.ceil(size / count)
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+def get_segmented_info(
+    info: Optional[ResumeInfo], headers: Mapping[str, str]
+) -> Optional[ResumeInfo]:
+    """
+    Extend the resume info with the segments of the file,
+    if the download is to be split in multiple parallel ranges
+    """
+
+    # Min size (in bytes) of the files to be downloaded in segments, 0 to disable
+    HTTP_SEGMENT_THRESHOLD = Env.get_int("HTTP_SEGMENT_THRESHOLD", 0)
+    HTTP_SEGMENTS = Env.get_int("HTTP_SEGMENTS", 4)
+
+    # info is None when the download can't be resumed, i.e. ranges are not usable
+    if not info or HTTP_SEGMENT_THRESHOLD <= 0 or HTTP_SEGMENTS <= 1:
+        return None
+
+    if headers.get("Accept-Ranges") != "bytes":
+        return None
+
+    size = Env.to_int(headers.get("Content-Length"), 0)
+    if size < HTTP_SEGMENT_THRESHOLD:
+        return None
+
+    info["size"] = size
+    info["segments"] = get_segments(size, HTTP_SEGMENTS)
+    info["completed"] = []
+    return info
+
+
+def preallocate(path: Path, size: int) -> None:
+    with open(path, "wb") as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        # not available on this platform or not supported by the filesystem
+        except (AttributeError, OSError):  # pragma: no cover
+            f.truncate(size)
+
+
+def get_buffer_size() -> int:
+    return max(65536, Env.get_int("DOWNLOAD_BUFFER_SIZE", 1048576))
+
+
+def get_expected_size(
+    status: int, headers: Mapping[str, str], offset: int
+) -> Optional[int]:
+    """Size of the complete file, if declared by the response headers"""
+
+    # The length of encoded contents differs from the written (decoded) size
+    if headers.get("Content-Encoding", "identity") != "identity":
+        return None
+
+    if status == 206:
+        total = headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+
+    length = headers.get("Content-Length", "")
+    return offset + int(length) if length.isdigit() else None
+
+
+class StreamWriter:
+    """
+    Write a download into the partial file, computing the checksums on the fly
+    to not read the file again once completed. When resuming, the content
+    already downloaded is read to initialize the checksums.
+    Only the transfers that can't be resumed are preallocated: the size of a
+    resumable partial file is the offset to resume from, also after a crash
+    """
+
+    def __init__(
+        self,
+        partial: Path,
+        resume: bool = False,
+        size: Optional[int] = None,
+        preallocate: bool = False,
+    ) -> None:
+        self.partial = partial
+        self.resume = resume
+        self.size = size
+        self.preallocate = preallocate
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.written = 0
+
+    def __enter__(self) -> "StreamWriter":
+
+        if self.resume:
+            with open(self.partial, "rb") as f:
+                while chunk := f.read(get_buffer_size()):
+                    self.update(chunk)
+            self.file = open(self.partial, "ab")
+            return self
+
+        self.file = open(self.partial, "wb")
+        if self.size and self.preallocate:
+            try:
+                os.posix_fallocate(self.file.fileno(), 0, self.size)
+            # not available on this platform or not supported by the filesystem
+            except (AttributeError, OSError):  # pragma: no cover
+                pass
+        return self
+
+    def update(self, chunk: bytes) -> None:
+        self.sha256.update(chunk)
+        self.md5.update(chunk)
+        self.written += len(chunk)
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+        self.update(chunk)
+
+    def __exit__(self, *args: Any) -> None:
+        # Preallocated space not written (e.g. interrupted transfers) is released,
+        # the size of the partial file is the offset to resume the download
+        self.file.truncate(self.written)
+        self.file.close()
+
+    def verify(self) -> None:
+        if self.size is not None and self.written != self.size:
+            raise IncompleteDownload(
+                f"{self.partial.name}: expected {self.size} bytes, "
+                f"received {self.written}"
+            )
+
+    def save_checksums(self, metadata: Optional[DownloadMetadata]) -> None:
+        if metadata is not None:
+            metadata["sha256"] = self.sha256.hexdigest()
+            metadata["md5"] = self.md5.hexdigest()
+            metadata["size"] = self.written
+
+
+class ArchiveWriter(StreamWriter):
+    """
+    Write a download directly into an entry of the output zip chunks.
+    Failed, incomplete or empty transfers are discarded from the chunk
+    (they can't be resumed, the whole file is downloaded again)
+    """
+
+    def __init__(
+        self,
+        archive: zip_writer.ChunkedZipWriter,
+        name: str,
+        size: Optional[int] = None,
+    ) -> None:
+        super().__init__(Path(name), size=size)
+        self.archive = archive
+
+    def __enter__(self) -> "ArchiveWriter":
+        # Without the whole content only the extension tells compressed files
+        compress_type = (
+            zipfile.ZIP_STORED
+            if zip_planner.is_compressed(self.partial.name)
+            else zipfile.ZIP_DEFLATED
         )
+        self.entry = self.archive.open(
+            self.partial.name, self.size, compress_type=compress_type
+        )
+        return self
+
+    def write(self, chunk: bytes) -> None:
+        self.entry.write(chunk)
+        self.update(chunk)
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        completed = self.size is None or self.written == self.size
+        if exc_type is None and completed and self.written > 0:
+            self.entry.close()
+        else:
+            self.entry.discard()
+
+
+def write_segment(partial: Path, start: int, end: int, r: requests.Response) -> None:
+
+    throttle = rate_limit.Throttle(get_host(r.url))
+    remaining = end - start + 1
+    with open(partial, "r+b") as downloaded_file:
+        downloaded_file.seek(start)
+        for chunk in r.iter_content(chunk_size=65536):
+            # The first segment is read from the response with the whole content
+            chunk = chunk[:remaining]
+            downloaded_file.write(chunk)
+            throttle.wait(len(chunk))
+            remaining -= len(chunk)
+            if remaining <= 0:
+                break
+
+    if remaining > 0:
+        raise IncompleteDownload(f"Segment {start}-{end}: {remaining} bytes missing")
+
+
+def download_segment(
+    url: str, partial: Path, start: int, end: int, validator: str
+) -> None:
+
+    headers = {
+        **DOWNLOAD_HEADERS,
+        "Range": f"bytes={start}-{end}",
+        "If-Range": validator,
+        "Accept-Encoding": "identity",
+    }
+    rate_limit.wait_request(get_host(url))
+    with get_http_session().get(
+        url, stream=True, verify=False, headers=headers, timeout=120
+    ) as r:
+
+        # If-Range failed, the whole (new) content is returned
+        if r.status_code == 200:
+            raise RestartDownload(f"{url} changed during the download")
+
+        content_range = r.headers.get("Content-Range", "")
+        if r.status_code != 206 or not content_range.startswith(
+            f"bytes {start}-{end}/"
+        ):
+            raise IncompleteDownload(
+                f"Segment {start}-{end}: invalid response {r.status_code}"
+            )
+
+        write_segment(partial, start, end, r)
+
+
+def segmented_download(
+    url: str,
+    partial: Path,
+    info: ResumeInfo,
+    first: Optional[requests.Response] = None,
+) -> None:
+    """
+    Download the pending segments of a preallocated partial file in parallel.
+    If provided, the first segment is read from the already opened response.
+    The slot of the order line is shared with one of the segments,
+    the others are downloaded in parallel only if free slots of the host
+    are available
+    """
+
+    segments = info["segments"]
+    completed = set(info.get("completed", []))
+    lock = threading.Lock()
+
+    def fetch(index: int) -> None:
+        start, end = segments[index]
+        if index == 0 and first is not None:
+            write_segment(partial, start, end, first)
+            # the connection is given back to the pool for the following segments
+            first.close()
+        else:
+            download_segment(url, partial, start, end, info["validator"])
+
+        # Completed segments are saved to be skipped if the download is resumed
+        with lock:
+            completed.add(index)
+            info["completed"] = sorted(completed)
+            write_resume_info(partial, info)
+
+    pending = [i for i in range(len(segments)) if i not in completed]
+
+    # Interrupted after the last segment, only the partial file is to be completed
+    if not pending:
+        log.info("All the segments of {} are already downloaded", url)
+        return
+
+    host = get_host(url)
+    extra = host_slots.acquire(host, len(pending) - 1)
+
+    log.info(
+        "Downloading {} ({} bytes) in {}/{} segment(s), {} in parallel",
+        url,
+        info["size"],
+        len(pending),
+        len(segments),
+        1 + extra,
+    )
+
+    try:
+        with ThreadPoolExecutor(max_workers=1 + extra) as executor:
+            futures = [executor.submit(fetch, index) for index in pending]
+            for future in futures:
+                future.result()
+    finally:
+        host_slots.release(host, extra)
+
+
+def get_conditional_headers(metadata: Optional[DownloadMetadata]) -> Dict[str, str]:
+
+    headers: Dict[str, str] = {}
+    if not metadata:
+        return headers
+
+    if etag := metadata.get("etag"):
+        headers["If-None-Match"] = etag
+    if last_modified := metadata.get("last_modified"):
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def save_metadata(metadata: DownloadMetadata, headers: Mapping[str, str]) -> None:
+
+    metadata.pop("etag", None)
+    metadata.pop("last_modified", None)
+
+    if etag := headers.get("ETag"):
+        metadata["etag"] = etag
+    if last_modified := headers.get("Last-Modified"):
+        metadata["last_modified"] = last_modified
+
+
+def http_stream_download(
+    url: str, partial: Path, metadata: Optional[DownloadMetadata]
+) -> Optional[Tuple[str, str]]:
+
+    resume_headers = get_resume_headers(url, partial)
+    conditional_headers = {} if resume_headers else get_conditional_headers(metadata)
+
+    rate_limit.wait_request(get_host(url))
+    with get_http_session().get(
+        url,
+        stream=True,
+        verify=False,
+        headers={**DOWNLOAD_HEADERS, **resume_headers, **conditional_headers},
+        timeout=120,
+    ) as r:
+
+        if conditional_headers and r.status_code == 304 and metadata is not None:
+            log.info("{} not modified", url)
+            metadata["not_modified"] = True
+            return None
+
+        if metadata is not None:
+            metadata["not_modified"] = False
+            save_metadata(metadata, r.headers)
+
+        resumed = is_resumed(partial, r.status_code, r.headers)
+
+        if resume_headers and not resumed and r.status_code != 200:
+            raise RestartDownload(
+                f"Can't resume the download of {url} (status: {r.status_code})"
+            )
+
+        if r.status_code != 200 and not resumed:  # pragma: no cover
+            log.error("Invalid response from {}: {}", url, r.status_code)
+
+            return ErrorCodes.INVALID_RESPONSE
+
+        resumable = True
+        if resumed:
+            log.info(
+                "Resuming download of {} from byte {}", url, partial.stat().st_size
+            )
+        else:
+            info = save_resume_info(url, partial, r.headers)
+            resumable = info is not None
+            info = get_segmented_info(info, r.headers)
+
+            if info and "segments" in info:
+                preallocate(partial, info["size"])
+                write_resume_info(partial, info)
+                segmented_download(url, partial, info, first=r)
+                return None
+
+        throttle = rate_limit.Throttle(get_host(url))
+        offset = partial.stat().st_size if resumed else 0
+        size = get_expected_size(r.status_code, r.headers, offset)
+        with StreamWriter(
+            partial, resume=resumed, size=size, preallocate=not resumable
+        ) as writer:
+            for chunk in r.iter_content(chunk_size=get_buffer_size()):
+                if chunk:  # filter out keep-alive new chunks
+                    writer.write(chunk)
+                    throttle.wait(len(chunk))
+
+    # Truncated transfers are detected here, the partial file is kept
+    # to resume the download on the next attempt
+    writer.verify()
+    writer.save_checksums(metadata)
+    return None
+
+
+def http_archive_download(
+    url: str,
+    name: str,
+    archive: zip_writer.ChunkedZipWriter,
+    metadata: Optional[DownloadMetadata],
+) -> Optional[Tuple[str, str]]:
+
+    conditional_headers = get_conditional_headers(metadata)
+
+    rate_limit.wait_request(get_host(url))
+    with get_http_session().get(
+        url,
+        stream=True,
+        verify=False,
+        headers={**DOWNLOAD_HEADERS, **conditional_headers},
+        timeout=120,
+    ) as r:
+
+        if conditional_headers and r.status_code == 304 and metadata is not None:
+            log.info("{} not modified", url)
+            metadata["not_modified"] = True
+            return None
+
+        if metadata is not None:
+            metadata["not_modified"] = False
+            save_metadata(metadata, r.headers)
 
         if r.status_code != 200:  # pragma: no cover
             log.error("Invalid response from {}: {}", url, r.status_code)
 
             return ErrorCodes.INVALID_RESPONSE
 
-        with open(out_path, "wb") as downloaded_file:
-            for chunk in r.iter_content(chunk_size=1024):
+        throttle = rate_limit.Throttle(get_host(url))
+        size = get_expected_size(r.status_code, r.headers, 0)
+        with ArchiveWriter(archive, name, size=size) as writer:
+            for chunk in r.iter_content(chunk_size=get_buffer_size()):
                 if chunk:  # filter out keep-alive new chunks
-                    downloaded_file.write(chunk)
+                    writer.write(chunk)
+                    throttle.wait(len(chunk))
+
+    writer.verify()
+    writer.save_checksums(metadata)
+    return None
+
+
+def http_download(
+    url: str,
+    out_path: Path,
+    metadata: Optional[DownloadMetadata] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+    restarted: bool = False,
+) -> Optional[Tuple[str, str]]:
+    """
+    If metadata is provided, its validators are used to send a conditional
+    request and are updated with the response. In case of a 304 response
+    out_path is not written and metadata["not_modified"] is set.
+    If archive is provided the file is written in the zip chunks
+    (as out_path.name) instead of out_path
+    """
+
+    partial = get_partial_path(out_path)
+    info = load_resume_info(url, partial)
+    restart = False
 
+    try:
+        if archive is not None:
+            return http_archive_download(url, out_path.name, archive, metadata)
+
+        if info and "segments" in info:
+            log.info("Resuming segmented download of {}", url)
+            segmented_download(url, partial, info)
+        elif error := http_stream_download(url, partial, metadata):
+            return error
+        elif metadata and metadata.get("not_modified"):
+            return None
+
+    except RestartDownload as e:
+        log.warning("{}, restarting", e)
+        restart = True
     except requests.exceptions.ConnectionError as e:
         log.error(e)
+        host_health.record_failure(get_host(url), str(e))
         return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
     except requests.exceptions.MissingSchema as e:
         log.error(e)
         return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
     except requests.exceptions.Timeout as e:
         log.error(e)
+        host_health.record_failure(get_host(url), str(e))
         return ErrorCodes.DOWNLOAD_TIMEOUT
     except Exception as e:
         log.error(e)
         return ErrorCodes.UNEXPECTED_ERROR
 
+    if restart:
+        discard_partial(partial)
+        # e.g. a file changing during each download, retried by the next attempt
+        if restarted:
+            log.error("{} restarted twice, giving up", url)
+            return ErrorCodes.UNEXPECTED_ERROR
+        return http_download(url, out_path, metadata, restarted=True)
+
+    complete_partial(partial, out_path)
     return None
 
 
+class FTPPool:
+    """
+    Logged in FTP connections, kept open to be reused by the following
+    downloads on the same server instead of connecting and logging in again
+    """
+
+    def __init__(self) -> None:
+        self.idle: Dict[Tuple[str, int, str], List[Tuple[ftplib.FTP, float]]] = {}
+        self.lock = threading.Lock()
+        self.logins = 0
+        self.reused = 0
+
+    def acquire(self, host: str, port: int, user: str, passwd: str) -> ftplib.FTP:
+
+        key = (host, port, user)
+        FTP_IDLE_TIMEOUT = Env.get_int("FTP_IDLE_TIMEOUT", 60)
+
+        while True:
+            with self.lock:
+                connections = self.idle.get(key)
+                if not connections:
+                    break
+                ftp, last_used = connections.pop()
+
+            if time.monotonic() - last_used > FTP_IDLE_TIMEOUT:
+                self.discard(ftp)
+                continue
+
+            # Keepalive to verify that the connection is still usable,
+            # otherwise it is discarded and a new connection is tried
+            try:
+                ftp.voidcmd("NOOP")
+            except ftplib.all_errors as e:
+                log.info("Discarding FTP connection to {}: {}", host, e)
+                self.discard(ftp)
+                continue
+
+            with self.lock:
+                self.reused += 1
+            return ftp
+
+        ftp = ftplib.FTP(timeout=120)
+        ftp.connect(host, port)
+        try:
+            # anonymous login if no credentials are provided in the url
+            ftp.login(user, passwd)
+        except BaseException:
+            self.discard(ftp)
+            raise
+
+        with self.lock:
+            self.logins += 1
+        return ftp
+
+    def release(self, ftp: ftplib.FTP, host: str, port: int, user: str) -> None:
+
+        FTP_POOL_MAXSIZE = Env.get_int("FTP_POOL_MAXSIZE", 4)
+
+        key = (host, port, user)
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < FTP_POOL_MAXSIZE:
+                connections.append((ftp, time.monotonic()))
+                return
+
+        self.close(ftp)
+
+    @staticmethod
+    def discard(ftp: ftplib.FTP) -> None:
+        try:
+            ftp.close()
+        except Exception:  # pragma: no cover
+            pass
+
+    @staticmethod
+    def close(ftp: ftplib.FTP) -> None:
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            FTPPool.discard(ftp)
+
+    def close_all(self) -> None:
+
+        with self.lock:
+            connections = [ftp for idle in self.idle.values() for ftp, _ in idle]
+            self.idle.clear()
+            logins, reused = self.logins, self.reused
+            self.logins = 0
+            self.reused = 0
+
+        for ftp in connections:
+            self.close(ftp)
+
+        if logins or reused:
+            log.info("FTP pool: {} login(s), {} connection(s) reused", logins, reused)
+
+
+ftp_pool = FTPPool()
+
+
+def get_ftp_validator(ftp: ftplib.FTP, path: str) -> Optional[str]:
+    """
+    Return size and modification time of the remote file, used to verify that
+    the file is unchanged before resuming a download. None if not supported
+    """
+    try:
+        ftp.voidcmd("TYPE I")
+        size = ftp.size(path)
+    except ftplib.error_perm:
+        return None
+
+    if size is None:  # pragma: no cover
+        return None
+
+    try:
+        mdtm = ftp.voidcmd(f"MDTM {path}").split()[-1]
+    except ftplib.error_perm:
+        mdtm = ""
+
+    return f"{size}:{mdtm}"
+
+
+def get_ftp_offset(url: str, partial: Path, validator: Optional[str]) -> int:
+    """
+    Return the offset to resume the download from, 0 if the remote file changed
+    or can't be validated. The resume info is updated with the validator
+    """
+
+    info = load_resume_info(url, partial)
+    if info and validator and info.get("validator") == validator:
+        return partial.stat().st_size
+
+    if validator:
+        write_resume_info(partial, {"url": url, "validator": validator})
+    else:
+        get_resume_info_path(partial).unlink(missing_ok=True)
+    return 0
+
+
+def get_ftp_callback(
+    writer: StreamWriter, throttle: rate_limit.Throttle
+) -> Callable[[bytes], None]:
+    def callback(data: bytes) -> None:
+        writer.write(data)
+        throttle.wait(len(data))
+
+    return callback
+
+
+def ftp_archive_retrieve(
+    ftp: ftplib.FTP,
+    url: str,
+    path: str,
+    name: str,
+    archive: zip_writer.ChunkedZipWriter,
+    metadata: Optional[DownloadMetadata] = None,
+) -> None:
+
+    validator = get_ftp_validator(ftp, path)
+    size = int(validator.split(":")[0]) if validator else None
+
+    throttle = rate_limit.Throttle(get_host(url))
+    rate_limit.wait_request(get_host(url))
+    with ArchiveWriter(archive, name, size=size) as writer:
+        ftp.retrbinary(
+            f"RETR {path}", get_ftp_callback(writer, throttle), get_buffer_size()
+        )
+
+    writer.verify()
+    writer.save_checksums(metadata)
+
+
+def ftp_retrieve(
+    ftp: ftplib.FTP,
+    url: str,
+    path: str,
+    partial: Path,
+    metadata: Optional[DownloadMetadata] = None,
+) -> None:
+
+    validator = get_ftp_validator(ftp, path)
+    offset = get_ftp_offset(url, partial, validator)
+    size = int(validator.split(":")[0]) if validator else None
+
+    if offset and offset == size:
+        log.info("Download of {} already completed", url)
+        return
+
+    if offset:
+        log.info("Resuming download of {} from byte {}", url, offset)
+
+    throttle = rate_limit.Throttle(get_host(url))
+
+    blocksize = get_buffer_size()
+    rate_limit.wait_request(get_host(url))
+    try:
+        with StreamWriter(partial, resume=offset > 0, size=size) as writer:
+            # REST command is sent by retrbinary when rest is provided
+            ftp.retrbinary(
+                f"RETR {path}",
+                get_ftp_callback(writer, throttle),
+                blocksize,
+                rest=offset or None,
+            )
+    except ftplib.error_perm as e:
+        if not offset:
+            raise
+        log.warning("Can't resume the download of {} ({}), restarting", url, e)
+        with StreamWriter(partial, size=size) as writer:
+            ftp.retrbinary(
+                f"RETR {path}", get_ftp_callback(writer, throttle), blocksize
+            )
+
+    writer.verify()
+    writer.save_checksums(metadata)
+
+
 def ftp_download(
-    url: str, out_path: Path
-) -> Optional[Tuple[str, str]]:  # pragma: no cover
+    url: str,
+    out_path: Path,
+    metadata: Optional[DownloadMetadata] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> Optional[Tuple[str, str]]:
+
+    partial = get_partial_path(out_path)
 
     try:
         parsed = urlparse(url)
-        ftp = ftplib.FTP(parsed.netloc, timeout=120)
-        ftp.login()
-        # ftp.login(username, password)
-        with open(out_path, "wb") as downloaded_file:
-            ftp.retrbinary(f"RETR {parsed.path}", downloaded_file.write)
+        host = parsed.hostname or ""
+        port = parsed.port or ftplib.FTP_PORT
+        user = unquote(parsed.username or "")
+        passwd = unquote(parsed.password or "")
+        path = unquote(parsed.path)
+
+        ftp = ftp_pool.acquire(host, port, user, passwd)
+        try:
+            if archive is not None:
+                ftp_archive_retrieve(ftp, url, path, out_path.name, archive, metadata)
+            else:
+                ftp_retrieve(ftp, url, path, partial, metadata)
+        except ftplib.error_perm:
+            # The command failed but the connection is still usable
+            ftp_pool.release(ftp, host, port, user)
+            raise
+        except BaseException:
+            ftp_pool.discard(ftp)
+            raise
+
+        ftp_pool.release(ftp, host, port, user)
+
     except socket.gaierror as e:
         log.error(e)
+        host_health.record_failure(get_host(url), str(e))
         return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
     except ftplib.error_perm as e:
         log.error(e)
         return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
     except socket.timeout as e:
         log.error(e)
+        host_health.record_failure(get_host(url), str(e))
         return ErrorCodes.DOWNLOAD_TIMEOUT
+    except ConnectionError as e:
+        log.error(e)
+        host_health.record_failure(get_host(url), str(e))
+        return ErrorCodes.UNEXPECTED_ERROR
     except Exception as e:
         log.error(e)
         return ErrorCodes.UNEXPECTED_ERROR
 
+    if archive is None:
+        complete_partial(partial, out_path)
+    return None
+
+
+async def async_wait_request(host: str) -> None:
+    # the event loop is kept free while waiting for the limiters
+    if seconds := rate_limit.reserve(host, rate_limit.REQUESTS, 1):
+        await asyncio.sleep(seconds)
+
+
+async def async_http_stream_download(
+    session: aiohttp.ClientSession,
+    url: str,
+    partial: Path,
+    metadata: Optional[DownloadMetadata],
+) -> Optional[Tuple[str, str]]:
+    """Same as http_stream_download, the downloads are not segmented"""
+
+    resume_headers = get_resume_headers(url, partial)
+    conditional_headers = {} if resume_headers else get_conditional_headers(metadata)
+
+    await async_wait_request(get_host(url))
+    async with session.get(
+        url,
+        ssl=False,
+        headers={**DOWNLOAD_HEADERS, **resume_headers, **conditional_headers},
+        timeout=aiohttp.ClientTimeout(sock_connect=120, sock_read=120),
+    ) as r:
+
+        if conditional_headers and r.status == 304 and metadata is not None:
+            log.info("{} not modified", url)
+            metadata["not_modified"] = True
+            return None
+
+        if metadata is not None:
+            metadata["not_modified"] = False
+            save_metadata(metadata, r.headers)
+
+        resumed = is_resumed(partial, r.status, r.headers)
+
+        if resume_headers and not resumed and r.status != 200:
+            raise RestartDownload(
+                f"Can't resume the download of {url} (status: {r.status})"
+            )
+
+        if r.status != 200 and not resumed:  # pragma: no cover
+            log.error("Invalid response from {}: {}", url, r.status)
+
+            return ErrorCodes.INVALID_RESPONSE
+
+        resumable = True
+        if resumed:
+            log.info(
+                "Resuming download of {} from byte {}", url, partial.stat().st_size
+            )
+        else:
+            resumable = save_resume_info(url, partial, r.headers) is not None
+
+        throttle = rate_limit.Throttle(get_host(url))
+        offset = partial.stat().st_size if resumed else 0
+        size = get_expected_size(r.status, r.headers, offset)
+        with StreamWriter(
+            partial, resume=resumed, size=size, preallocate=not resumable
+        ) as writer:
+            async for chunk in r.content.iter_chunked(get_buffer_size()):
+                writer.write(chunk)
+                if seconds := throttle.consume(len(chunk)):
+                    await asyncio.sleep(seconds)
+
+    writer.verify()
+    writer.save_checksums(metadata)
     return None
 
 
-def count_files(z: Path) -> int:
+async def async_http_archive_download(
+    session: aiohttp.ClientSession,
+    url: str,
+    name: str,
+    archive: zip_writer.ChunkedZipWriter,
+    metadata: Optional[DownloadMetadata],
+) -> Optional[Tuple[str, str]]:
+
+    conditional_headers = get_conditional_headers(metadata)
+
+    await async_wait_request(get_host(url))
+    async with session.get(
+        url,
+        ssl=False,
+        headers={**DOWNLOAD_HEADERS, **conditional_headers},
+        timeout=aiohttp.ClientTimeout(sock_connect=120, sock_read=120),
+    ) as r:
+
+        if conditional_headers and r.status == 304 and metadata is not None:
+            log.info("{} not modified", url)
+            metadata["not_modified"] = True
+            return None
+
+        if metadata is not None:
+            metadata["not_modified"] = False
+            save_metadata(metadata, r.headers)
+
+        if r.status != 200:  # pragma: no cover
+            log.error("Invalid response from {}: {}", url, r.status)
+
+            return ErrorCodes.INVALID_RESPONSE
+
+        throttle = rate_limit.Throttle(get_host(url))
+        size = get_expected_size(r.status, r.headers, 0)
+        with ArchiveWriter(archive, name, size=size) as writer:
+            async for chunk in r.content.iter_chunked(get_buffer_size()):
+                writer.write(chunk)
+                if seconds := throttle.consume(len(chunk)):
+                    await asyncio.sleep(seconds)
+
+    writer.verify()
+    writer.save_checksums(metadata)
+    return None
+
+
+async def async_http_download(
+    session: aiohttp.ClientSession,
+    url: str,
+    out_path: Path,
+    metadata: Optional[DownloadMetadata] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+    restarted: bool = False,
+) -> Optional[Tuple[str, str]]:
+    """Same as http_download, with the transfers of an aiohttp session"""
+
+    partial = get_partial_path(out_path)
+    restart = False
+
     try:
-        with zipfile.ZipFile(z, "r") as myzip:
-            return len(myzip.infolist())
-    except zipfile.BadZipFile:  # pragma: no cover
-        return 0
+        if archive is not None:
+            return await async_http_archive_download(
+                session, url, out_path.name, archive, metadata
+            )
+
+        if error := await async_http_stream_download(session, url, partial, metadata):
+            return error
+        if metadata and metadata.get("not_modified"):
+            return None
+
+    except RestartDownload as e:
+        log.warning("{}, restarting", e)
+        restart = True
+    except aiohttp.InvalidURL as e:
+        log.error(e)
+        return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+    except aiohttp.ClientConnectionError as e:
+        log.error(e)
+        host_health.record_failure(get_host(url), str(e))
+        return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+    except asyncio.TimeoutError:
+        log.error("Download of {} timed out", url)
+        host_health.record_failure(get_host(url), "timeout")
+        return ErrorCodes.DOWNLOAD_TIMEOUT
+    except Exception as e:
+        log.error(e)
+        return ErrorCodes.UNEXPECTED_ERROR
+
+    if restart:
+        discard_partial(partial)
+        # e.g. a file changing during each download, retried by the next attempt
+        if restarted:
+            log.error("{} restarted twice, giving up", url)
+            return ErrorCodes.UNEXPECTED_ERROR
+        return await async_http_download(
+            session, url, out_path, metadata, restarted=True
+        )
+
+    complete_partial(partial, out_path)
+    return None
+
+
+# Errors of a connection that is no longer usable
+ASYNC_FTP_ERRORS = (aioftp.AIOFTPException, OSError, asyncio.TimeoutError)
+
+
+class AsyncFTPPool:
+    """
+    Same as FTPPool, for the aioftp clients of a run of the asyncio backend.
+    The clients are bound to the event loop of the run, so that a pool is
+    created by each run and closed at its end
+    """
+
+    def __init__(self) -> None:
+        self.idle: Dict[Tuple[str, int, str], List[Tuple[aioftp.Client, float]]] = {}
+        self.logins = 0
+        self.reused = 0
+
+    async def acquire(
+        self, host: str, port: int, user: str, passwd: str
+    ) -> aioftp.Client:
+
+        key = (host, port, user)
+        FTP_IDLE_TIMEOUT = Env.get_int("FTP_IDLE_TIMEOUT", 60)
+
+        while connections := self.idle.get(key):
+            client, last_used = connections.pop()
+
+            if time.monotonic() - last_used > FTP_IDLE_TIMEOUT:
+                client.close()
+                continue
+
+            # Keepalive to verify that the connection is still usable,
+            # otherwise it is discarded and a new connection is tried
+            try:
+                await client.command("NOOP", "2xx")
+            except ASYNC_FTP_ERRORS as e:
+                log.info("Discarding FTP connection to {}: {}", host, e)
+                client.close()
+                continue
+
+            self.reused += 1
+            return client
+
+        client = aioftp.Client(socket_timeout=120, connection_timeout=120)
+        try:
+            await client.connect(host, port)
+            # anonymous login if no credentials are provided in the url
+            await client.login(user or "anonymous", passwd or "anonymous@")
+        except BaseException:
+            client.close()
+            raise
+
+        self.logins += 1
+        return client
+
+    async def release(
+        self, client: aioftp.Client, host: str, port: int, user: str
+    ) -> None:
+
+        FTP_POOL_MAXSIZE = Env.get_int("FTP_POOL_MAXSIZE", 4)
+
+        connections = self.idle.setdefault((host, port, user), [])
+        if len(connections) < FTP_POOL_MAXSIZE:
+            connections.append((client, time.monotonic()))
+            return
+
+        await self.close(client)
+
+    @staticmethod
+    async def close(client: aioftp.Client) -> None:
+        try:
+            await client.quit()
+        except ASYNC_FTP_ERRORS:
+            client.close()
+
+    async def close_all(self) -> None:
+
+        connections = [client for idle in self.idle.values() for client, _ in idle]
+        self.idle.clear()
+
+        for client in connections:
+            await self.close(client)
+
+        if self.logins or self.reused:
+            log.info(
+                "FTP pool: {} login(s), {} connection(s) reused",
+                self.logins,
+                self.reused,
+            )
+
+
+async def async_get_ftp_validator(client: aioftp.Client, path: str) -> Optional[str]:
+    """Same as get_ftp_validator"""
+
+    try:
+        await client.command("TYPE I", "200")
+        _, info = await client.command(f"SIZE {path}", "213")
+    except aioftp.StatusCodeError:
+        return None
+
+    size = info[-1].strip()
+    if not size.isdigit():  # pragma: no cover
+        return None
+
+    try:
+        _, info = await client.command(f"MDTM {path}", "213")
+        mdtm = info[-1].split()[-1]
+    except aioftp.StatusCodeError:
+        mdtm = ""
+
+    return f"{size}:{mdtm}"
+
+
+async def async_ftp_transfer(
+    client: aioftp.Client,
+    url: str,
+    path: str,
+    writer: StreamWriter,
+    offset: int = 0,
+) -> None:
+
+    throttle = rate_limit.Throttle(get_host(url))
+    await async_wait_request(get_host(url))
+    # REST command is sent before RETR when offset is provided
+    async with client.download_stream(path, offset=offset) as stream:
+        async for block in stream.iter_by_block(get_buffer_size()):
+            writer.write(block)
+            if seconds := throttle.consume(len(block)):
+                await asyncio.sleep(seconds)
+
+
+async def async_ftp_retrieve(
+    client: aioftp.Client,
+    url: str,
+    path: str,
+    partial: Path,
+    metadata: Optional[DownloadMetadata] = None,
+) -> None:
+
+    validator = await async_get_ftp_validator(client, path)
+    offset = get_ftp_offset(url, partial, validator)
+    size = int(validator.split(":")[0]) if validator else None
+
+    if offset and offset == size:
+        log.info("Download of {} already completed", url)
+        return
+
+    if offset:
+        log.info("Resuming download of {} from byte {}", url, offset)
+
+    try:
+        with StreamWriter(partial, resume=offset > 0, size=size) as writer:
+            await async_ftp_transfer(client, url, path, writer, offset)
+    except aioftp.StatusCodeError as e:
+        if not offset:
+            raise
+        log.warning("Can't resume the download of {} ({}), restarting", url, e)
+        with StreamWriter(partial, size=size) as writer:
+            await async_ftp_transfer(client, url, path, writer)
+
+    writer.verify()
+    writer.save_checksums(metadata)
+
+
+async def async_ftp_archive_retrieve(
+    client: aioftp.Client,
+    url: str,
+    path: str,
+    name: str,
+    archive: zip_writer.ChunkedZipWriter,
+    metadata: Optional[DownloadMetadata] = None,
+) -> None:
+
+    validator = await async_get_ftp_validator(client, path)
+    size = int(validator.split(":")[0]) if validator else None
+
+    with ArchiveWriter(archive, name, size=size) as writer:
+        await async_ftp_transfer(client, url, path, writer)
+
+    writer.verify()
+    writer.save_checksums(metadata)
+
+
+async def async_ftp_download(
+    pool: AsyncFTPPool,
+    url: str,
+    out_path: Path,
+    metadata: Optional[DownloadMetadata] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> Optional[Tuple[str, str]]:
+    """Same as ftp_download, with the aioftp clients of pool"""
+
+    partial = get_partial_path(out_path)
+
+    try:
+        parsed = urlparse(url)
+        host = parsed.hostname or ""
+        port = parsed.port or ftplib.FTP_PORT
+        user = unquote(parsed.username or "")
+        passwd = unquote(parsed.password or "")
+        path = unquote(parsed.path)
+
+        client = await pool.acquire(host, port, user, passwd)
+        try:
+            if archive is not None:
+                await async_ftp_archive_retrieve(
+                    client, url, path, out_path.name, archive, metadata
+                )
+            else:
+                await async_ftp_retrieve(client, url, path, partial, metadata)
+        except aioftp.StatusCodeError:
+            # The command failed but the connection is still usable
+            await pool.release(client, host, port, user)
+            raise
+        except BaseException:
+            client.close()
+            raise
+
+        await pool.release(client, host, port, user)
+
+    except socket.gaierror as e:
+        log.error(e)
+        host_health.record_failure(get_host(url), str(e))
+        return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+    except aioftp.StatusCodeError as e:
+        log.error(e)
+        return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+    except asyncio.TimeoutError:
+        log.error("Download of {} timed out", url)
+        host_health.record_failure(get_host(url), "timeout")
+        return ErrorCodes.DOWNLOAD_TIMEOUT
+    except ConnectionError as e:
+        log.error(e)
+        host_health.record_failure(get_host(url), str(e))
+        return ErrorCodes.UNEXPECTED_ERROR
+    except Exception as e:
+        log.error(e)
+        return ErrorCodes.UNEXPECTED_ERROR
+
+    if archive is None:
+        complete_partial(partial, out_path)
+    return None
 
 
 def make_zip_archives(
     path: Path, zip_file: Path, datadir: Path
 ) -> Tuple[Path, List[Path]]:
+    """
+    Archive the datafiles in zip chunks of up to MAX_ZIP_SIZE, written in
+    a single pass following the layout planned by zip_planner, compressing
+    the datafiles with ZIP_WORKERS threads.
+    Oversize files are archived in dedicated chunks.
+    Returns the whole zip path and the chunks (empty if not split)
+    """
 
     MAX_ZIP_SIZE = Env.get_int("MAX_ZIP_SIZE")
+    # threads compressing the datafiles
+    ZIP_WORKERS = max(1, Env.get_int("ZIP_WORKERS", 1))
 
-    oversize_cache = datadir.parent.joinpath("cache_oversize")
     # Move any over-size file in the oversize cache
-    for f in datadir.glob("*"):
-        if f.stat().st_size > MAX_ZIP_SIZE:
-            if not oversize_cache.exists():
-                oversize_cache.mkdir()
-            log.warning("Too large file found: {}, moving to oversize cache", f)
-            f.rename(oversize_cache.joinpath(f.name))
-
-    # Delete the split folder if already exists and create it,
+    oversize_cache = archives.move_oversize_files(datadir, MAX_ZIP_SIZE)
+
+    datafiles = {f.name: f for f in datadir.iterdir() if f.is_file()}
+    if oversize_cache.exists():
+        datafiles.update((f.name, f) for f in oversize_cache.iterdir() if f.is_file())
+
+    # Datafiles with the same content are archived once
+    duplicates = archives.find_duplicates(
+        datafiles, archives.get_checksums(path), MAX_ZIP_SIZE
+    )
+    if duplicates:
+        log.info(
+            "{}: {} duplicated datafile(s), {} bytes not archived",
+            path,
+            len(duplicates),
+            sum(datafiles[name].stat().st_size for name in duplicates),
+        )
+    for name in duplicates:
+        datafiles.pop(name)
+
+    sizes = {name: f.stat().st_size for name, f in datafiles.items()}
+    compression = {
+        name: zip_planner.get_compression(f)
+        for name, f in datafiles.items()
+        # oversize zip files are written as they are
+        if sizes[name] <= MAX_ZIP_SIZE or not name.endswith(".zip")
+    }
+    estimates = {name: estimate for name, (_, estimate) in compression.items()}
+    stored = {
+        datafiles[name]
+        for name, (compress_type, _) in compression.items()
+        if compress_type == zipfile.ZIP_STORED
+    }
+    layout = zip_planner.plan(sizes, MAX_ZIP_SIZE, estimates)
+    log.info(
+        "{}: {} of {} datafile(s) stored without compression",
+        path,
+        len(stored),
+        len(datafiles),
+    )
+
+    # Delete the split folder if already exists,
     # This way the split will always start from a clean environment
     split_path = path.joinpath("zip_split")
-
     if split_path.exists():
         shutil.rmtree(split_path)
-    split_path.mkdir()
-
-    shutil.make_archive(base_name=str(zip_file), format="zip", root_dir=datadir)
 
     z = zip_file.with_suffix(".zip")
+    writer = zip_writer.ChunkedZipWriter(
+        split_path, MAX_ZIP_SIZE, zip_planner.get_level()
+    )
+    try:
+        planned: List[Tuple[zip_planner.PlannedChunk, Path]] = []
+        # files not fitting in the planned chunk (due to underestimated sizes)
+        # are spilled and added afterwards
+        files: List[Tuple[Path, zip_writer.Chunk]] = []
+        for c in layout:
+            if not c["oversize"]:
+                chunk = writer.new_chunk()
+                planned.append((c, chunk.path))
+                files.extend((datafiles[name], chunk) for name in c["files"])
+        spilled = writer.add_files(files, ZIP_WORKERS, stored)
+
+        # Spilled files are added to any chunk with enough space
+        for f in spilled:
+            compress_type = compression[f.name][0]
+            writer.add_file(f, compress_type=compress_type)
+
+        # Oversize files are archived last, as the last chunks
+        split = Env.get_bool("ZIP_SPLIT_OVERSIZE")
+        for c in (c for c in layout if c["oversize"]):
+            f = datafiles[c["files"][0]]
+            if split:
+                # oversize zip files are not probed, they are compressed
+                compress_type, _ = compression.get(f.name, (zipfile.ZIP_STORED, 0))
+                parts = writer.add_parts(f, compress_type)
+                log.info("{}: {} split in {} parts", path, f.name, parts)
+            elif f.name.endswith(".zip"):
+                # written as it is
+                writer.add_raw(f)
+            else:
+                writer.add_files([(f, writer.new_chunk())], ZIP_WORKERS, stored)
+
+        chunks = writer.close()
+
+        reports = [zip_planner.get_report(c, p) for c, p in planned]
+        zip_planner.log_report(path, reports, chunks)
+        log.info("{}: {} bytes copied for oversize zip files", path, writer.copied)
+
+        archives.add_duplicates(chunks, duplicates)
+        with generations.stage(path) as outputs:
+            # Outputs of previous builds are replaced, with their index
+            archives.save(path, None)
+            published = archives.publish(path, chunks)
+            if not chunks:
+                # an empty archive is still published
+                zipfile.ZipFile(outputs.joinpath(z.name), "w").close()
+                return z, []
+    finally:
+        shutil.rmtree(split_path, ignore_errors=True)
+
+    log.info(
+        "{}: {} zip chunk(s) created (maxsize {})", path, len(chunks), MAX_ZIP_SIZE
+    )
+
+    if len(published) == 1:
+        return z, []
+    return z, published
 
-    size = z.stat().st_size
 
-    zip_chunks: List[Path] = []
-    if size > MAX_ZIP_SIZE:
+def add_checksum_manifests(path: Path) -> None:
+    """
+    Add to each output zip the checksums of its own datafiles, so that the
+    chunks not modified by a merge keep up to date manifests and are not
+    rewritten
+    """
 
-        log.warning(
-            "{}: zip too large, splitting {} (size {}, maxsize {})",
-            path,
-            z,
-            size,
-            MAX_ZIP_SIZE,
+    entries = manifest.load(path)
+    with generations.stage(path) as outputs:
+        copied = sum(
+            add_checksum_manifest(path, z, entries)
+            for z in sorted(outputs.glob("output*.zip"))
         )
+    if copied:
+        log.info("{}: {} bytes copied to update the manifests", path, copied)
 
-        # Execute the split of the zip
-        split_params = [
-            "-n",
-            MAX_ZIP_SIZE,
-            "-b",
-            split_path,
-            z,
-        ]
-        try:
-            zipsplit = local["/usr/bin/zipsplit"]
-            zipsplit(split_params)
-
-            log.info("{}: split completed", path)
-
-            zip_chunks = list(split_path.glob("*.zip"))
-        # This can no longer happens because large entries are removed from the zip
-        # Added re-added after the split with a separated workflow
-        except ProcessExecutionError as e:  # pragma: no cover
-
-            if "Entry is larger than max split size" in e.stdout:
-                reg = r"Entry too big to split, read, or write \((.*)\)"
-                extra = None
-                if m := re.search(reg, e.stdout):
-                    extra = m.group(1)
-                # ErrorCodes.ZIP_SPLIT_ENTRY_TOO_LARGE
-                log.error("{}: entry is larger than max split size: {}", path, extra)
-            else:
-                # ErrorCodes.ZIP_SPLIT_ERROR
-                log.error("{}: {}", path, e.stdout)
-
-            return z, []
-
-    oversize_cache_list = list(oversize_cache.glob("*"))
-
-    # One or more over-size file have to added to the output
-    # They are not included in the normal zip & zipsplit workflow
-    # Because zipsplit would fail when the zip file contains a file larger then MAX_SIZE
-    if oversize_cache_list:
-
-        index = len(zip_chunks)
-
-        if index == 0:
-            # chunks are ZERO => zipsplit not executed and output.zip
-            # is to be considered as chunk 1
-            # BUT only if it is not empty
-            if count_files(z) > 0:
-                chunk_path = split_path.joinpath("output1.zip")
-                z.rename(chunk_path)
-                zip_chunks.append(chunk_path)
-                index = 1
-
-        # for each NON ZIP file in oversize_cache_list:
-        #   1 - move it in cache_oversize/tmp
-        #   2 - zip cache_oversize/tmp -> zip_split/output{inde}.zip
-        #   3 - move back the file from cache_oversize/tmp to cache_oversize
-        # for each ZIP file in oversize_cache_list:
-        #   1 - copy the file from cache_oversize to zip_split/output{inde}.zip
-        for f in oversize_cache_list:
-            index += 1
-            chunk_path = split_path.joinpath(f"output{index}")
-
-            if f.name.endswith(".zip"):
-                log.warning("{} is a zip file, directly copying to zip_path", f)
-                shutil.copy(f, chunk_path.with_suffix(".zip"))
-            else:
-                # Can't safely go outside the loop because if the order does not contain
-                # any over size file then the oversize_cache folder does not exist
-                tmp_dir = oversize_cache.joinpath("tmp")
-                tmp_dir.mkdir(exist_ok=True)
-                # make_archive can't create an archive from file (only from a folder)
-                tmp_file = tmp_dir.joinpath(f.name)
-                f.rename(tmp_file)
-                shutil.make_archive(
-                    base_name=str(chunk_path), format="zip", root_dir=tmp_dir
-                )
-                # move back the file on the oversize_cache cache
-                tmp_file.rename(f)
 
-                shutil.rmtree(tmp_dir)
+def add_checksum_manifest(path: Path, z: Path, entries: manifest.Manifest) -> int:
+    """Returns the bytes copied to not modify the published chunk"""
 
-            zip_chunks.append(chunk_path.with_suffix(".zip"))
+    # Oversize zip files hardlinked as chunks are the cached datafiles
+    if archives.is_datafile(path, z):
+        log.info("{}: {} is linked to a datafile, no manifests added", path, z.name)
+        return 0
 
-    if zip_chunks:
+    with zipfile.ZipFile(z, "r") as zip_archive:
+        names = zip_archive.namelist()
+        current = {
+            filename: zip_archive.read(filename).decode()
+            for filename in names
+            if filename in manifest.CHECKSUM_FILES
+        }
+
+    # Split datafiles are listed in the chunk with the checksums of their parts
+    suffix = zip_writer.PARTS_SUFFIX
+    datafiles = set(names) | {n[: -len(suffix)] for n in names if n.endswith(suffix)}
+    checksum_files = {
+        filename: content
+        for filename, content in manifest.get_checksum_files(entries, datafiles).items()
+        if content
+    }
+
+    # Chunks with up to date manifests are not rewritten
+    if current == checksum_files:
+        return 0
 
-        log.info("{}: split completed, moving files", path)
-        # remove the whole zip to save space
-        # and move all split zips on the main folder
-        # Note that the whole zip may not exist in the case of small zip (so not split)
-        # and a too-large file. In this case the whole zip is moved as chunk1
-        if z.exists():
+    copied = generations.detach(z)
+    # Manifests added by previous executions are replaced
+    with zip_writer.open_append(z, replaced=manifest.CHECKSUM_FILES) as zip_archive:
+        for filename, content in checksum_files.items():
+            zip_archive.writestr(filename, content)
+    return copied
+
+
+def has_datafiles(z: Path) -> bool:
+    with zipfile.ZipFile(z, "r") as zip_archive:
+        return any(n not in manifest.CHECKSUM_FILES for n in zip_archive.namelist())
+
+
+def use_zip_streaming(path: Path, cache: Path, previous: manifest.Manifest) -> bool:
+    """
+    Orders created with ZIP_STREAMING enabled are always archived while
+    downloading, the others are always archived from the cache folder
+    """
+
+    if any(entry.get("archived") for entry in previous.values()):
+        return True
+
+    if not Env.get_bool("ZIP_STREAMING"):
+        return False
+
+    return not any(cache.iterdir()) and not archives.get_output_chunks(path)
+
+
+def publish_chunks(path: Path, chunks: List[Path], replaced: Set[str]) -> List[Path]:
+    """
+    Add the chunks written while downloading to the outputs of the order,
+    after removing the replaced datafiles from the previous outputs.
+    Outputs are named output.zip if single, output1.zip ... outputN.zip otherwise
+    """
+
+    outputs: List[Path] = []
+    for z in archives.get_output_chunks(path):
+        if replaced:
+            zip_writer.remove_entries(z, replaced)
+        if has_datafiles(z):
+            outputs.append(z)
+        else:
             z.unlink()
 
-        for f in zip_chunks:
-
-            p = f.absolute()
-            parent_dir = p.parents[1]
-            p.rename(parent_dir.joinpath(p.name))
-
-        log.warning("{}: oversize cache merged", path)
-
-    # Just a final check to verify how many chunks we have
-    # In case of a single too large file the current situation would be:
-    # output.zip empty because no normal files have been merged
-    # cache empty
-    # zip path empty
-    # oversize cache contains 1 file archived in output1.zip
-    # In this very specific case output1.zip has to be renamed into output.zip
-    output1 = path.joinpath("output1.zip")
-    output2 = path.joinpath("output2.zip")
-    # not that len(zip_chunks) == 1 is redundant, but added for a safer check
-    if output1.exists() and not output2.exists() and len(zip_chunks) == 1:
-        output1.rename(z)
-        return z, []
+    outputs.extend(chunks)
+    return archives.publish(path, outputs)
+
+
+def publish_archive(
+    path: Path,
+    archive: zip_writer.ChunkedZipWriter,
+    entries: manifest.Manifest,
+    replaced: Set[str],
+) -> None:
+
+    chunks = archive.close()
 
-    return z, zip_chunks
+    if chunks or replaced:
+        with locks.order_lock(path), generations.stage(path):
+            published = publish_chunks(path, chunks, replaced)
+            # Checksums are computed from the manifest
+            manifest.update(path, entries)
+            add_checksum_manifests(path)
+        log.info("{}: {} zip chunk(s) published", path, len(published))
+    else:
+        manifest.update(path, entries)
+
+    shutil.rmtree(archive.folder, ignore_errors=True)
+
+
+def download_file(
+    url: str,
+    out_path: Path,
+    metadata: Optional[DownloadMetadata] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> Optional[Tuple[str, str]]:
+
+    host = get_host(url)
+    if not host_health.allow(host):
+        log.warning("Circuit of {} is open, skipping {}", host, url)
+        return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+
+    if url.startswith("ftp://"):
+        error = ftp_download(url, out_path, metadata, archive)
+    else:
+        error = http_download(url, out_path, metadata, archive)
+
+    if not error:
+        host_health.record_success(host)
+    return error
+
+
+def get_cache_entry(metadata: DownloadMetadata) -> download_cache.CacheEntry:
+    entry: download_cache.CacheEntry = {}
+    if etag := metadata.get("etag"):
+        entry["etag"] = etag
+    if last_modified := metadata.get("last_modified"):
+        entry["last_modified"] = last_modified
+    if sha256 := metadata.get("sha256"):
+        entry["sha256"] = sha256
+    if md5 := metadata.get("md5"):
+        entry["md5"] = md5
+    return entry
+
+
+def get_validators(
+    entry: Union[manifest.ManifestEntry, download_cache.CacheEntry],
+) -> DownloadMetadata:
+    metadata: DownloadMetadata = {}
+    if etag := entry.get("etag"):
+        metadata["etag"] = etag
+    if last_modified := entry.get("last_modified"):
+        metadata["last_modified"] = last_modified
+    return metadata
+
+
+def get_cached_metadata(entry: download_cache.CacheEntry) -> DownloadMetadata:
+    metadata = get_validators(entry)
+    if sha256 := entry.get("sha256"):
+        metadata["sha256"] = sha256
+    if md5 := entry.get("md5"):
+        metadata["md5"] = md5
+    return metadata
+
+
+def fetch_datafile(
+    url: str, local_path: Path, metadata: DownloadMetadata
+) -> Optional[Tuple[str, str]]:
+    """
+    Download url into local_path, through the shared download cache if enabled.
+    Concurrent requests of the same url wait for the first transfer to complete.
+    metadata is filled with the validators and the checksums of the file
+    """
+
+    if not download_cache.is_enabled():
+        return download_file(url, local_path, metadata)
+
+    with download_cache.lock(url):
+        entry = download_cache.load(url)
+
+        if entry and download_cache.is_fresh(entry):
+            if download_cache.retrieve(url, local_path):
+                metadata.update(get_cached_metadata(entry))
+                return None
+
+        # A stale entry is revalidated with a conditional request
+        if entry:
+            metadata.update(get_validators(entry))
+
+        if error := download_file(url, local_path, metadata):
+            return error
+
+        if entry and metadata.get("not_modified"):
+            download_cache.refresh(url, entry)
+            if download_cache.retrieve(url, local_path):
+                metadata.update(get_cached_metadata(entry))
+                return None
+            return ErrorCodes.UNEXPECTED_ERROR  # pragma: no cover
+
+        # Empty files are reported as errors, they are not worth caching
+        if local_path.stat().st_size > 0:
+            download_cache.store(url, local_path, get_cache_entry(metadata))
+
+    return None
+
+
+class DownloadResult(TypedDict):
+    error: Optional[DownloadError]
+    # None in case of errors
+    entry: Optional[manifest.ManifestEntry]
+    # False if the datafile was already in the order and is unchanged
+    changed: bool
+
+
+def download_failed(download: DownloadType, error: Tuple[str, str]) -> DownloadResult:
+    return {
+        "error": {
+            "url": download["url"],
+            "order_line": download["order_line"],
+            "error_number": error[0],
+        },
+        "entry": None,
+        "changed": False,
+    }
+
+
+def download_completed(
+    download: DownloadType,
+    local_path: Path,
+    metadata: DownloadMetadata,
+    previous: Optional[manifest.ManifestEntry],
+    archived: bool = False,
+) -> DownloadResult:
+    """archived is True if the file was written in the zip chunks"""
+
+    if previous and metadata.get("not_modified"):
+        log.info("{} is unchanged", local_path)
+        return {
+            "error": None,
+            "entry": manifest.refresh(previous, download["order_line"]),
+            "changed": False,
+        }
+
+    # Verify the file size, if zero delete the file and report as error
+    # (empty entries are already discarded from the zip chunks)
+    if archived:
+        size = metadata.get("size", 0)
+    else:
+        size = local_path.stat().st_size
+        if size == 0:  # pragma: no cover
+            local_path.unlink()
+
+    if size == 0:  # pragma: no cover
+        return download_failed(download, ErrorCodes.EMPTY_FILE)
+
+    entry = manifest.make_entry(
+        download["url"],
+        download["order_line"],
+        local_path,
+        etag=metadata.get("etag"),
+        last_modified=metadata.get("last_modified"),
+        sha256=metadata.get("sha256"),
+        md5=metadata.get("md5"),
+        size=size,
+    )
+    if archived:
+        entry["archived"] = True
+    return {"error": None, "entry": entry, "changed": True}
+
+
+def download_datafile(
+    path: Path,
+    cache: Path,
+    download: DownloadType,
+    previous: Optional[manifest.ManifestEntry] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> DownloadResult:
+
+    download_url = download["url"]
+    filename = download["filename"]
+
+    log.debug("{} -> {}", download_url, filename)
+
+    try:
+
+        local_path = cache.joinpath(filename)
+
+        # Already downloaded by a previous request merged in this order
+        revalidate = False
+        if previous and manifest.is_available(path, download_url, previous):
+            if manifest.is_fresh(previous):
+                log.info("{}: {} already downloaded, skipping", path, filename)
+                # not revalidated, the freshness of the entry is not extended
+                return {
+                    "error": None,
+                    "entry": manifest.reuse(previous, download["order_line"]),
+                    "changed": False,
+                }
+            revalidate = True
+
+        # Transient errors are not retried here, the failed lines are
+        # rescheduled by make_order to not keep the worker busy while waiting
+        if revalidate and previous:
+            # conditional request, the file is not downloaded if unchanged
+            metadata = get_validators(previous)
+            error = download_file(download_url, local_path, metadata, archive)
+        elif archive is not None:
+            # the download cache is bypassed, it requires the downloaded files
+            metadata = {}
+            error = download_file(download_url, local_path, metadata, archive)
+        else:
+            metadata = {}
+            error = fetch_datafile(download_url, local_path, metadata)
+
+        if error:
+            return download_failed(download, error)
+
+        return download_completed(
+            download,
+            local_path,
+            metadata,
+            previous if revalidate else None,
+            archived=archive is not None,
+        )
+
+    except Exception as e:  # pragma: no cover
+        log.error("{}: {} ({})", path, e, type(e))
+        return download_failed(download, ErrorCodes.UNEXPECTED_ERROR)
+
+
+async def async_download_file(
+    session: aiohttp.ClientSession,
+    ftp: AsyncFTPPool,
+    url: str,
+    out_path: Path,
+    metadata: Optional[DownloadMetadata] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> Optional[Tuple[str, str]]:
+
+    host = get_host(url)
+    if not host_health.allow(host):
+        log.warning("Circuit of {} is open, skipping {}", host, url)
+        return ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+
+    if url.startswith("ftp://"):
+        error = await async_ftp_download(ftp, url, out_path, metadata, archive)
+    else:
+        error = await async_http_download(session, url, out_path, metadata, archive)
+
+    if not error:
+        host_health.record_success(host)
+    return error
+
+
+async def async_fetch_datafile(
+    session: aiohttp.ClientSession,
+    ftp: AsyncFTPPool,
+    url: str,
+    local_path: Path,
+    metadata: DownloadMetadata,
+) -> Optional[Tuple[str, str]]:
+    """
+    Same as fetch_datafile, but concurrent requests of the same url are not
+    coalesced: waiting for the cache lock would block the event loop
+    """
+
+    if not download_cache.is_enabled():
+        return await async_download_file(session, ftp, url, local_path, metadata)
+
+    entry = download_cache.load(url)
+
+    if entry and download_cache.is_fresh(entry):
+        if download_cache.retrieve(url, local_path):
+            metadata.update(get_cached_metadata(entry))
+            return None
+
+    # A stale entry is revalidated with a conditional request
+    if entry:
+        metadata.update(get_validators(entry))
+
+    if error := await async_download_file(session, ftp, url, local_path, metadata):
+        return error
+
+    if entry and metadata.get("not_modified"):
+        download_cache.refresh(url, entry)
+        if download_cache.retrieve(url, local_path):
+            metadata.update(get_cached_metadata(entry))
+            return None
+        return ErrorCodes.UNEXPECTED_ERROR  # pragma: no cover
+
+    # Empty files are reported as errors, they are not worth caching
+    if local_path.stat().st_size > 0:
+        download_cache.store(url, local_path, get_cache_entry(metadata))
+
+    return None
+
+
+async def async_download_datafile(
+    path: Path,
+    cache: Path,
+    download: DownloadType,
+    session: aiohttp.ClientSession,
+    ftp: AsyncFTPPool,
+    previous: Optional[manifest.ManifestEntry] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> DownloadResult:
+    """Same as download_datafile, executed by the asyncio backend"""
+
+    download_url = download["url"]
+    filename = download["filename"]
+
+    log.debug("{} -> {}", download_url, filename)
+
+    try:
+
+        local_path = cache.joinpath(filename)
+
+        # Already downloaded by a previous request merged in this order
+        revalidate = False
+        if previous and manifest.is_available(path, download_url, previous):
+            if manifest.is_fresh(previous):
+                log.info("{}: {} already downloaded, skipping", path, filename)
+                # not revalidated, the freshness of the entry is not extended
+                return {
+                    "error": None,
+                    "entry": manifest.reuse(previous, download["order_line"]),
+                    "changed": False,
+                }
+            revalidate = True
+
+        metadata: DownloadMetadata = {}
+        if revalidate and previous:
+            # conditional request, the file is not downloaded if unchanged
+            metadata = get_validators(previous)
+            error = await async_download_file(
+                session, ftp, download_url, local_path, metadata, archive
+            )
+        elif archive is not None:
+            # the download cache is bypassed, it requires the downloaded files
+            error = await async_download_file(
+                session, ftp, download_url, local_path, metadata, archive
+            )
+        else:
+            error = await async_fetch_datafile(
+                session, ftp, download_url, local_path, metadata
+            )
+
+        if error:
+            return download_failed(download, error)
+
+        return download_completed(
+            download,
+            local_path,
+            metadata,
+            previous if revalidate else None,
+            archived=archive is not None,
+        )
+
+    except Exception as e:  # pragma: no cover
+        log.error("{}: {} ({})", path, e, type(e))
+        return download_failed(download, ErrorCodes.UNEXPECTED_ERROR)
+
+
+async def async_download_datafiles(
+    path: Path,
+    cache: Path,
+    downloads: List[DownloadType],
+    previous: manifest.Manifest,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> List[DownloadResult]:
+    """
+    Same as download_datafiles, with the transfers executed as coroutines of
+    an event loop: up to DOWNLOAD_ASYNC_WORKERS transfers in parallel,
+    DOWNLOAD_WORKERS_PER_HOST on each host
+    """
+
+    DOWNLOAD_ASYNC_WORKERS = max(1, Env.get_int("DOWNLOAD_ASYNC_WORKERS", 100))
+
+    log.info(
+        "{}: downloading with the asyncio backend ({} transfers, max {} per host)",
+        path,
+        DOWNLOAD_ASYNC_WORKERS,
+        get_host_workers(),
+    )
+
+    semaphore = asyncio.Semaphore(DOWNLOAD_ASYNC_WORKERS)
+    host_semaphores: Dict[str, asyncio.Semaphore] = {}
+    # Lines writing the same file (and partial file) are downloaded one at
+    # a time, in order: the locks are fair and acquired in order-line order
+    targets: Dict[str, asyncio.Lock] = {}
+    for d in downloads:
+        host = get_host(d["url"])
+        if host not in host_semaphores:
+            host_semaphores[host] = asyncio.Semaphore(get_host_workers())
+        if d["filename"] not in targets:
+            targets[d["filename"]] = asyncio.Lock()
+
+    ftp = AsyncFTPPool()
+
+    async def download(
+        d: DownloadType, session: aiohttp.ClientSession
+    ) -> DownloadResult:
+        async with targets[d["filename"]]:
+            async with host_semaphores[get_host(d["url"])], semaphore:
+                return await async_download_datafile(
+                    path, cache, d, session, ftp, previous.get(d["filename"]), archive
+                )
+
+    # Limits are enforced by the semaphores, the connector only keeps
+    # the connections alive to be reused by the following lines on the same host
+    connector = aiohttp.TCPConnector(limit=0)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(*(download(d, session) for d in downloads))
+    finally:
+        await ftp.close_all()
+
+
+def download_datafiles(
+    path: Path,
+    cache: Path,
+    downloads: List[DownloadType],
+    previous: Optional[manifest.Manifest] = None,
+    archive: Optional[zip_writer.ChunkedZipWriter] = None,
+) -> List[DownloadResult]:
+    """
+    Download all the order lines into the cache folder
+    (or directly into the zip chunks, if archive is provided).
+    Returns the outcome of each line, in order-line order.
+    previous is the manifest of the datafiles already downloaded in this order
+    """
+
+    previous = previous or {}
+
+    # requests (threads) or asyncio
+    if Env.get("DOWNLOAD_BACKEND", "requests") == "asyncio":
+        return asyncio.run(
+            async_download_datafiles(path, cache, downloads, previous, archive)
+        )
+
+    DOWNLOAD_WORKERS = max(1, Env.get_int("DOWNLOAD_WORKERS", 1))
+
+    log.info(
+        "{}: downloading with {} workers (max {} per host)",
+        path,
+        DOWNLOAD_WORKERS,
+        get_host_workers(),
+    )
+
+    results: List[Optional[DownloadResult]] = [None] * len(downloads)
+
+    # Order lines waiting for a free slot, grouped by host
+    queues: Dict[str, Deque[int]] = {}
+    # and the lines not completed yet, by target file: lines writing the same
+    # file (and partial file) are downloaded one at a time, in order, so that
+    # the last one is kept as with a sequential download
+    targets: Dict[str, Deque[int]] = {}
+    for index, d in enumerate(downloads):
+        queues.setdefault(get_host(d["url"]), deque()).append(index)
+        targets.setdefault(d["filename"], deque()).append(index)
+
+    def is_next(index: int) -> bool:
+        return targets[downloads[index]["filename"]][0] == index
+
+    futures: Dict["Future[DownloadResult]", Tuple[int, str]] = {}
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        while queues or futures:
+
+            # Fill the free slots by looping on hosts, so that a single host
+            # can't take more than DOWNLOAD_WORKERS_PER_HOST slots
+            for host in list(queues.keys()):
+                queue = queues[host]
+                for index in [i for i in queue if is_next(i)]:
+                    if len(futures) >= DOWNLOAD_WORKERS or not host_slots.acquire(host):
+                        break
+                    queue.remove(index)
+                    d = downloads[index]
+                    future = executor.submit(
+                        download_datafile,
+                        path,
+                        cache,
+                        d,
+                        previous.get(d["filename"]),
+                        archive,
+                    )
+                    futures[future] = (index, host)
+
+                if not queue:
+                    del queues[host]
+
+            if not futures:  # pragma: no cover
+                # the slots are taken by other tasks of this worker process
+                time.sleep(1)
+                continue
+
+            done, _ = wait(futures.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                index, host = futures.pop(future)
+                host_slots.release(host)
+                targets[downloads[index]["filename"]].popleft()
+                results[index] = future.result()
+
+    return [r for r in results if r is not None]
+
+
+def is_transient(error: DownloadError) -> bool:
+    return error["error_number"] in (
+        ErrorCodes.DOWNLOAD_TIMEOUT[0],
+        ErrorCodes.UNEXPECTED_ERROR[0],
+    )
+
+
+def get_retry_countdown(attempt: int) -> int:
+    """Exponential backoff with full jitter, in seconds"""
+    return get_exponential_backoff_interval(
+        factor=Env.get_int("DOWNLOAD_RETRY_BACKOFF", 60),
+        retries=attempt - 1,
+        maximum=Env.get_int("DOWNLOAD_RETRY_BACKOFF_MAX", NETWORK_SLEEP),
+        full_jitter=True,
+    )
+
+
+class LineError(TypedDict):
+    # position of the line in the request
+    line: int
+    error: DownloadError
+
+
+class RetryState(TypedDict):
+    # execution of the request, starting from 1
+    attempt: int
+    # position in the request of each line rescheduled with this execution
+    lines: List[int]
+    # errors of the lines resolved by the previous executions
+    errors: List[LineError]
+    # files downloaded by the previous executions
+    downloaded: int
+    # build of the archives delayed by the previous execution
+    merge: Optional[merges.MergeState]
 
 
 @CeleryExt.task(idempotent=False)
 def make_order(
-    self: Task[[str, str, str, List[DownloadType], bool], ResponseType],
+    self: Task[
+        [str, str, str, List[DownloadType], bool, Optional[RetryState]],
+        ResponseType,
+    ],
     request_id: str,
     marine_id: str,
     order_number: str,
     downloads: List[DownloadType],
     debug: bool,
+    retry: Optional[RetryState] = None,
 ) -> ResponseType:
 
     path = DATA_PATH.joinpath(marine_id, order_number)
 
-    log.warning("{}: starting task with {} download(s)", path, len(downloads))
+    attempt = retry["attempt"] if retry else 1
+
+    log.warning(
+        "{}: starting task with {} download(s) (attempt {}/{})",
+        path,
+        len(downloads),
+        attempt,
+        NETWORK_RETRIES,
+    )
 
     # it is expected to be created by the endpoint
     if not path.exists():
@@ -308,7 +2316,6 @@ def make_order(
     zip_file = path.joinpath("output")
     cache = path.joinpath("cache")
     logs = path.joinpath("logs")
-    lock = path.joinpath("lock")
 
     cache.mkdir(exist_ok=True)
     logs.mkdir(exist_ok=True)
@@ -319,90 +2326,131 @@ def make_order(
         "errors": [],
     }
 
-    downloaded: int = 0
-    for d in downloads:
-        download_url = d["url"]
-        filename = d["filename"]
-        order_line = d["order_line"]
-
-        log.debug("{} -> {}", download_url, filename)
-
-        try:
-
-            local_path = cache.joinpath(filename)
-
-            for i in range(1, NETWORK_RETRIES + 1):
-                if download_url.startswith("ftp://"):
-                    error = ftp_download(download_url, local_path)  # pragma: no cover
-                else:
-                    error = http_download(download_url, local_path)
+    previous = manifest.load(path)
+    archive: Optional[zip_writer.ChunkedZipWriter] = None
+    if use_zip_streaming(path, cache, previous):
+        # Each execution writes its own chunks, published under the order lock
+        archive = zip_writer.ChunkedZipWriter(
+            path.joinpath("zip_stream", uuid.uuid4().hex),
+            Env.get_int("MAX_ZIP_SIZE"),
+            zip_planner.get_level(),
+        )
 
-                if (
-                    error == ErrorCodes.DOWNLOAD_TIMEOUT
-                    or error == ErrorCodes.UNEXPECTED_ERROR
-                ):  # pragma: no cover
-                    log.warning(
-                        "{} attempt {}/{}: {}", path, error[1], i, NETWORK_RETRIES
-                    )
-                    time.sleep(NETWORK_SLEEP)
-                    continue
+    downloaded: int = retry["downloaded"] if retry else 0
+    unchanged: int = 0
+    lines = retry["lines"] if retry else list(range(len(downloads)))
+    errors: List[LineError] = list(retry["errors"]) if retry else []
+    # lines failed with a transient error, to be retried later
+    pending: List[DownloadType] = []
+    pending_lines: List[int] = []
+    entries: manifest.Manifest = {}
+    # datafiles already in the order, downloaded again since changed
+    replaced: Set[str] = set()
+    results = download_datafiles(path, cache, downloads, previous, archive)
+    for line, d, result in zip(lines, downloads, results):
+        if error := result["error"]:
+            if is_transient(error) and attempt < NETWORK_RETRIES:
+                pending.append(d)
+                pending_lines.append(line)
+            else:
+                errors.append({"line": line, "error": error})
+            continue
 
-                break
+        if entry := result["entry"]:
+            entries[d["filename"]] = entry
 
-            if error:
-                response["errors"].append(
-                    {
-                        "url": download_url,
-                        "order_line": order_line,
-                        "error_number": error[0],
-                    }
-                )
-                continue
-
-            # Verify the file size, if zero delete the file and report as error
-            if local_path.stat().st_size == 0:  # pragma: no cover
-                local_path.unlink()
-                response["errors"].append(
-                    {
-                        "url": download_url,
-                        "order_line": order_line,
-                        "error_number": ErrorCodes.EMPTY_FILE[0],
-                    }
-                )
-                continue
+        if result["changed"]:
             downloaded += 1
+            if d["filename"] in previous:
+                replaced.add(d["filename"])
+        else:
+            unchanged += 1
+
+    if archive is not None:
+        # Streamed datafiles are not kept in the cache folder, they are
+        # published at each execution (also when some lines are rescheduled)
+        publish_archive(path, archive, entries, replaced)
+    else:
+        manifest.update(path, entries)
+
+    # Errors resolved by different executions are reported in order-line order
+    errors.sort(key=lambda e: e["line"])
+    response["errors"] = [e["error"] for e in errors]
+
+    log.warning("{}: downloaded {} file(s), {} unchanged", path, downloaded, unchanged)
+    log_http_pool_stats()
+    rate_limit.log_stats()
+    ftp_pool.close_all()
+
+    if pending:
+        # The failed lines are rescheduled instead of waiting here, so that
+        # the worker is free to serve other orders in the meantime.
+        # The order is finalized by the execution resolving the last lines
+        countdown = get_retry_countdown(attempt)
+        log.warning(
+            "{}: {} download(s) failed, retrying in {} seconds",
+            path,
+            len(pending),
+            countdown,
+        )
+        state: RetryState = {
+            "attempt": attempt + 1,
+            "lines": pending_lines,
+            "errors": errors,
+            "downloaded": downloaded,
+            "merge": None,
+        }
+        self.apply_async(
+            args=[request_id, marine_id, order_number, pending, debug, state],
+            countdown=countdown,
+        )
+        return response
 
-        except Exception as e:  # pragma: no cover
-            log.error("{}: {} ({})", path, e, type(e))
-            response["errors"].append(
-                {
-                    "url": download_url,
-                    "order_line": order_line,
-                    "error_number": ErrorCodes.UNEXPECTED_ERROR[0],
-                }
+    # Skipped lines can also be waiting for the build, e.g. if an execution
+    # was interrupted after downloading them
+    if archive is None and (downloaded > 0 or archives.is_outdated(path, cache)):
+
+        # Concurrent merges of the order are archived by a single build,
+        # delayed by rescheduling the execution to free the worker meanwhile
+        delayed = retry["merge"] if retry else None
+        merge = delayed["merge"] if delayed else merges.register(path)
+        if (delayed := merges.debounce(path, merge, delayed)) is not None:
+            countdown = Env.get_int("ZIP_MERGE_DELAY", 5)
+            log.info("{}: archives build delayed by {} seconds", path, countdown)
+            self.apply_async(
+                args=[
+                    request_id,
+                    marine_id,
+                    order_number,
+                    [],
+                    debug,
+                    {
+                        "attempt": attempt,
+                        "lines": [],
+                        "errors": errors,
+                        "downloaded": downloaded,
+                        "merge": delayed,
+                    },
+                ],
+                countdown=countdown,
             )
-            continue
+            return response
 
-    log.warning("{}: downloaded {} file(s)", path, downloaded)
-
-    if downloaded > 0:
-
-        LOCK_SLEEP_TIME = Env.get_int("LOCK_SLEEP_TIME")
-        while lock.exists():  # pragma: no cover
-            log.warning("{}: found a lock ({}), waiting", path, lock)
-            time.sleep(LOCK_SLEEP_TIME)
-        lock.touch(exist_ok=False)
-
-        try:
-
-            whole_zip, zip_chunks = make_zip_archives(path, zip_file, cache)
-
-            lock.unlink()
-        # should never happens, but it is added to prevent problems with lock release
-        except Exception as e:  # pragma: no cover
-            log.error("{}: {}", path, e)
-            lock.unlink()
-            raise e
+        MAX_ZIP_SIZE = Env.get_int("MAX_ZIP_SIZE")
+        with locks.order_lock(path):
+            if merges.is_built(path, merge):
+                log.info("{}: merge {} already archived", path, merge)
+            else:
+                registered = merges.get_registered(path)
+                # Archives are published once updated, with their manifests
+                with generations.stage(path):
+                    # Merges only archive the new and changed datafiles
+                    if not archives.update(path, cache, MAX_ZIP_SIZE):
+                        make_zip_archives(path, zip_file, cache)
+                        archives.save(path, archives.build(path, cache))
+                    add_checksum_manifests(path)
+                merges.set_built(path, registered)
+        locks.log_stats()
 
     log.warning("{}: task completed", path)
 
@@ -0,0 +1,182 @@
+"""
+Manifest of the datafiles downloaded in an order.
+
+Used when a new request is merged into an existing order, to skip the lines
+already downloaded (or to revalidate them with a conditional request,
+once older than DOWNLOAD_MANIFEST_TTL) instead of downloading them again.
+"""
+
+import fcntl
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Collection, Dict, Optional, Tuple, TypedDict
+
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+
+class ManifestEntry(TypedDict, total=False):
+    url: str
+    order_line: str
+    filename: str
+    size: int
+    etag: str
+    last_modified: str
+    sha256: str
+    md5: str
+    # timestamp of the last download or revalidation
+    timestamp: float
+    # written directly in the zip chunks (ZIP_STREAMING), not in the cache folder
+    archived: bool
+
+
+Manifest = Dict[str, ManifestEntry]
+
+SHA256_FILE = "checksums.sha256"
+MD5_FILE = "checksums.md5"
+# added to each zip archive of the order, with the checksums of its datafiles
+CHECKSUM_FILES = (SHA256_FILE, MD5_FILE)
+
+
+def get_manifest_path(path: Path) -> Path:
+    return path.joinpath("manifest.json")
+
+
+def load(path: Path) -> Manifest:
+
+    manifest_path = get_manifest_path(path)
+    if not manifest_path.exists():
+        return {}
+
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest: Manifest = json.load(manifest_file)
+            return manifest
+    except Exception as e:  # pragma: no cover
+        log.warning("Invalid manifest {}: {}", manifest_path, e)
+        return {}
+
+
+def update(path: Path, entries: Manifest) -> None:
+    """Add or replace entries, other entries are preserved"""
+
+    if not entries:
+        return
+
+    # Merged requests of the same order can be executed concurrently
+    with open(path.joinpath(".manifest.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            manifest = load(path)
+            manifest.update(entries)
+
+            manifest_path = get_manifest_path(path)
+            tmp_path = manifest_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as manifest_file:
+                manifest_file.write(json.dumps(manifest))
+            tmp_path.replace(manifest_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def compute_checksums(file: Path) -> Tuple[str, str]:
+    """sha256 and md5 of file, only needed when not computed while downloading"""
+
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(file, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def make_entry(
+    url: str,
+    order_line: str,
+    file: Path,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+    sha256: Optional[str] = None,
+    md5: Optional[str] = None,
+    size: Optional[int] = None,
+) -> ManifestEntry:
+    """file is only read if checksums and size are not provided"""
+
+    if not sha256 or not md5:
+        sha256, md5 = compute_checksums(file)
+
+    entry: ManifestEntry = {
+        "url": url,
+        "order_line": order_line,
+        "filename": file.name,
+        "size": file.stat().st_size if size is None else size,
+        "sha256": sha256,
+        "md5": md5,
+        "timestamp": time.time(),
+    }
+    if etag:
+        entry["etag"] = etag
+    if last_modified:
+        entry["last_modified"] = last_modified
+    return entry
+
+
+def reuse(entry: ManifestEntry, order_line: str) -> ManifestEntry:
+    """Return a copy of the entry for the order line, not revalidated"""
+    reused = entry.copy()
+    reused["order_line"] = order_line
+    return reused
+
+
+def refresh(entry: ManifestEntry, order_line: str) -> ManifestEntry:
+    """Return a copy of the entry, marked as revalidated with the server"""
+    refreshed = reuse(entry, order_line)
+    refreshed["timestamp"] = time.time()
+    return refreshed
+
+
+def is_available(path: Path, url: str, entry: Optional[ManifestEntry]) -> bool:
+    """Verify if the datafile described by the entry is still in the order"""
+
+    if not entry or entry.get("url") != url:
+        return False
+
+    # The manifest is updated once the zip chunks are published
+    if entry.get("archived"):
+        return True
+
+    filename = entry.get("filename", "")
+    # Oversize files are moved out of the cache by make_zip_archives
+    for folder in ("cache", "cache_oversize"):
+        f = path.joinpath(folder, filename)
+        if f.exists() and f.stat().st_size == entry.get("size"):
+            return True
+
+    return False
+
+
+def is_fresh(entry: ManifestEntry) -> bool:
+    DOWNLOAD_MANIFEST_TTL = Env.get_int("DOWNLOAD_MANIFEST_TTL", 3600)
+    return time.time() - entry.get("timestamp", 0) < DOWNLOAD_MANIFEST_TTL
+
+
+def get_checksum_files(entries: Manifest, names: Collection[str]) -> Dict[str, str]:
+    """
+    Checksums of the named datafiles, by filename of the checksum manifest
+    (in the format of sha256sum and md5sum, to be verified with -c)
+    """
+
+    sha256 = []
+    md5 = []
+    for filename in sorted(names):
+        if (entry := entries.get(filename)) is None:
+            continue
+        if "sha256" in entry:
+            sha256.append(f"{entry['sha256']}  {filename}\n")
+        if "md5" in entry:
+            md5.append(f"{entry['md5']}  {filename}\n")
+
+    return {SHA256_FILE: "".join(sha256), MD5_FILE: "".join(md5)}
@@ -0,0 +1,118 @@
+"""
+Coalescing of the concurrent merges of an order in a single archive build.
+
+Each execution registers its merge with an increasing number once its
+downloads are completed. The archives are built behind the order lock and
+cover all the merges registered when the build starts, so the executions
+whose merge has already been covered by a build complete without building
+the archives again. Builds are debounced by ZIP_MERGE_DELAY seconds before
+locking the order, delayed again while new merges are registered: the
+executions are rescheduled after each delay instead of waiting in the worker.
+If Redis is not available the archives are built by every execution.
+"""
+
+from pathlib import Path
+from typing import Optional, TypedDict
+
+from bluecloud.tasks.host_health import get_redis
+from redis.exceptions import RedisError
+from restapi.env import Env
+from restapi.exceptions import ServiceUnavailable
+from restapi.utilities.logs import log
+
+KEY_PREFIX = "bluecloud:merges:"
+REGISTERED = "registered"
+BUILT = "built"
+# the counters of an order are forgotten once idle for a week
+EXPIRATION = 7 * 86400
+# maximum number of debounce delays
+MAX_DELAYS = 6
+
+
+class MergeState(TypedDict):
+    # number of the merge of the execution
+    merge: int
+    # last merge registered when delaying the build
+    last: int
+    # delays of the build, including the current one
+    delays: int
+
+
+def get_key(path: Path) -> str:
+    return f"{KEY_PREFIX}{path}"
+
+
+def register(path: Path) -> Optional[int]:
+    """Register the merge of the completed downloads, returns its number"""
+
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hincrby(get_key(path), REGISTERED, 1)
+        pipe.expire(get_key(path), EXPIRATION)
+        merge, _ = pipe.execute()
+        return int(merge)
+    except (RedisError, ServiceUnavailable) as e:
+        log.error("{}: can't register the merge: {}", path, e)
+        return None
+
+
+def get_registered(path: Path) -> Optional[int]:
+    try:
+        registered = get_redis().hget(get_key(path), REGISTERED)
+    except (RedisError, ServiceUnavailable) as e:  # pragma: no cover
+        log.error("{}: can't read the merges: {}", path, e)
+        return None
+    return int(registered) if registered is not None else None
+
+
+def debounce(
+    path: Path, merge: Optional[int], delayed: Optional[MergeState]
+) -> Optional[MergeState]:
+    """
+    Delay the build until no merge is registered for a delay. Returns the state
+    of the build to be delayed again (None to build now), given the state of
+    the previous delay (None if not delayed yet)
+    """
+
+    ZIP_MERGE_DELAY = Env.get_int("ZIP_MERGE_DELAY", 5)
+    if merge is None or ZIP_MERGE_DELAY <= 0:
+        return None
+
+    if delayed is None:
+        return {"merge": merge, "last": merge, "delays": 1}
+
+    if delayed["delays"] >= MAX_DELAYS:
+        return None
+
+    registered = get_registered(path)
+    if registered is None or registered == delayed["last"]:
+        return None
+    log.info("{}: {} merge(s) registered, waiting", path, registered - delayed["last"])
+    return {"merge": merge, "last": registered, "delays": delayed["delays"] + 1}
+
+
+def is_built(path: Path, merge: Optional[int]) -> bool:
+    """True if the merge has been archived by a build of another execution"""
+
+    if merge is None:
+        return False
+    try:
+        built = get_redis().hget(get_key(path), BUILT)
+    except (RedisError, ServiceUnavailable) as e:  # pragma: no cover
+        log.error("{}: can't read the merges: {}", path, e)
+        return False
+    return built is not None and int(built) >= merge
+
+
+def set_built(path: Path, registered: Optional[int]) -> None:
+    """Record the merges covered by a completed build"""
+
+    if registered is None:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hset(get_key(path), BUILT, registered)
+        pipe.expire(get_key(path), EXPIRATION)
+        pipe.execute()
+    except (RedisError, ServiceUnavailable) as e:  # pragma: no cover
+        log.error("{}: can't record the build: {}", path, e)
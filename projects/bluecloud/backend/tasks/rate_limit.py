@@ -0,0 +1,157 @@
+"""
+Rate limits on the download hosts, shared by all the workers through Redis.
+
+DOWNLOAD_RATE_LIMITS configures the limits by host pattern (fnmatch syntax,
+the first matching pattern is used) as a JSON object, e.g.:
+{"*.example.org": {"requests": 2, "bytes": 10485760}}
+with the requests per second and the bytes per second allowed on each host.
+
+Limits are enforced with a token bucket for each host, holding up to one
+second of tokens. Tokens are reserved in advance, the caller waits for the
+returned time before using them.
+"""
+
+import json
+import threading
+import time
+from fnmatch import fnmatch
+from typing import Dict, Optional, Tuple
+
+from bluecloud.tasks.host_health import get_redis
+from redis.exceptions import RedisError
+from restapi.env import Env
+from restapi.exceptions import ServiceUnavailable
+from restapi.utilities.logs import log
+
+KEY_PREFIX = "bluecloud:buckets:"
+
+REQUESTS = "requests"
+BYTES = "bytes"
+
+# Executed atomically by Redis, on the Redis clock shared by all the workers.
+# Returns the seconds to wait before using the requested tokens
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local amount = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or rate
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(rate, tokens + math.max(0, now - timestamp) * rate) - amount
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], 60 + math.ceil(math.max(0, -tokens) / rate))
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+# allowed requests and bytes per second, by kind
+Limits = Dict[str, float]
+
+# Time spent waiting for the limiters by this worker process, by host
+waits: Dict[str, Tuple[int, float]] = {}
+waits_lock = threading.Lock()
+
+
+def get_limits(host: str) -> Optional[Limits]:
+
+    DOWNLOAD_RATE_LIMITS = Env.get("DOWNLOAD_RATE_LIMITS", "")
+    if not DOWNLOAD_RATE_LIMITS:
+        return None
+
+    try:
+        patterns: Dict[str, Limits] = json.loads(DOWNLOAD_RATE_LIMITS)
+    except ValueError as e:  # pragma: no cover
+        log.error("Invalid DOWNLOAD_RATE_LIMITS: {}", e)
+        return None
+
+    # the port is not considered
+    hostname = host.split(":")[0]
+    for pattern, limits in patterns.items():
+        if fnmatch(hostname, pattern):
+            return limits
+    return None
+
+
+def reserve(host: str, kind: str, amount: float) -> float:
+    """
+    Take amount tokens (requests or bytes) from the bucket of host.
+    Returns the seconds to wait before the tokens can be used
+    """
+
+    limits = get_limits(host)
+    rate = limits.get(kind) if limits else None
+    if not rate:
+        return 0
+
+    # The limiter is an optimization, downloads are not blocked if Redis fails
+    try:
+        r = get_redis()
+        wait = float(
+            r.eval(TOKEN_BUCKET, 1, f"{KEY_PREFIX}{kind}:{host}", rate, amount)
+        )
+    except (RedisError, ServiceUnavailable) as e:  # pragma: no cover
+        log.error("Can't verify the rate limits of {}: {}", host, e)
+        return 0
+
+    if wait > 0:
+        with waits_lock:
+            count, total = waits.get(host, (0, 0.0))
+            waits[host] = (count + 1, total + wait)
+
+    return wait
+
+
+def wait_request(host: str) -> None:
+    if seconds := reserve(host, REQUESTS, 1):
+        time.sleep(seconds)
+
+
+class Throttle:
+    """
+    Bandwidth limiter of a single transfer. Tokens are reserved in batches
+    of about 1/10 of the allowed bytes per second to limit the Redis calls
+    """
+
+    def __init__(self, host: str) -> None:
+        limits = get_limits(host)
+        self.host = host
+        self.rate = limits.get(BYTES, 0) if limits else 0
+        self.batch = max(65536, int(self.rate / 10))
+        # bytes already reserved and not yet transferred
+        self.reserved = 0
+
+    def consume(self, amount: int) -> float:
+        """Returns the seconds to wait after the transfer of amount bytes"""
+
+        if not self.rate:
+            return 0
+
+        self.reserved -= amount
+        if self.reserved >= 0:
+            return 0
+
+        tokens = max(self.batch, -self.reserved)
+        self.reserved += tokens
+        return reserve(self.host, BYTES, tokens)
+
+    def wait(self, amount: int) -> None:
+        if seconds := self.consume(amount):
+            time.sleep(seconds)
+
+
+def log_stats() -> None:
+    """Log and reset the time spent waiting for the limiters"""
+
+    with waits_lock:
+        for host, (count, total) in sorted(waits.items()):
+            log.info(
+                "Rate limits of {}: waited {:.1f} seconds ({} times)",
+                host,
+                total,
+                count,
+            )
+        waits.clear()
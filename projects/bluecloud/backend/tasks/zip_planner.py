@@ -0,0 +1,186 @@
+"""
+Layout of the datafiles in zip chunks of up to MAX_ZIP_SIZE.
+
+All the file sizes are known before archiving the cache folder, so the files
+are packed in as few chunks as possible with a best-fit-decreasing strategy
+(a variant of first-fit-decreasing, placing each file in the fullest chunk
+with enough space) on their estimated compressed sizes. Compressed sizes are
+estimated by compressing a few samples of each file. Files larger than
+MAX_ZIP_SIZE are placed in dedicated chunks, after the others.
+
+Files already compressed, by extension (ZIP_STORED_EXTENSIONS) or because
+their samples are not reduced below ZIP_STORED_THRESHOLD percent of their
+size, are stored without compression to not waste time deflating them.
+"""
+
+import bisect
+import zipfile
+import zlib
+from pathlib import Path
+from typing import List, Mapping, Optional, Tuple, TypedDict
+
+from bluecloud.tasks import zip_writer
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+SAMPLE_SIZE = 16384
+SAMPLES = 3
+
+STORED_EXTENSIONS = ".zip,.gz,.tgz,.bz2,.xz,.zst,.7z,.png,.jpg,.jpeg"
+
+
+class PlannedChunk(TypedDict):
+    files: List[str]
+    # predicted size of the completed chunk
+    size: int
+    oversize: bool
+
+
+class ChunkReport(TypedDict):
+    files: int
+    predicted: int
+    # 0 if the chunk has been merged in another chunk
+    actual: int
+
+
+def estimate_size(f: Path) -> int:
+    """Compressed size of f, estimated from a few samples"""
+
+    size = f.stat().st_size
+    if size <= SAMPLE_SIZE * SAMPLES:
+        offsets = [0]
+        length = size
+    else:
+        step = (size - SAMPLE_SIZE) // (SAMPLES - 1)
+        offsets = [i * step for i in range(SAMPLES)]
+        length = SAMPLE_SIZE
+
+    sampled = 0
+    compressed = 0
+    with open(f, "rb") as source:
+        for offset in offsets:
+            source.seek(offset)
+            data = source.read(length)
+            sampled += len(data)
+            # the fastest level overestimates the default one
+            compressed += len(zlib.compress(data, 1))
+
+    if not sampled:
+        return 0
+    # the expansion of incompressible data is included in the entry overhead
+    return min(size, size * compressed // sampled)
+
+
+def get_level() -> int:
+    """Deflate level of the compressed entries (ZIP_COMPRESSION_LEVEL)"""
+
+    return min(9, max(0, Env.get_int("ZIP_COMPRESSION_LEVEL", 6)))
+
+
+def is_compressed(name: str) -> bool:
+    """Files already compressed, by extension"""
+
+    extensions = Env.get("ZIP_STORED_EXTENSIONS", STORED_EXTENSIONS).split(",")
+    return name.lower().endswith(
+        tuple(e.strip().lower() for e in extensions if e.strip())
+    )
+
+
+def get_compression(f: Path) -> Tuple[int, int]:
+    """Compression type of f, with its estimated compressed size"""
+
+    size = f.stat().st_size
+    if is_compressed(f.name):
+        return zipfile.ZIP_STORED, size
+
+    estimate = estimate_size(f)
+    if estimate * 100 >= size * Env.get_int("ZIP_STORED_THRESHOLD", 95):
+        return zipfile.ZIP_STORED, size
+    return zipfile.ZIP_DEFLATED, estimate
+
+
+def plan(
+    sizes: Mapping[str, int],
+    max_size: int,
+    estimates: Optional[Mapping[str, int]] = None,
+) -> List[PlannedChunk]:
+    """
+    Pack the files in chunks of up to max_size, by estimated compressed size
+    (the file size if not estimated). Oversize files are placed last,
+    one for each chunk
+    """
+
+    def get_required(name: str) -> int:
+        size = estimates.get(name, sizes[name]) if estimates else sizes[name]
+        return zip_writer.get_entry_size(name, size)
+
+    chunks: List[PlannedChunk] = []
+    oversize: List[PlannedChunk] = []
+    # (free space, chunk index), sorted to find the fullest chunk that fits
+    free: List[Tuple[int, int]] = []
+
+    for name in sorted(sizes, key=lambda n: (-get_required(n), n)):
+        required = get_required(name)
+
+        if sizes[name] > max_size:
+            oversize.append(
+                {
+                    "files": [name],
+                    "size": zip_writer.END_OVERHEAD + required,
+                    "oversize": True,
+                }
+            )
+            continue
+
+        position = bisect.bisect_left(free, (required, -1))
+        if position < len(free):
+            space, i = free.pop(position)
+            chunks[i]["files"].append(name)
+            chunks[i]["size"] += required
+            bisect.insort(free, (space - required, i))
+            continue
+
+        chunks.append(
+            {
+                "files": [name],
+                "size": zip_writer.END_OVERHEAD + required,
+                "oversize": False,
+            }
+        )
+        space = max_size - chunks[-1]["size"]
+        bisect.insort(free, (space, len(chunks) - 1))
+
+    return chunks + oversize
+
+
+def log_report(path: Path, reports: List[ChunkReport], chunks: List[Path]) -> None:
+    """Compare the planned chunks with the written ones"""
+
+    for number, report in enumerate(reports, start=1):
+        log.debug(
+            "{}: planned chunk {} ({} files): predicted {}, actual {}",
+            path,
+            number,
+            report["files"],
+            report["predicted"],
+            report["actual"],
+        )
+
+    predicted = sum(r["predicted"] for r in reports)
+    actual = sum(z.stat().st_size for z in chunks)
+    log.info(
+        "{}: planned {} chunk(s) of {} bytes, written {} of {} (oversize included)",
+        path,
+        len(reports),
+        predicted,
+        len(chunks),
+        actual,
+    )
+
+
+def get_report(planned: PlannedChunk, z: Path) -> ChunkReport:
+    return {
+        "files": len(planned["files"]),
+        "predicted": planned["size"],
+        "actual": z.stat().st_size if z.exists() else 0,
+    }
@@ -0,0 +1,747 @@
+"""
+Zip chunks of up to MAX_ZIP_SIZE, written in a single pass.
+
+Used to archive the cache folder (make_zip_archives) and to stream the
+downloads directly into the entries of the chunks (ZIP_STREAMING mode),
+instead of saving them in the cache folder, so that each byte is written once.
+A chunk is written by a single transfer at a time: concurrent transfers use
+different chunks and a new chunk is started when an entry would exceed
+MAX_ZIP_SIZE. Once all the transfers are completed, the chunks filled only in
+part are merged by copying their compressed entries (without recompressing).
+Zip files larger than MAX_ZIP_SIZE are written as they are, as dedicated chunks
+(local oversize zip files are cloned or hardlinked, copied only if required).
+With ZIP_SPLIT_OVERSIZE, local oversize files are instead split in parts of up
+to MAX_ZIP_SIZE once compressed, each in a dedicated chunk, to be joined with
+cat once extracted. The sha256 of the parts are listed in the last chunk.
+"""
+
+import copy
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Collection, Deque, List, Optional, Tuple, Union
+
+from restapi.utilities.logs import log
+
+# Upper bound of the local and central headers of an entry (name excluded)
+ENTRY_OVERHEAD = 256
+# End of central directory records, zip64 included
+END_OVERHEAD = 128
+
+LOCAL_HEADER_SIZE = 30
+# files are compressed in blocks of BLOCK_SIZE, in parallel
+BLOCK_SIZE = 1024 * 1024
+DICT_SIZE = 32768
+MIN_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP64_EXTRA_TAG = 1
+# list of the parts of a split datafile, in the format of sha256sum
+PARTS_SUFFIX = ".parts.sha256"
+# ioctl cloning a file on copy-on-write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def get_entry_size(name: str, size: int) -> int:
+    """Upper bound of the space taken in a chunk by an entry of size bytes"""
+    # deflate can slightly expand incompressible data (5 bytes each stored block)
+    return size + size // 1000 + 2 * len(name.encode()) + ENTRY_OVERHEAD
+
+
+def reflink(source: Path, dest: Path) -> bool:
+    """Make dest a reflink of source, if supported by the filesystem"""
+
+    dest.unlink(missing_ok=True)
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    dest.unlink()
+    return False
+
+
+def clone_file(source: Path, dest: Path) -> int:
+    """Reflink source as dest, or copy it. Returns the copied bytes"""
+
+    if reflink(source, dest):
+        return 0
+    shutil.copyfile(source, dest)
+    return dest.stat().st_size
+
+
+def link_file(source: Path, dest: Path) -> int:
+    """
+    Make dest a reflink of source if supported by the filesystem, otherwise
+    a hardlink (dest shares source content, it must not be modified in place).
+    Falls back to a copy. Returns the copied bytes
+    """
+
+    if reflink(source, dest):
+        return 0
+
+    try:
+        os.link(source, dest)
+        return 0
+    except OSError:
+        pass
+
+    log.warning("Can't link {}, copying it", source)
+    shutil.copyfile(source, dest)
+    return dest.stat().st_size
+
+
+def get_part_name(name: str, number: int, width: int = 3) -> str:
+    return f"{name}.{number:0{width}d}"
+
+
+def get_split_name(names: Collection[str]) -> Optional[str]:
+    """Name of the datafile split in the named entries of a chunk, if any"""
+
+    for n in names:
+        if n.endswith(PARTS_SUFFIX):
+            return n[: -len(PARTS_SUFFIX)]
+        if m := re.match(r"(.+)\.[0-9]{3,}$", n):
+            return m.group(1)
+    return None
+
+
+def is_linked(z: Path) -> bool:
+    """z shares its content with another file (e.g. a cached datafile)"""
+    return z.stat().st_nlink > 1
+
+
+def strip_zip64(extra: bytes) -> bytes:
+    """Remove the zip64 extra field, added again by zipfile if needed"""
+
+    fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        tag, length = struct.unpack("<2H", extra[i : i + 4])
+        if tag != ZIP64_EXTRA_TAG:
+            fields.append(extra[i : i + 4 + length])
+        i += 4 + length
+    return b"".join(fields)
+
+
+def copy_entry(
+    source: zipfile.ZipFile, dest: zipfile.ZipFile, info: zipfile.ZipInfo
+) -> None:
+    """Append an entry of source to dest as is, without recompressing it"""
+
+    if source.fp is None or dest.fp is None:  # pragma: no cover
+        raise ValueError("Can't copy entries of closed zip files")
+
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack("<2H", header[26:30])
+    source.fp.seek(name_length + extra_length, os.SEEK_CUR)
+
+    copied = copy.copy(info)
+    # sizes and CRC are known, they are written in the local header
+    # instead of a data descriptor following the data
+    copied.flag_bits &= ~0x08
+    copied.extra = strip_zip64(info.extra)
+    copied.header_offset = dest.start_dir
+
+    dest.fp.seek(dest.start_dir)
+    dest.fp.write(copied.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        data = source.fp.read(min(remaining, 1024 * 1024))
+        if not data:  # pragma: no cover
+            raise zipfile.BadZipFile(f"Truncated entry {info.filename}")
+        dest.fp.write(data)
+        remaining -= len(data)
+
+    dest.start_dir = dest.fp.tell()
+    dest.filelist.append(copied)
+    dest.NameToInfo[copied.filename] = copied
+
+
+def remove_entries(z: Path, names: Collection[str]) -> bool:
+    """
+    Remove the named entries from z by copying the other entries in a new file.
+    Returns False if z does not contain any of the names
+    """
+
+    with zipfile.ZipFile(z, "r") as source:
+        infos = source.infolist()
+        if not any(info.filename in names for info in infos):
+            return False
+
+        tmp_path = z.with_name(f".{z.name}.tmp")
+        with zipfile.ZipFile(tmp_path, "w") as dest:
+            for info in infos:
+                if info.filename not in names:
+                    copy_entry(source, dest, info)
+
+    tmp_path.replace(z)
+    return True
+
+
+def open_append(z: Path, replaced: Collection[str] = ()) -> zipfile.ZipFile:
+    """
+    Open z to append new entries. The entries named in replaced are dropped:
+    the trailing ones are overwritten by the new entries (the removal is only
+    effective once a new entry is written), the others by rewriting z
+    """
+
+    zip_archive = zipfile.ZipFile(z, "a", compression=zipfile.ZIP_DEFLATED)
+
+    infos = sorted(zip_archive.filelist, key=lambda i: i.header_offset)
+    trailing: List[zipfile.ZipInfo] = []
+    while infos and infos[-1].filename in replaced:
+        trailing.append(infos.pop())
+
+    if any(info.filename in replaced for info in infos):
+        zip_archive.close()
+        remove_entries(z, replaced)
+        return zipfile.ZipFile(z, "a", compression=zipfile.ZIP_DEFLATED)
+
+    for info in trailing:
+        zip_archive.filelist.remove(info)
+        zip_archive.NameToInfo.pop(info.filename, None)
+        zip_archive.start_dir = min(zip_archive.start_dir, info.header_offset)
+
+    return zip_archive
+
+
+def get_info(
+    name: str,
+    mtime: Optional[float] = None,
+    compress_type: int = zipfile.ZIP_DEFLATED,
+    level: Optional[int] = None,
+) -> zipfile.ZipInfo:
+    date_time = time.localtime(mtime)[:6]
+    # timestamps before 1980 can't be represented
+    info = zipfile.ZipInfo(name, date_time=max(date_time, MIN_DATE_TIME))
+    info.compress_type = compress_type
+    # used by zipfile to create the compressor of the entry
+    info._compresslevel = level  # type: ignore[attr-defined]
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def compress_block(data: bytes, zdict: bytes, last: bool, level: int) -> bytes:
+    """
+    Raw deflate stream of a block of a file, to be concatenated to the
+    streams of the previous blocks (whose last 32KB are the dictionary)
+    """
+
+    if zdict:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # non-final blocks are flushed to a byte boundary
+    flush = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(data) + compressor.flush(flush)
+
+
+class Chunk:
+    def __init__(self, path: Path, number: int) -> None:
+        self.path = path
+        self.number = number
+        self.zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        # estimated size of the completed chunk
+        self.size = END_OVERHEAD
+        self.busy = False
+
+    def is_empty(self) -> bool:
+        return not self.zip.filelist
+
+    def fits(self, required: Optional[int], max_size: int) -> bool:
+        # Entries of unknown size (or larger than max_size) start a new chunk
+        if self.is_empty():
+            return True
+        return required is not None and self.size + required <= max_size
+
+
+class Entry:
+    """A datafile being written into a chunk, discarded in case of errors"""
+
+    def __init__(
+        self,
+        writer: "ChunkedZipWriter",
+        chunk: Chunk,
+        name: str,
+        size: Optional[int],
+        mtime: Optional[float] = None,
+        compress_type: int = zipfile.ZIP_DEFLATED,
+    ) -> None:
+        self.writer = writer
+        self.chunk = chunk
+        self.info = get_info(name, mtime, compress_type, writer.level)
+        self.offset = chunk.zip.start_dir
+        # zip64 extensions are only enabled for large (or unknown) sizes
+        if size is not None:
+            self.info.file_size = size
+        self.stream: IO[bytes] = chunk.zip.open(
+            self.info, "w", force_zip64=size is None
+        )
+
+    def write(self, data: bytes) -> None:
+        self.stream.write(data)
+
+    def close(self) -> None:
+        try:
+            self.stream.close()
+            self.chunk.size += get_entry_size(
+                self.info.filename, self.info.compress_size
+            )
+        except BaseException:
+            self.truncate()
+            raise
+        finally:
+            self.writer.release(self.chunk)
+
+    def discard(self) -> None:
+        try:
+            self.stream.close()
+        except Exception as e:  # pragma: no cover
+            log.debug("Discarding {}: {}", self.info.filename, e)
+        finally:
+            self.truncate()
+            self.writer.release(self.chunk)
+
+    def remove(self) -> None:
+        """Remove a closed entry, the last one of its chunk"""
+        self.truncate()
+        self.chunk.size -= get_entry_size(self.info.filename, self.info.compress_size)
+
+    def truncate(self) -> None:
+        # The entry is removed and the following entries will overwrite it
+        z = self.chunk.zip
+        if self.info in z.filelist:
+            z.filelist.remove(self.info)
+            z.NameToInfo.pop(self.info.filename, None)
+        z.start_dir = self.offset
+        if z.fp is not None:
+            z.fp.seek(self.offset)
+            z.fp.truncate()
+
+
+class CompressedEntry(Entry):
+    """
+    An entry written from the blocks of a file compressed in parallel
+    (or stored as they are). The local header is written again once the CRC
+    and the sizes are known
+    """
+
+    def __init__(
+        self,
+        writer: "ChunkedZipWriter",
+        chunk: Chunk,
+        name: str,
+        size: int,
+        mtime: Optional[float] = None,
+        compress_type: int = zipfile.ZIP_DEFLATED,
+    ) -> None:
+        self.writer = writer
+        self.chunk = chunk
+        self.info = get_info(name, mtime, compress_type)
+        self.info.file_size = size
+        self.info.CRC = 0
+        self.offset = chunk.zip.start_dir
+        self.info.header_offset = self.offset
+        # as decided by zipfile, the header size can't change once written
+        self.zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+        self.fp().seek(self.offset)
+        self.fp().write(self.info.FileHeader(self.zip64))
+
+    def fp(self) -> IO[bytes]:
+        if self.chunk.zip.fp is None:  # pragma: no cover
+            raise ValueError("Can't write entries of closed zip files")
+        return self.chunk.zip.fp
+
+    def write(self, data: bytes) -> None:
+        self.fp().write(data)
+        self.info.compress_size += len(data)
+
+    def close(self) -> None:
+        z = self.chunk.zip
+        try:
+            end = self.fp().tell()
+            self.fp().seek(self.offset)
+            self.fp().write(self.info.FileHeader(self.zip64))
+            self.fp().seek(end)
+            z.start_dir = end
+            z.filelist.append(self.info)
+            z.NameToInfo[self.info.filename] = self.info
+            self.chunk.size += get_entry_size(
+                self.info.filename, self.info.compress_size
+            )
+        except BaseException:
+            self.truncate()
+            raise
+        finally:
+            self.writer.release(self.chunk)
+
+    def discard(self) -> None:
+        try:
+            self.truncate()
+        finally:
+            self.writer.release(self.chunk)
+
+
+class RawEntry:
+    """
+    Oversize zip files are not archived, they are written as dedicated chunks
+    (as done by make_zip_archives, to not produce zips of zips).
+    Zip files of unknown size are archived once completed, if small enough
+    """
+
+    def __init__(
+        self, writer: "ChunkedZipWriter", name: str, path: Path, number: int
+    ) -> None:
+        self.writer = writer
+        self.name = name
+        self.path = path
+        self.number = number
+        self.file = open(path, "wb")
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+
+    def close(self) -> None:
+        self.file.close()
+        if self.path.stat().st_size <= self.writer.max_size:
+            self.writer.archive(self)
+
+    def discard(self) -> None:
+        self.file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class ChunkedZipWriter:
+    def __init__(self, folder: Path, max_size: int, level: Optional[int] = None):
+        self.folder = folder
+        self.max_size = max_size
+        # deflate level, zlib default if None
+        self.level = level
+        self.chunks: List[Chunk] = []
+        self.raw_chunks: List[RawEntry] = []
+        # dedicated to the parts of split files, never merged
+        self.part_chunks: List[Chunk] = []
+        # bytes copied to write the local oversize zip files as chunks
+        self.copied = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def get_chunk_path(self) -> Tuple[Path, int]:
+        self.count += 1
+        return self.folder.joinpath(f"chunk{self.count}.zip"), self.count
+
+    def open(
+        self,
+        name: str,
+        size: Optional[int] = None,
+        mtime: Optional[float] = None,
+        compress_type: int = zipfile.ZIP_DEFLATED,
+    ) -> Union[Entry, RawEntry]:
+        """
+        Start a new entry in a chunk not used by other transfers, with enough
+        space for size bytes. The entry has to be closed or discarded
+        """
+
+        if name.endswith(".zip") and (size is None or size > self.max_size):
+            with self.lock:
+                raw = RawEntry(self, name, *self.get_chunk_path())
+                self.raw_chunks.append(raw)
+            return raw
+
+        required = get_entry_size(name, size) if size is not None else None
+        with self.lock:
+            # The fullest chunk with enough space, to leave as few chunks as possible
+            candidates = [
+                c for c in self.chunks if not c.busy and c.fits(required, self.max_size)
+            ]
+            if candidates:
+                chunk = max(candidates, key=lambda c: c.size)
+            else:
+                chunk = Chunk(*self.get_chunk_path())
+                self.chunks.append(chunk)
+            chunk.busy = True
+
+        try:
+            return Entry(self, chunk, name, size, mtime, compress_type)
+        except BaseException:
+            self.release(chunk)
+            raise
+
+    def new_chunk(self) -> Chunk:
+        with self.lock:
+            chunk = Chunk(*self.get_chunk_path())
+            self.chunks.append(chunk)
+        return chunk
+
+    def add_file(
+        self,
+        f: Path,
+        name: Optional[str] = None,
+        compress_type: int = zipfile.ZIP_DEFLATED,
+    ) -> None:
+        """Archive a local file, with its modification time"""
+
+        stat = f.stat()
+        entry = self.open(name or f.name, stat.st_size, stat.st_mtime, compress_type)
+        try:
+            with open(f, "rb") as source:
+                while data := source.read(1024 * 1024):
+                    entry.write(data)
+        except BaseException:
+            entry.discard()
+            raise
+        entry.close()
+
+    def add_raw(self, f: Path, name: Optional[str] = None) -> None:
+        """Write a local oversize zip file as a dedicated chunk, without copying it"""
+
+        with self.lock:
+            raw = RawEntry(self, name or f.name, *self.get_chunk_path())
+            self.raw_chunks.append(raw)
+        raw.file.close()
+        copied = link_file(f, raw.path)
+        with self.lock:
+            self.copied += copied
+
+    def add_parts(self, f: Path, compress_type: int = zipfile.ZIP_DEFLATED) -> int:
+        """
+        Archive a local file split in parts, each in a dedicated chunk.
+        A part ends when another block could exceed max_size once compressed.
+        Returns the number of parts
+        """
+
+        level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+        stat = f.stat()
+        # upper bound of the number of parts, each at least half a chunk
+        width = max(3, len(str(stat.st_size * 2 // self.max_size + 1)))
+        line_size = 64 + 2 + len(get_part_name(f.name, 0, width).encode()) + 1
+        parts_name = f"{f.name}{PARTS_SUFFIX}"
+        # the list of the parts is added to the last chunk, reserved in all
+        budget = self.max_size - END_OVERHEAD - get_entry_size(parts_name, 0)
+        budget -= line_size * (stat.st_size * 2 // self.max_size + 1)
+        block_size = min(BLOCK_SIZE, budget // 16)
+
+        def get_bound(n: int) -> int:
+            # deflate can slightly expand incompressible data
+            return n + n // 1000 + 64
+
+        checksums: List[str] = []
+        chunk: Optional[Chunk] = None
+        with open(f, "rb") as source:
+            data = source.read(block_size)
+            remaining = stat.st_size
+            while data:
+                name = get_part_name(f.name, len(checksums) + 1, width)
+                with self.lock:
+                    chunk = Chunk(*self.get_chunk_path())
+                    self.part_chunks.append(chunk)
+                entry = CompressedEntry(
+                    self, chunk, name, remaining, stat.st_mtime, compress_type
+                )
+                sha256 = hashlib.sha256()
+                crc = 0
+                size = 0
+                zdict = b""
+                used = get_entry_size(name, 0)
+                try:
+                    while data:
+                        following = source.read(block_size)
+                        last = not following or (
+                            used + get_bound(len(data)) + get_bound(len(following))
+                            > budget
+                        )
+                        crc = zlib.crc32(data, crc)
+                        sha256.update(data)
+                        size += len(data)
+                        if compress_type == zipfile.ZIP_STORED:
+                            entry.write(data)
+                        else:
+                            entry.write(compress_block(data, zdict, last, level))
+                        used = get_entry_size(name, entry.info.compress_size)
+                        zdict = data[-DICT_SIZE:]
+                        data = following
+                        if last:
+                            break
+                except BaseException:
+                    entry.discard()
+                    raise
+                entry.info.CRC, entry.info.file_size = crc, size
+                entry.close()
+                remaining -= size
+                checksums.append(f"{sha256.hexdigest()}  {name}\n")
+
+        if chunk is not None:
+            chunk.zip.writestr(get_info(parts_name, stat.st_mtime), "".join(checksums))
+        return len(checksums)
+
+    def add_files(
+        self,
+        files: List[Tuple[Path, Chunk]],
+        workers: int,
+        stored: Collection[Path] = (),
+    ) -> List[Path]:
+        """
+        Archive local files in the given chunks, compressing blocks of the
+        files in parallel (zlib releases the GIL while compressing).
+        The stored files are archived without compression.
+        A file is only kept if it fits in its chunk once compressed.
+        Returns the files not kept
+        """
+
+        level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+
+        spilled: List[Path] = []
+        # compressed blocks, in order, with the file of the first block
+        # and the CRC and size of the file with the last block
+        blocks: Deque[
+            Tuple[
+                "Future[bytes]", Optional[Tuple[Path, Chunk]], Optional[Tuple[int, int]]
+            ]
+        ] = deque()
+        entry: Optional[CompressedEntry] = None
+        current: Optional[Path] = None
+
+        def write_block() -> None:
+            nonlocal entry, current
+            future, start, end = blocks.popleft()
+            if start:
+                current, chunk = start
+                stat = current.stat()
+                with self.lock:
+                    chunk.busy = True
+                entry = CompressedEntry(
+                    self,
+                    chunk,
+                    current.name,
+                    stat.st_size,
+                    stat.st_mtime,
+                    zipfile.ZIP_STORED if current in stored else zipfile.ZIP_DEFLATED,
+                )
+            if entry is None or current is None:  # pragma: no cover
+                raise ValueError("Compressed block without entry")
+
+            entry.write(future.result())
+            if end:
+                entry.info.CRC, entry.info.file_size = end
+                entry.close()
+                chunk = entry.chunk
+                if chunk.size > self.max_size and len(chunk.zip.filelist) > 1:
+                    entry.remove()
+                    spilled.append(current)
+                entry = None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for f, chunk in files:
+                    crc = 0
+                    size = 0
+                    zdict = b""
+                    start: Optional[Tuple[Path, Chunk]] = (f, chunk)
+                    with open(f, "rb") as source:
+                        data = source.read(BLOCK_SIZE)
+                        while True:
+                            following = source.read(BLOCK_SIZE) if data else b""
+                            last = not following
+                            crc = zlib.crc32(data, crc)
+                            size += len(data)
+                            future: "Future[bytes]"
+                            if f in stored:
+                                future = Future()
+                                future.set_result(data)
+                            else:
+                                future = executor.submit(
+                                    compress_block, data, zdict, last, level
+                                )
+                            blocks.append(
+                                (future, start, (crc, size) if last else None)
+                            )
+                            start = None
+                            zdict = data[-DICT_SIZE:]
+                            data = following
+                            # a few blocks are compressed ahead of the writes
+                            while len(blocks) >= 2 * workers:
+                                write_block()
+                            if last:
+                                break
+                while blocks:
+                    write_block()
+            except BaseException:
+                for future, _, _ in blocks:
+                    future.cancel()
+                if entry is not None:
+                    entry.discard()
+                raise
+
+        return spilled
+
+    def archive(self, raw: RawEntry) -> None:
+        """Move a completed zip file of small size into a chunk"""
+
+        with self.lock:
+            self.raw_chunks.remove(raw)
+
+        self.add_file(raw.path, raw.name)
+        raw.path.unlink()
+
+    def release(self, chunk: Chunk) -> None:
+        with self.lock:
+            chunk.busy = False
+
+    def close(self) -> List[Path]:
+        """
+        Complete the chunks, merging the ones filled in part.
+        Returns the paths of the non-empty chunks
+        """
+
+        chunks = [c for c in self.chunks if not c.is_empty()]
+        for c in self.chunks:
+            if c.is_empty():
+                c.zip.close()
+                c.path.unlink(missing_ok=True)
+        self.chunks = []
+
+        # The smallest chunk is merged in the fullest chunk with enough space.
+        # If it does not fit in any chunk, no other pair of chunks can be merged
+        chunks.sort(key=lambda c: c.size)
+        while len(chunks) > 1:
+            source = chunks[0]
+            targets = [c for c in chunks[1:] if c.size + source.size <= self.max_size]
+            if not targets:
+                break
+
+            target = max(targets, key=lambda c: c.size)
+            source.zip.close()
+            with zipfile.ZipFile(source.path, "r") as source_zip:
+                for info in source_zip.infolist():
+                    copy_entry(source_zip, target.zip, info)
+            source.path.unlink()
+            log.debug("Merged {} into {}", source.path.name, target.path.name)
+
+            target.size += source.size - END_OVERHEAD
+            chunks = sorted(chunks[1:], key=lambda c: c.size)
+
+        for c in chunks:
+            c.zip.close()
+        for c in self.part_chunks:
+            c.zip.close()
+
+        completed = [(c.number, c.path) for c in chunks + self.part_chunks]
+        self.part_chunks = []
+        completed.extend((r.number, r.path) for r in self.raw_chunks if r.path.exists())
+        self.raw_chunks = []
+
+        return [path for _, path in sorted(completed)]
@@ -0,0 +1,277 @@
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Dict
+
+from bluecloud.tasks import archives, generations, manifest, zip_writer
+from bluecloud.tasks.make_order import add_checksum_manifests, make_zip_archives
+from faker import Faker
+from restapi.env import Env
+from restapi.tests import BaseTests
+
+MAX_SIZE = 262144
+
+
+def create_file(file: Path, size: int) -> bytes:
+    content = os.urandom(size)
+    with open(file, "wb") as f:
+        f.write(content)
+    return content
+
+
+def verify_chunk(z: Path, files: Dict[str, bytes]) -> None:
+    with zipfile.ZipFile(z, "r") as myzip:
+        assert myzip.testzip() is None
+        assert sorted(myzip.namelist()) == sorted(files.keys())
+        for name, content in files.items():
+            assert myzip.read(name) == content
+
+
+class TestApp(BaseTests):
+    def test_incremental_update(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        files = {
+            name: create_file(cache.joinpath(name), 100000)
+            for name in (faker.pystr(), faker.pystr())
+        }
+
+        # Archives not indexed are built from scratch
+        assert archives.is_outdated(path, cache)
+        assert not archives.update(path, cache, MAX_SIZE)
+        make_zip_archives(path, path.joinpath("output"), cache)
+        archives.save(path, archives.build(path, cache))
+        assert not archives.is_outdated(path, cache)
+
+        whole_zip = path.joinpath("output.zip")
+        verify_chunk(whole_zip, files)
+        inode = whole_zip.stat().st_ino
+
+        # Nothing to archive
+        assert archives.update(path, cache, MAX_SIZE)
+        assert whole_zip.stat().st_ino == inode
+
+        # New datafiles not fitting in the last chunk are archived in a new chunk
+        new_file = faker.pystr()
+        new_content = create_file(cache.joinpath(new_file), 100000)
+        assert archives.is_outdated(path, cache)
+        assert archives.update(path, cache, MAX_SIZE)
+        assert not archives.is_outdated(path, cache)
+
+        assert not whole_zip.exists()
+        output1 = path.joinpath("output1.zip")
+        output2 = path.joinpath("output2.zip")
+        assert output1.stat().st_ino == inode
+        verify_chunk(output1, files)
+        verify_chunk(output2, {new_file: new_content})
+
+        # Changed datafiles are removed from their chunk and appended to the last
+        changed = next(iter(files))
+        files[changed] = create_file(cache.joinpath(changed), 1000)
+        assert archives.is_outdated(path, cache)
+        assert archives.update(path, cache, MAX_SIZE)
+
+        verify_chunk(output1, {n: c for n, c in files.items() if n != changed})
+        verify_chunk(output2, {new_file: new_content, changed: files[changed]})
+
+        # Oversize zip files are published as they are
+        oversize = f"{faker.pystr()}.zip"
+        with zipfile.ZipFile(cache.joinpath(oversize), "w") as myzip:
+            myzip.writestr(faker.pystr(), os.urandom(MAX_SIZE))
+        assert archives.update(path, cache, MAX_SIZE)
+
+        output3 = path.joinpath("output3.zip")
+        oversize_file = path.joinpath("cache_oversize", oversize)
+        assert output3.read_bytes() == oversize_file.read_bytes()
+        assert not archives.is_outdated(path, cache)
+
+        # The index matches the archives built from scratch
+        assert archives.load(path) == archives.build(path, cache)
+        assert len(archives.get_output_chunks(path)) == 3
+
+    def test_unchanged_downloads(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        files = {
+            name: create_file(cache.joinpath(name), 1000)
+            for name in (faker.pystr(), faker.pystr())
+        }
+        entries = {
+            name: manifest.make_entry(faker.url(), faker.pystr(), cache.joinpath(name))
+            for name in files
+        }
+        manifest.update(path, entries)
+
+        make_zip_archives(path, path.joinpath("output"), cache)
+        archives.save(path, archives.build(path, cache))
+        whole_zip = path.joinpath("output.zip")
+        size = whole_zip.stat().st_size
+
+        # Datafiles downloaded again with the same content are not archived
+        name, content = next(iter(files.items()))
+        cache.joinpath(name).unlink()
+        cache.joinpath(name).write_bytes(content)
+        os.utime(cache.joinpath(name), ns=(1, 1))
+        assert archives.update(path, cache, MAX_SIZE)
+        assert whole_zip.stat().st_size == size
+        index = archives.load(path)
+        assert index is not None
+        assert index[0]["files"][name]["mtime"] == 1
+        verify_chunk(whole_zip, files)
+
+        # Datafiles with a different content are archived again
+        files[name] = create_file(cache.joinpath(name), 1000)
+        manifest.update(
+            path,
+            {
+                name: manifest.make_entry(
+                    faker.url(), faker.pystr(), cache.joinpath(name)
+                )
+            },
+        )
+        assert archives.update(path, cache, MAX_SIZE)
+        verify_chunk(whole_zip, files)
+        assert archives.load(path) == archives.build(path, cache)
+
+    def test_checksum_manifests(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        def add_file(name: str) -> None:
+            create_file(cache.joinpath(name), 100000)
+            entries[name] = manifest.make_entry(
+                faker.url(), faker.pystr(), cache.joinpath(name)
+            )
+            manifest.update(path, {name: entries[name]})
+
+        def merge() -> None:
+            with generations.stage(path):
+                if not archives.update(path, cache, MAX_SIZE):
+                    make_zip_archives(path, path.joinpath("output"), cache)
+                    archives.save(path, archives.build(path, cache))
+                add_checksum_manifests(path)
+
+        def get_manifest(z: Path) -> str:
+            with zipfile.ZipFile(z, "r") as myzip:
+                return myzip.read(manifest.SHA256_FILE).decode()
+
+        entries: manifest.Manifest = {}
+        first = sorted([faker.pystr(), faker.pystr()])
+        for name in first:
+            add_file(name)
+        merge()
+
+        # Each chunk lists the checksums of its own datafiles
+        whole_zip = path.joinpath("output.zip")
+        first_manifest = "".join(f"{entries[n]['sha256']}  {n}\n" for n in first)
+        assert get_manifest(whole_zip) == first_manifest
+        inode = whole_zip.stat().st_ino
+
+        # A merge archiving a new datafile in a new chunk doesn't rewrite
+        # (nor copy) the other chunks to update their manifests
+        new_file = faker.pystr()
+        add_file(new_file)
+        merge()
+
+        output1 = path.joinpath("output1.zip")
+        output2 = path.joinpath("output2.zip")
+        assert output1.stat().st_ino == inode
+        assert get_manifest(output1) == first_manifest
+        assert get_manifest(output2) == f"{entries[new_file]['sha256']}  {new_file}\n"
+
+        # Unchanged outputs => nothing is published again
+        current = generations.get_current(path)
+        merge()
+        assert generations.get_current(path) == current
+
+    def test_split_oversize(self, faker: Faker) -> None:
+
+        Env.get_bool.cache_clear()
+        Env.get.cache_clear()
+        os.environ["ZIP_SPLIT_OVERSIZE"] = "1"
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        small = faker.pystr()
+        oversize = faker.pystr()
+        create_file(cache.joinpath(small), 1000)
+        create_file(cache.joinpath(oversize), MAX_SIZE * 2)
+
+        make_zip_archives(path, path.joinpath("output"), cache)
+        index = archives.build(path, cache)
+        assert index is not None
+        archives.save(path, index)
+
+        # The oversize file is split in the chunks following the first one
+        outputs = archives.get_output_chunks(path)
+        assert len(outputs) > 3
+        assert all(z.stat().st_size <= MAX_SIZE for z in outputs)
+        assert index[0]["files"].keys() == {small}
+        assert all(chunk["files"].keys() == {oversize} for chunk in index[1:])
+
+        # Changed split files are split again
+        content = create_file(cache.joinpath(oversize), MAX_SIZE * 2)
+        assert archives.update(path, cache, MAX_SIZE)
+        outputs = archives.get_output_chunks(path)
+        assert all(z.stat().st_size <= MAX_SIZE for z in outputs)
+
+        joined = b""
+        for z in outputs[1:]:
+            with zipfile.ZipFile(z, "r") as myzip:
+                for name in myzip.namelist():
+                    if not name.endswith(zip_writer.PARTS_SUFFIX):
+                        joined += myzip.read(name)
+        assert joined == content
+        assert archives.load(path) == archives.build(path, cache)
+
+        Env.get_bool.cache_clear()
+        Env.get.cache_clear()
+        os.environ["ZIP_SPLIT_OVERSIZE"] = "0"
+
+    def test_duplicates(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        first, second, other = sorted(faker.pystr() for _ in range(3))
+        content = create_file(cache.joinpath(first), 100000)
+        cache.joinpath(second).write_bytes(content)
+        create_file(cache.joinpath(other), 100000)
+        entries = {
+            name: manifest.make_entry(faker.url(), faker.pystr(), cache.joinpath(name))
+            for name in (first, second, other)
+        }
+        manifest.update(path, entries)
+
+        # The duplicated content is archived once, and it fits in a single chunk
+        make_zip_archives(path, path.joinpath("output"), cache)
+        whole_zip = path.joinpath("output.zip")
+        with zipfile.ZipFile(whole_zip, "r") as myzip:
+            assert myzip.testzip() is None
+            assert sorted(myzip.namelist()) == sorted(
+                [first, other, archives.DUPLICATES_FILE]
+            )
+            duplicates = myzip.read(archives.DUPLICATES_FILE).decode()
+            assert duplicates == f"{first}  {second}\n"
+
+        index = archives.build(path, cache)
+        assert index is not None
+        assert index[0]["files"].keys() == {first, second, other}
+        assert index[0]["duplicates"] == {second: first}
+        archives.save(path, index)
+
+        # Changed duplicates are archived from scratch
+        create_file(cache.joinpath(second), 1000)
+        assert not archives.update(path, cache, MAX_SIZE)
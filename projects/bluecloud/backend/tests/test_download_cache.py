@@ -0,0 +1,86 @@
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from bluecloud.tasks import download_cache
+from bluecloud.tasks.make_order import DownloadMetadata, fetch_datafile
+from bluecloud.tests.test_http_download import HTTPStandIn
+from faker import Faker
+from restapi.env import Env
+from restapi.tests import BaseTests
+
+
+class TestApp(BaseTests):
+    def test_download_cache(self, faker: Faker) -> None:
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["DOWNLOAD_CACHE_SIZE"] = str(16 * 1024 * 1024)
+
+        orders = [Path(tempfile.gettempdir(), faker.pystr()) for _ in range(2)]
+        for order in orders:
+            order.joinpath("cache").mkdir(parents=True)
+
+        shared = f"/data/{faker.pystr()}.nc"
+        other = f"/data/{faker.pystr()}.nc"
+        files = {shared: os.urandom(65536), other: os.urandom(65536)}
+        server = HTTPStandIn(files)
+        server.delays[shared] = 0.5
+
+        try:
+            # Two orders downloading the same url at the same time
+            # => a single transfer, hardlinked in both orders
+            errors: List[Optional[Tuple[str, str]]] = []
+
+            def fetch(order: Path) -> None:
+                metadata: DownloadMetadata = {}
+                local_path = order.joinpath("cache", "shared.nc")
+                errors.append(fetch_datafile(server.url(shared), local_path, metadata))
+
+            threads = [threading.Thread(target=fetch, args=(o,)) for o in orders]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert errors == [None, None]
+            assert server.completed == [shared]
+            first, second = (o.joinpath("cache", "shared.nc") for o in orders)
+            assert first.read_bytes() == files[shared]
+            assert first.stat().st_ino == second.stat().st_ino
+            key = download_cache.get_key(server.url(shared))
+            assert download_cache.get_data_path(key).samefile(first)
+
+            metadata: DownloadMetadata = {}
+            local_path = orders[0].joinpath("cache", "other.nc")
+            assert fetch_datafile(server.url(other), local_path, metadata) is None
+            other_key = download_cache.get_key(server.url(other))
+            assert download_cache.get_data_path(other_key).exists()
+
+            # Cache over its size => the least recently used entries are evicted,
+            # except the entries locked by an order using them
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ["DOWNLOAD_CACHE_SIZE"] = "1"
+            with download_cache.lock(server.url(shared)):
+                download_cache.evict()
+
+            assert download_cache.load(server.url(shared)) is not None
+            assert download_cache.load(server.url(other)) is None
+            assert not download_cache.get_data_path(other_key).exists()
+            # evicted files are still available in the orders
+            assert local_path.read_bytes() == files[other]
+
+            # ... until released
+            download_cache.evict()
+            assert download_cache.load(server.url(shared)) is None
+            assert first.read_bytes() == files[shared]
+
+        finally:
+            server.close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ.pop("DOWNLOAD_CACHE_SIZE")
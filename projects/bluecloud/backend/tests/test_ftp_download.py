@@ -0,0 +1,269 @@
+import hashlib
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+from bluecloud.endpoints.schemas import DownloadType
+from bluecloud.tasks.make_order import (
+    DownloadMetadata,
+    ErrorCodes,
+    StreamWriter,
+    download_datafiles,
+    ftp_download,
+    ftp_pool,
+    get_partial_path,
+    write_resume_info,
+)
+from faker import Faker
+from restapi.env import Env
+from restapi.tests import BaseTests
+
+
+class FTPStandInHandler(socketserver.StreamRequestHandler):
+    server: "FTPStandIn"
+
+    def reply(self, message: str) -> None:
+        self.wfile.write(f"{message}\r\n".encode())
+
+    def handle(self) -> None:
+
+        self.server.connections.append(self.request)
+        self.reply("220 BlueCloud test FTP server")
+
+        rest = 0
+        passive = None
+        while line := self.rfile.readline():
+            command, _, arg = line.decode().strip().partition(" ")
+            command = command.upper()
+
+            if command == "USER":
+                self.reply("331 Password required")
+            elif command == "PASS":
+                self.server.logins += 1
+                self.reply("230 Logged in")
+            elif command in ("TYPE", "NOOP"):
+                self.reply("200 OK")
+            elif command == "SIZE":
+                if arg not in self.server.files:
+                    self.reply("550 File not found")
+                else:
+                    self.reply(f"213 {len(self.server.files[arg])}")
+            elif command == "MDTM":
+                self.reply("213 20220101000000")
+            elif command == "PASV":
+                passive = socket.socket()
+                passive.bind(("127.0.0.1", 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                self.reply(
+                    f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 0xFF})"
+                )
+            elif command == "REST":
+                rest = int(arg)
+                self.server.rest_commands += 1
+                self.reply(f"350 Restarting at {rest}")
+            elif command == "RETR" and passive:
+                if arg not in self.server.files:
+                    self.reply("550 File not found")
+                    continue
+                data = self.server.files[arg][rest:]
+                # Simulate an interrupted transfer
+                if self.server.truncate:
+                    data = data[: len(data) // 2]
+                    self.server.truncate = False
+                self.reply("150 Opening data connection")
+                conn, _ = passive.accept()
+                conn.sendall(data)
+                conn.close()
+                passive.close()
+                passive = None
+                rest = 0
+                self.reply("226 Transfer complete")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply("502 Command not implemented")
+
+
+class FTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    Minimal anonymous FTP server (passive mode and binary transfers only),
+    serving in-memory files to test the FTP downloads offline
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files: Dict[str, bytes]) -> None:
+        super().__init__(("127.0.0.1", 0), FTPStandInHandler)
+        self.files = files
+        self.logins = 0
+        self.rest_commands = 0
+        self.truncate = False
+        self.connections: List[socket.socket] = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path: str) -> str:
+        return f"ftp://127.0.0.1:{self.server_address[1]}{path}"
+
+    def drop_connections(self) -> None:
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:  # pragma: no cover
+                pass
+        self.connections.clear()
+
+
+class TestApp(BaseTests):
+    def test_ftp_download(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        files = {f"/data/{faker.pystr()}.nc": os.urandom(65536) for _ in range(3)}
+        server = FTPStandIn(files)
+
+        try:
+            # Three downloads from the same server => only one login
+            for remote_path, content in files.items():
+                local_path = cache.joinpath(faker.pystr())
+                assert ftp_download(server.url(remote_path), local_path) is None
+                assert local_path.read_bytes() == content
+
+            assert server.logins == 1
+
+            # Missing file => the connection is still usable and kept in the pool
+            local_path = cache.joinpath(faker.pystr())
+            error = ftp_download(server.url("/data/missing.nc"), local_path)
+            assert error == ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+            assert not local_path.exists()
+            assert server.logins == 1
+
+            # Pooled connection closed by the server => reconnect
+            server.drop_connections()
+            remote_path, content = next(iter(files.items()))
+            local_path = cache.joinpath(faker.pystr())
+            assert ftp_download(server.url(remote_path), local_path) is None
+            assert local_path.read_bytes() == content
+            assert server.logins == 2
+
+            # Interrupted transfer => the partial file is kept out of the cache
+            server.truncate = True
+            local_path = cache.joinpath(faker.pystr())
+            error = ftp_download(server.url(remote_path), local_path)
+            assert error == ErrorCodes.UNEXPECTED_ERROR
+            assert not local_path.exists()
+            partial = get_partial_path(local_path)
+            assert partial.exists()
+            assert 0 < partial.stat().st_size < len(content)
+
+            # ... and resumed with REST on the following attempt
+            # (checksums also cover the bytes received by the previous attempt)
+            assert server.rest_commands == 0
+            metadata: DownloadMetadata = {}
+            url = server.url(remote_path)
+            assert ftp_download(url, local_path, metadata) is None
+            assert server.rest_commands == 1
+            assert local_path.read_bytes() == content
+            assert metadata["sha256"] == hashlib.sha256(content).hexdigest()
+            assert metadata["md5"] == hashlib.md5(content).hexdigest()
+            assert not partial.exists()
+
+            # Worker killed during a transfer (the writer is never exited)
+            # => the partial file is not padded to the remote size, the
+            # download is resumed from the received bytes
+            local_path = cache.joinpath(faker.pystr())
+            partial = get_partial_path(local_path)
+            validator = f"{len(content)}:20220101000000"
+            write_resume_info(partial, {"url": url, "validator": validator})
+            writer = StreamWriter(partial, size=len(content)).__enter__()
+            writer.write(content[:1000])
+            writer.file.close()
+            assert partial.stat().st_size == 1000
+
+            assert ftp_download(url, local_path, metadata) is None
+            assert server.rest_commands == 2
+            assert local_path.read_bytes() == content
+            assert metadata["sha256"] == hashlib.sha256(content).hexdigest()
+
+            # Unknown host
+            local_path = cache.joinpath(faker.pystr())
+            error = ftp_download("ftp://invalidurlafailisexpected.zzz/f", local_path)
+            assert error == ErrorCodes.UNREACHABLE_DOWNLOAD_PATH
+
+        finally:
+            ftp_pool.close_all()
+            server.shutdown()
+            server.server_close()
+
+    def test_asyncio_backend(self, faker: Faker) -> None:
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["DOWNLOAD_BACKEND"] = "asyncio"
+        os.environ["DOWNLOAD_WORKERS_PER_HOST"] = "1"
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        files = {f"/data/{faker.pystr()}.nc": os.urandom(65536) for _ in range(3)}
+        server = FTPStandIn(files)
+
+        def get_download(remote_path: str) -> DownloadType:
+            return {
+                "url": server.url(remote_path),
+                "filename": f"{faker.pystr()}.nc",
+                "order_line": faker.pystr(),
+            }
+
+        try:
+            # Lines on the same server => one login, also after a missing file
+            downloads = [get_download(p) for p in files]
+            downloads.insert(1, get_download("/data/missing.nc"))
+            results = download_datafiles(path, cache, downloads)
+            assert len(results) == len(downloads)
+            assert results[1]["error"] is not None
+            error_number = results[1]["error"]["error_number"]
+            assert error_number == ErrorCodes.UNREACHABLE_DOWNLOAD_PATH[0]
+            for d, result in zip(downloads, results):
+                if result["error"] is None:
+                    content = files[d["url"].removeprefix(server.url(""))]
+                    assert cache.joinpath(d["filename"]).read_bytes() == content
+            assert server.logins == 1
+
+            # Interrupted transfer => the partial file is kept...
+            remote_path, content = next(iter(files.items()))
+            d = get_download(remote_path)
+            partial = get_partial_path(cache.joinpath(d["filename"]))
+            server.truncate = True
+            (result,) = download_datafiles(path, cache, [d])
+            assert result["error"] is not None
+            assert result["error"]["error_number"] == ErrorCodes.UNEXPECTED_ERROR[0]
+            assert 0 < partial.stat().st_size < len(content)
+
+            # ... and resumed with REST by the following execution
+            assert server.rest_commands == 0
+            (result,) = download_datafiles(path, cache, [d])
+            assert result["error"] is None
+            assert server.rest_commands == 1
+            assert cache.joinpath(d["filename"]).read_bytes() == content
+            assert result["entry"] is not None
+            assert result["entry"]["sha256"] == hashlib.sha256(content).hexdigest()
+            assert not partial.exists()
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ.pop("DOWNLOAD_BACKEND")
+            os.environ.pop("DOWNLOAD_WORKERS_PER_HOST")
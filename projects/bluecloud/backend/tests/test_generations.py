@@ -0,0 +1,111 @@
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+from bluecloud.tasks import archives, generations
+from faker import Faker
+from restapi.tests import BaseTests
+
+
+def write_zip(z: Path, name: str, content: bytes) -> None:
+    with zipfile.ZipFile(z, "w") as myzip:
+        myzip.writestr(name, content)
+
+
+class TestApp(BaseTests):
+    def test_generations(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        path.mkdir()
+
+        # Outputs published before the generations are staged as well
+        whole_zip = path.joinpath("output.zip")
+        write_zip(whole_zip, "legacy", b"legacy")
+        with generations.stage(path) as staging:
+            assert staging.joinpath("output.zip").samefile(whole_zip)
+            write_zip(path.joinpath("chunk.zip"), "first", b"first")
+            archives.publish(path, [path.joinpath("chunk.zip")])
+            # Published once the stage is completed
+            with zipfile.ZipFile(whole_zip, "r") as myzip:
+                assert myzip.namelist() == ["legacy"]
+        assert whole_zip.is_symlink()
+        assert os.readlink(whole_zip) == "current/output.zip"
+        first_generation = generations.get_current(path)
+        assert first_generation is not None
+
+        # Unchanged outputs are not published again
+        with generations.stage(path):
+            pass
+        assert generations.get_current(path) == first_generation
+
+        # Downloads in progress keep reading the previous generation
+        target, lease = generations.lease(whole_zip)
+        assert target == first_generation.joinpath("output.zip")
+        assert lease is not None
+        with open(target, "rb") as download:
+            with generations.stage(path) as staging:
+                # Nested stages update the same generation
+                with generations.stage(path) as nested:
+                    assert nested == staging
+                    assert archives.get_output_chunks(path) == [
+                        staging.joinpath("output.zip")
+                    ]
+                    assert generations.detach(nested.joinpath("output.zip")) > 0
+                    chunk = staging.joinpath("chunk.zip")
+                    write_zip(chunk, "second", b"second")
+                    archives.publish(path, [nested.joinpath("output.zip"), chunk])
+
+                # Not published until the outer stage is completed
+                assert whole_zip.exists()
+                assert not path.joinpath("output1.zip").exists()
+
+            with zipfile.ZipFile(download, "r") as myzip:
+                assert myzip.read("first") == b"first"
+
+        assert not whole_zip.exists()
+        assert archives.get_output_chunks(path) == [
+            generations.get_current(path).joinpath("output1.zip"),  # type: ignore
+            generations.get_current(path).joinpath("output2.zip"),  # type: ignore
+        ]
+        with zipfile.ZipFile(path.joinpath("output2.zip"), "r") as myzip:
+            assert myzip.read("second") == b"second"
+        assert first_generation.exists()
+
+        # Failed updates are not published
+        try:
+            with generations.stage(path) as staging:
+                staging.joinpath("output1.zip").unlink()
+                raise ValueError("failed update")
+        except ValueError:
+            pass
+        assert path.joinpath("output1.zip").exists()
+
+        # Superseded generations are deleted once not read anymore
+        generations.collect(path)
+        assert first_generation.exists()
+        lease.close()
+        generations.collect(path)
+        assert not first_generation.exists()
+        assert path.joinpath("output1.zip").exists()
+        assert len(list(path.joinpath(generations.GENERATIONS).iterdir())) == 1
+
+        # Stale links (e.g. left by an interrupted publish) are not leased,
+        # the missing target is returned to be reported as not found
+        stale = path.joinpath("output9.zip")
+        stale.symlink_to(f"{generations.CURRENT}/output9.zip")
+        target, missing = generations.lease(stale)
+        assert missing is None
+        assert target == generations.get_current(path).joinpath(  # type: ignore
+            "output9.zip"
+        )
+        assert not target.exists()
+
+        # Outputs published before the generations are not leased
+        legacy = Path(tempfile.gettempdir(), faker.pystr())
+        legacy.mkdir()
+        write_zip(legacy.joinpath("output.zip"), "legacy", b"legacy")
+        assert generations.lease(legacy.joinpath("output.zip")) == (
+            legacy.joinpath("output.zip"),
+            None,
+        )
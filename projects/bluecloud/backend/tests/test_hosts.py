@@ -0,0 +1,67 @@
+import os
+
+from bluecloud.tasks import host_health
+from faker import Faker
+from restapi.env import Env
+from restapi.tests import API_URI, BaseTests, FlaskClient
+
+
+class TestApp(BaseTests):
+    def test_hosts(self, client: FlaskClient, faker: Faker) -> None:
+
+        r = client.get(f"{API_URI}/hosts")
+        assert r.status_code == 401
+
+        r = client.post(f"{API_URI}/hosts")
+        assert r.status_code == 405
+
+        headers, _ = self.do_login(client, None, None)
+
+        default_failures = os.environ.get("CIRCUIT_BREAKER_FAILURES", "0")
+        default_reset = os.environ.get("CIRCUIT_BREAKER_RESET", "300")
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["CIRCUIT_BREAKER_FAILURES"] = "2"
+        os.environ["CIRCUIT_BREAKER_RESET"] = "300"
+
+        host = faker.domain_name()
+        host_health.record_failure(host, "Connection refused")
+
+        r = client.get(f"{API_URI}/hosts", headers=headers)
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, dict)
+        assert "hosts" in response
+        hosts = {h["host"]: h for h in response["hosts"]}
+        assert host in hosts
+        assert hosts[host]["state"] == "closed"
+        assert hosts[host]["failures"] == 1
+        assert hosts[host]["last_error"] == "Connection refused"
+        assert host_health.allow(host)
+
+        # Too many failures => the circuit is opened
+        host_health.record_failure(host, "Connection refused")
+        r = client.get(f"{API_URI}/hosts", headers=headers)
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, dict)
+        hosts = {h["host"]: h for h in response["hosts"]}
+        assert hosts[host]["state"] == "open"
+        assert not host_health.allow(host)
+
+        # The probe after the reset timeout is successful => closed again
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["CIRCUIT_BREAKER_RESET"] = "0"
+        assert host_health.allow(host)
+        # only a single probe is allowed
+        assert not host_health.allow(host)
+        host_health.record_success(host)
+        assert host_health.load(host)["state"] == "closed"
+        assert host_health.allow(host)
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["CIRCUIT_BREAKER_FAILURES"] = default_failures
+        os.environ["CIRCUIT_BREAKER_RESET"] = default_reset
@@ -0,0 +1,613 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+import pytest
+from bluecloud.endpoints.schemas import DownloadType
+from bluecloud.tasks import make_order
+from bluecloud.tasks.make_order import (
+    DownloadMetadata,
+    ErrorCodes,
+    ResumeInfo,
+    download_datafiles,
+    get_http_session,
+    get_partial_path,
+    get_resume_info_path,
+    get_segments,
+    http_download,
+    preallocate,
+    write_resume_info,
+)
+from faker import Faker
+from requests.adapters import HTTPAdapter
+from restapi.env import Env
+from restapi.tests import BaseTests
+
+
+class HTTPStandInHandler(BaseHTTPRequestHandler):
+    server: "HTTPStandIn"
+    # keep-alive, to verify the reuse of the pooled connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.connections.append(self.client_address)
+
+    def send_status(self, status: int, **headers: str) -> None:
+        self.server.requests.append((self.path, self.headers, status))
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header.replace("_", "-"), value)
+        self.end_headers()
+
+    def do_GET(self) -> None:
+
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            self.respond()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def respond(self) -> None:
+
+        if delay := self.server.delays.get(self.path):
+            time.sleep(delay)
+
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_status(404, Content_Length="0")
+            return
+
+        etag = self.server.etag(self.path)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_status(304, ETag=etag)
+            return
+
+        status = 200
+        start, end = 0, len(content) - 1
+        headers = {"ETag": etag}
+        if self.server.ranges:
+            headers["Accept_Ranges"] = "bytes"
+
+            # If-Range is not matched => the whole (new) content is returned
+            requested = self.headers.get("Range")
+            if requested and self.headers.get("If-Range", etag) == etag:
+                first, _, last = requested.removeprefix("bytes=").partition("-")
+                start = int(first)
+                end = int(last) if last else len(content) - 1
+                if start >= len(content):
+                    self.send_status(
+                        416, Content_Range=f"bytes */{len(content)}", Content_Length="0"
+                    )
+                    return
+                if self.server.range_limit:
+                    end = min(end, start + self.server.range_limit - 1)
+                status = 206
+                headers["Content_Range"] = f"bytes {start}-{end}/{len(content)}"
+
+        data = content[start : end + 1]
+        self.send_status(status, Content_Length=str(len(data)), **headers)
+
+        # Simulate an interrupted transfer
+        if self.server.truncated.get(self.path):
+            self.server.truncated[self.path] -= 1
+            self.wfile.write(data[: len(data) // 2])
+            self.close_connection = True
+            return
+
+        self.wfile.write(data)
+        self.server.completed.append(self.path)
+
+
+class HTTPStandIn(ThreadingHTTPServer):
+    """
+    Minimal HTTP server serving in-memory files with strong ETags
+    and byte ranges, to test the HTTP downloads offline
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files: Dict[str, bytes]) -> None:
+        super().__init__(("127.0.0.1", 0), HTTPStandInHandler)
+        self.files = files
+        # False to ignore the Range headers, as some servers do
+        self.ranges = True
+        # max bytes of the range responses, shorter than requested if exceeded
+        self.range_limit = 0
+        # number of next responses of a path to be interrupted
+        self.truncated: Dict[str, int] = {}
+        # seconds waited before responding to the requests of a path
+        self.delays: Dict[str, float] = {}
+        # paths with a different ETag at every request
+        self.changing: Set[str] = set()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.requests: List[Tuple[str, Message, int]] = []
+        self.connections: List[Tuple[str, int]] = []
+        self.completed: List[str] = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+    def etag(self, path: str) -> str:
+        etag = hashlib.md5(self.files[path]).hexdigest()
+        if path in self.changing:
+            etag = f"{etag}-{len(self.requests)}"
+        return f'"{etag}"'
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class TestApp(BaseTests):
+    def test_resume(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        remote_path = f"/data/{faker.pystr()}.nc"
+        # larger than the download buffer, to be partially written when truncated
+        content = os.urandom(4194304)
+        server = HTTPStandIn({remote_path: content})
+        url = server.url(remote_path)
+
+        try:
+            # Interrupted transfer => the partial file is kept out of the cache
+            server.truncated[remote_path] = 1
+            local_path = cache.joinpath(faker.pystr())
+            assert http_download(url, local_path) == ErrorCodes.UNEXPECTED_ERROR
+            assert not local_path.exists()
+            partial = get_partial_path(local_path)
+            offset = partial.stat().st_size
+            assert 0 < offset < len(content)
+
+            # ... and resumed with a 206 on the following attempt
+            # (checksums also cover the bytes received by the previous attempt)
+            metadata: DownloadMetadata = {}
+            assert http_download(url, local_path, metadata) is None
+            _, headers, status = server.requests[-1]
+            assert headers.get("Range") == f"bytes={offset}-"
+            assert status == 206
+            assert local_path.read_bytes() == content
+            assert metadata["sha256"] == hashlib.sha256(content).hexdigest()
+            assert metadata["md5"] == hashlib.md5(content).hexdigest()
+            assert not partial.exists()
+
+            # Range ignored by the server => 200, restarted from the beginning
+            server.ranges = False
+            server.truncated[remote_path] = 1
+            local_path = cache.joinpath(faker.pystr())
+            assert http_download(url, local_path) == ErrorCodes.UNEXPECTED_ERROR
+            partial = get_partial_path(local_path)
+            assert partial.stat().st_size > 0
+
+            metadata = {}
+            assert http_download(url, local_path, metadata) is None
+            _, headers, status = server.requests[-1]
+            assert headers.get("Range") is not None
+            assert status == 200
+            assert local_path.read_bytes() == content
+            assert metadata["sha256"] == hashlib.sha256(content).hexdigest()
+            assert not partial.exists()
+            server.ranges = True
+
+            # Remote file changed => If-Range is not matched, the new content
+            # is returned in full and replaces the partial file
+            server.truncated[remote_path] = 1
+            local_path = cache.joinpath(faker.pystr())
+            assert http_download(url, local_path) == ErrorCodes.UNEXPECTED_ERROR
+
+            changed = os.urandom(3145728)
+            server.files[remote_path] = changed
+            metadata = {}
+            assert http_download(url, local_path, metadata) is None
+            _, headers, status = server.requests[-1]
+            assert headers.get("If-Range") == f'"{hashlib.md5(content).hexdigest()}"'
+            assert status == 200
+            assert local_path.read_bytes() == changed
+            assert metadata["sha256"] == hashlib.sha256(changed).hexdigest()
+            assert metadata["size"] == len(changed)
+            server.files[remote_path] = content
+
+            # Range not satisfiable (partial file larger than the remote file)
+            # => RestartDownload, the partial file is discarded and the
+            # download restarted from the beginning
+            server.truncated[remote_path] = 1
+            local_path = cache.joinpath(faker.pystr())
+            assert http_download(url, local_path) == ErrorCodes.UNEXPECTED_ERROR
+            partial = get_partial_path(local_path)
+            with open(partial, "ab") as f:
+                f.write(os.urandom(len(content)))
+
+            count = len(server.requests)
+            metadata = {}
+            assert http_download(url, local_path, metadata) is None
+            assert [status for _, _, status in server.requests[count:]] == [416, 200]
+            _, headers, _ = server.requests[-1]
+            assert headers.get("Range") is None
+            assert local_path.read_bytes() == content
+            assert metadata["sha256"] == hashlib.sha256(content).hexdigest()
+            assert not partial.exists()
+
+        finally:
+            server.close()
+
+    def test_truncated(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        remote_path = f"/data/{faker.pystr()}.nc"
+        content = os.urandom(4194304)
+        server = HTTPStandIn({remote_path: content})
+        url = server.url(remote_path)
+        local_path = cache.joinpath(faker.pystr())
+        partial = get_partial_path(local_path)
+
+        try:
+            # Fewer bytes than the Content-Length => failed, the received bytes
+            # are kept in the partial file with the info to resume it
+            server.truncated[remote_path] = 1
+            assert http_download(url, local_path) == ErrorCodes.UNEXPECTED_ERROR
+            assert not local_path.exists()
+            offset = partial.stat().st_size
+            assert 0 < offset < len(content)
+            assert partial.read_bytes() == content[:offset]
+            assert get_resume_info_path(partial).exists()
+
+            # Fewer bytes than the size of the file, declared by the Content-Range
+            # of the resumed transfer => detected by the size check of the writer
+            # (IncompleteDownload, the response itself is not truncated)
+            server.range_limit = 1048576
+            assert http_download(url, local_path) == ErrorCodes.UNEXPECTED_ERROR
+            _, headers, status = server.requests[-1]
+            assert headers.get("Range") == f"bytes={offset}-"
+            assert status == 206
+            assert not local_path.exists()
+            assert partial.stat().st_size == offset + server.range_limit
+            assert partial.read_bytes() == content[: offset + server.range_limit]
+
+            # ... resumed again until completed, with the checksums of the whole file
+            server.range_limit = 0
+            offset = partial.stat().st_size
+            metadata: DownloadMetadata = {}
+            assert http_download(url, local_path, metadata) is None
+            _, headers, status = server.requests[-1]
+            assert headers.get("Range") == f"bytes={offset}-"
+            assert status == 206
+            assert local_path.read_bytes() == content
+            assert metadata["sha256"] == hashlib.sha256(content).hexdigest()
+            assert metadata["size"] == len(content)
+            assert not partial.exists()
+
+        finally:
+            server.close()
+
+    def test_segmented(self, faker: Faker) -> None:
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["HTTP_SEGMENT_THRESHOLD"] = "1"
+        os.environ["HTTP_SEGMENTS"] = "4"
+        os.environ["DOWNLOAD_WORKERS_PER_HOST"] = "2"
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        remote_path = f"/data/{faker.pystr()}.nc"
+        content = os.urandom(4194304)
+        server = HTTPStandIn({remote_path: content})
+        server.delays[remote_path] = 0.2
+        url = server.url(remote_path)
+        segments = get_segments(len(content), 4)
+
+        try:
+            # The first segment is read from the first response, the others
+            # are downloaded in parallel within the slots of the host
+            filename = f"{faker.pystr()}.nc"
+            download: DownloadType = {
+                "url": url,
+                "filename": filename,
+                "order_line": "1",
+            }
+            results = download_datafiles(path, cache, [download])
+            assert results[0]["error"] is None
+            assert cache.joinpath(filename).read_bytes() == content
+            assert [status for _, _, status in server.requests] == [200, 206, 206, 206]
+            assert server.max_active <= 2
+
+            # Resumed with some segments already downloaded
+            local_path = cache.joinpath(faker.pystr())
+            partial = get_partial_path(local_path)
+            preallocate(partial, len(content))
+            with open(partial, "r+b") as f:
+                for start, end in segments[:2]:
+                    f.seek(start)
+                    f.write(content[start : end + 1])
+            info: ResumeInfo = {
+                "url": url,
+                "validator": server.etag(remote_path),
+                "size": len(content),
+                "segments": segments,
+                "completed": [0, 1],
+            }
+            write_resume_info(partial, info)
+
+            count = len(server.requests)
+            assert http_download(url, local_path) is None
+            ranges = sorted(
+                str(headers.get("Range")) for _, headers, _ in server.requests[count:]
+            )
+            assert ranges == [f"bytes={start}-{end}" for start, end in segments[2:]]
+            assert local_path.read_bytes() == content
+            assert not partial.exists()
+
+            # ... or all of them, interrupted before completing the partial file
+            local_path = cache.joinpath(faker.pystr())
+            partial = get_partial_path(local_path)
+            partial.write_bytes(content)
+            info["completed"] = [0, 1, 2, 3]
+            write_resume_info(partial, info)
+
+            count = len(server.requests)
+            assert http_download(url, local_path) is None
+            assert len(server.requests) == count
+            assert local_path.read_bytes() == content
+            assert not partial.exists()
+
+            # File changing during each download => restarted only once
+            server.changing.add(remote_path)
+            local_path = cache.joinpath(faker.pystr())
+            assert http_download(url, local_path) == ErrorCodes.UNEXPECTED_ERROR
+            assert not local_path.exists()
+            assert not get_partial_path(local_path).exists()
+
+        finally:
+            server.close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ.pop("HTTP_SEGMENT_THRESHOLD")
+            os.environ.pop("HTTP_SEGMENTS")
+            os.environ.pop("DOWNLOAD_WORKERS_PER_HOST")
+
+    def test_pool(self, faker: Faker, monkeypatch: pytest.MonkeyPatch) -> None:
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["DOWNLOAD_WORKERS"] = "4"
+        os.environ["DOWNLOAD_WORKERS_PER_HOST"] = "3"
+
+        # A new session is created with the configured concurrency
+        monkeypatch.setattr(make_order, "http_session", None)
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        files = {f"/data/{faker.pystr()}.nc": os.urandom(65536) for _ in range(8)}
+        server = HTTPStandIn(files)
+        downloads: List[DownloadType] = []
+        for remote_path in files:
+            server.delays[remote_path] = 0.1
+            downloads.append(
+                {
+                    "url": server.url(remote_path),
+                    "filename": remote_path.rpartition("/")[2],
+                    "order_line": str(len(downloads)),
+                }
+            )
+
+        session = get_http_session()
+        try:
+            assert get_http_session() is session
+
+            results = download_datafiles(path, cache, downloads)
+            assert all(r["error"] is None for r in results)
+            for d in downloads:
+                content = files[f"/data/{d['filename']}"]
+                assert cache.joinpath(d["filename"]).read_bytes() == content
+
+            # The pool of the host is sized with the concurrency per host
+            # and its connections are reused by the following lines
+            adapter = session.get_adapter(downloads[0]["url"])
+            assert isinstance(adapter, HTTPAdapter)
+            pools = adapter.poolmanager.pools
+            assert len(pools) == 1
+            pool = pools[next(iter(pools.keys()))]
+            assert pool.pool is not None
+            assert pool.pool.maxsize == 3
+            assert pool.num_requests == len(downloads)
+            assert pool.num_connections <= 3
+            assert len(server.connections) == pool.num_connections
+            assert server.max_active <= 3
+
+        finally:
+            session.close()
+            server.close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ.pop("DOWNLOAD_WORKERS")
+            os.environ.pop("DOWNLOAD_WORKERS_PER_HOST")
+
+    def test_concurrent_lines(
+        self, faker: Faker, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["DOWNLOAD_WORKERS"] = "4"
+        os.environ["DOWNLOAD_WORKERS_PER_HOST"] = "4"
+        # with pools sized for the concurrency per host
+        monkeypatch.setattr(make_order, "http_session", None)
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        slow = f"/data/{faker.pystr()}.nc"
+        fast = f"/data/{faker.pystr()}.nc"
+        files = {slow: os.urandom(65536), fast: os.urandom(65536)}
+        server = HTTPStandIn(files)
+        server.delays[slow] = 0.5
+        server.delays["/data/slow_missing.nc"] = 0.5
+
+        def get_download(remote_path: str, filename: str) -> DownloadType:
+            return {
+                "url": server.url(remote_path),
+                "filename": filename,
+                "order_line": faker.pystr(),
+            }
+
+        try:
+            # Lines completed out of order => results and errors in order-line order
+            downloads = [
+                get_download(slow, f"{faker.pystr()}.nc"),
+                get_download("/data/fast_missing.nc", f"{faker.pystr()}.nc"),
+                get_download("/data/slow_missing.nc", f"{faker.pystr()}.nc"),
+                get_download(fast, f"{faker.pystr()}.nc"),
+            ]
+            results = download_datafiles(path, cache, downloads)
+            assert server.completed.index(fast) < server.completed.index(slow)
+
+            assert len(results) == len(downloads)
+            for d, result in zip(downloads, results):
+                if error := result["error"]:
+                    assert error["order_line"] == d["order_line"]
+                    assert error["url"] == d["url"]
+                else:
+                    assert result["entry"] is not None
+                    assert result["entry"]["order_line"] == d["order_line"]
+            assert [r["error"] is None for r in results] == [True, False, False, True]
+
+            # Lines writing the same file => downloaded one at a time in order,
+            # the last line is kept even if the previous one is slower
+            server.completed.clear()
+            filename = f"{faker.pystr()}.nc"
+            downloads = [get_download(slow, filename), get_download(fast, filename)]
+            results = download_datafiles(path, cache, downloads)
+            assert all(r["error"] is None for r in results)
+            assert server.completed == [slow, fast]
+            assert cache.joinpath(filename).read_bytes() == files[fast]
+
+        finally:
+            get_http_session().close()
+            server.close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ.pop("DOWNLOAD_WORKERS")
+            os.environ.pop("DOWNLOAD_WORKERS_PER_HOST")
+
+    def test_asyncio_backend(self, faker: Faker) -> None:
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["DOWNLOAD_BACKEND"] = "asyncio"
+        os.environ["DOWNLOAD_WORKERS_PER_HOST"] = "2"
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        files = {f"/data/{faker.pystr()}.nc": os.urandom(65536) for _ in range(6)}
+        server = HTTPStandIn(files)
+
+        def get_download(remote_path: str, filename: str) -> DownloadType:
+            return {
+                "url": server.url(remote_path),
+                "filename": filename,
+                "order_line": faker.pystr(),
+            }
+
+        try:
+            downloads: List[DownloadType] = []
+            for remote_path in files:
+                server.delays[remote_path] = 0.1
+                downloads.append(get_download(remote_path, f"{faker.pystr()}.nc"))
+            downloads.insert(2, get_download("/data/missing.nc", "missing.nc"))
+            # without scheme
+            downloads.append(
+                {"url": "invalid/url", "filename": "invalid.nc", "order_line": "0"}
+            )
+
+            # Results in order-line order, no more transfers than allowed per host
+            results = download_datafiles(path, cache, downloads)
+            assert len(results) == len(downloads)
+            for d, result in zip(downloads, results):
+                if error := result["error"]:
+                    assert error["order_line"] == d["order_line"]
+                    continue
+                assert result["entry"] is not None
+                assert result["entry"]["order_line"] == d["order_line"]
+                content = files[d["url"].removeprefix(server.url(""))]
+                assert cache.joinpath(d["filename"]).read_bytes() == content
+                assert result["entry"]["sha256"] == hashlib.sha256(content).hexdigest()
+            errors = [
+                r["error"]["error_number"] if r["error"] else None for r in results
+            ]
+            assert errors[2] == ErrorCodes.INVALID_RESPONSE[0]
+            assert errors[-1] == ErrorCodes.UNREACHABLE_DOWNLOAD_PATH[0]
+            assert errors.count(None) == len(files)
+            assert server.max_active <= 2
+
+            # Interrupted transfer => the partial file is kept to be resumed
+            remote_path, content = next(iter(files.items()))
+            d = get_download(remote_path, f"{faker.pystr()}.nc")
+            partial = get_partial_path(cache.joinpath(d["filename"]))
+            server.truncated[remote_path] = 1
+            (result,) = download_datafiles(path, cache, [d])
+            assert result["error"] is not None
+            assert result["error"]["error_number"] == ErrorCodes.UNEXPECTED_ERROR[0]
+            offset = partial.stat().st_size
+            assert 0 < offset < len(content)
+            assert get_resume_info_path(partial).exists()
+
+            (result,) = download_datafiles(path, cache, [d])
+            assert result["error"] is None
+            _, headers, status = server.requests[-1]
+            assert headers.get("Range") == f"bytes={offset}-"
+            assert status == 206
+            assert cache.joinpath(d["filename"]).read_bytes() == content
+            assert result["entry"] is not None
+            assert result["entry"]["sha256"] == hashlib.sha256(content).hexdigest()
+            assert not partial.exists()
+
+            # Lines writing the same file => downloaded one at a time in order
+            slow, fast = list(files)[:2]
+            server.delays[slow] = 0.5
+            server.completed.clear()
+            filename = f"{faker.pystr()}.nc"
+            downloads = [get_download(slow, filename), get_download(fast, filename)]
+            results = download_datafiles(path, cache, downloads)
+            assert all(r["error"] is None for r in results)
+            assert server.completed == [slow, fast]
+            assert cache.joinpath(filename).read_bytes() == files[fast]
+
+        finally:
+            server.close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ.pop("DOWNLOAD_BACKEND")
+            os.environ.pop("DOWNLOAD_WORKERS_PER_HOST")
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from bluecloud.tasks import locks
+from bluecloud.tasks.host_health import get_redis
+from faker import Faker
+from restapi.env import Env
+from restapi.tests import BaseTests
+
+
+class TestApp(BaseTests):
+    def test_order_lock(self, faker: Faker, tmp_path: Path) -> None:
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["ORDER_LOCK_TTL"] = "1"
+        os.environ["LOCK_SLEEP_TIME"] = "30"
+
+        path = tmp_path.joinpath(faker.pystr())
+        path.mkdir()
+        r = get_redis()
+        key = locks.get_key(path)
+
+        acquired = threading.Event()
+        release = threading.Event()
+        waited: List[float] = []
+
+        def hold() -> None:
+            with locks.order_lock(path):
+                acquired.set()
+                release.wait()
+
+        def wait() -> None:
+            start = time.monotonic()
+            with locks.order_lock(path):
+                waited.append(time.monotonic() - start)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        assert acquired.wait(5)
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+
+        # The heartbeat keeps the lock beyond its lease
+        time.sleep(2)
+        assert r.get(key) is not None
+        assert not waited
+
+        # The waiter is notified without waiting LOCK_SLEEP_TIME
+        release.set()
+        holder.join()
+        waiter.join(5)
+        assert len(waited) == 1
+        assert 2 <= waited[0] < 5
+        assert r.get(key) is None
+
+        # The lock of a crashed worker expires
+        r.set(key, "crashed", px=500)
+        start = time.monotonic()
+        with locks.order_lock(path):
+            assert r.get(key) != b"crashed"
+        assert time.monotonic() - start < 5
+
+        assert locks.waits["count"] >= 3
+        locks.log_stats()
+        assert locks.waits["count"] == 0
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ.pop("ORDER_LOCK_TTL")
+        os.environ.pop("LOCK_SLEEP_TIME")
@@ -1,11 +1,17 @@
 import os
 import zipfile
 from pathlib import Path
+from typing import Any, List, Tuple
 
 import pytest
+from bluecloud.endpoints.schemas import DownloadType
+from bluecloud.tasks import manifest
+from bluecloud.tasks.make_order import NETWORK_RETRIES, download_datafiles
+from bluecloud.tests.test_http_download import HTTPStandIn
 from faker import Faker
 from flask import Flask
 from restapi.config import DATA_PATH
+from restapi.connectors import celery
 from restapi.connectors.celery import Ignore
 from restapi.env import Env
 from restapi.tests import BaseTests
@@ -40,6 +46,12 @@ def test_make_order_task(self, app: Flask, faker: Faker) -> None:
         path = DATA_PATH.joinpath(marine_id, order_number)
         path.mkdir(parents=True)
 
+        # The archives are built at once, not delayed by rescheduling
+        merge_delay = os.environ.get("ZIP_MERGE_DELAY", "5")
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["ZIP_MERGE_DELAY"] = "0"
+
         # Send a request with zero files to be downloaded
         response = self.send_task(
             app, TASK_NAME, request_id, marine_id, order_number, [], True
@@ -121,6 +133,26 @@ def test_make_order_task(self, app: Flask, faker: Faker) -> None:
         assert response["errors"][1]["error_number"] == "001"
         assert Path(path.joinpath("output.zip")).exists()
 
+        # Only the downloaded file is recorded in the manifest
+        entries = manifest.load(path)
+        assert list(entries.keys()) == [downloads[0]["filename"]]
+        assert entries[downloads[0]["filename"]]["url"] == downloads[0]["url"]
+        cached_file = path.joinpath("cache", downloads[0]["filename"])
+        mtime = cached_file.stat().st_mtime_ns
+
+        # Merge the same file in the order => not downloaded again
+        downloads = downloads[0:1]
+        downloads[0]["order_line"] = faker.pystr()
+        response = self.send_task(
+            app, TASK_NAME, request_id, marine_id, order_number, downloads, True
+        )
+        assert response is not None
+        assert len(response["errors"]) == 0
+
+        assert cached_file.stat().st_mtime_ns == mtime
+        entry = manifest.load(path)[downloads[0]["filename"]]
+        assert entry["order_line"] == downloads[0]["order_line"]
+
         downloads = [
             {
                 "url": "https://github.com/rapydo/http-api/archive/v1.0.zip",
@@ -156,3 +188,228 @@ def test_make_order_task(self, app: Flask, faker: Faker) -> None:
 
             content_list = [f.name for f in local_unzipdir.iterdir()]
             assert "http-api-1.0" in content_list
+
+        # Same request with the datafiles streamed into the zip archives:
+        # the cache folder is not used and the large zip is still not nested
+        Env.get_bool.cache_clear()
+        os.environ["ZIP_STREAMING"] = "1"
+
+        order_number = faker.pystr()
+        path = DATA_PATH.joinpath(marine_id, order_number)
+        path.mkdir(parents=True)
+
+        response = self.send_task(
+            app, TASK_NAME, request_id, marine_id, order_number, downloads, True
+        )
+        assert response is not None
+        assert len(response["errors"]) == 0
+
+        assert not any(path.joinpath("cache").iterdir())
+        entries = manifest.load(path)
+        assert entries[downloads[0]["filename"]]["archived"]
+
+        zippath = path.joinpath("output.zip")
+        assert zippath.exists()
+        with zipfile.ZipFile(zippath, "r") as zipref:
+            assert zipref.testzip() is None
+            assert any(n.startswith("http-api-1.0/") for n in zipref.namelist())
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        Env.get_bool.cache_clear()
+        os.environ["ZIP_STREAMING"] = "0"
+        os.environ["ZIP_MERGE_DELAY"] = merge_delay
+
+    def test_interrupted_build(self, app: Flask, faker: Faker) -> None:
+
+        request_id = faker.pyint()
+        marine_id = faker.pystr()
+        order_number = faker.pystr()
+        path = DATA_PATH.joinpath(marine_id, order_number)
+        cache = path.joinpath("cache")
+        cache.mkdir(parents=True)
+
+        merge_delay = os.environ.get("ZIP_MERGE_DELAY", "5")
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["ZIP_MERGE_DELAY"] = "0"
+
+        files = {f"/data/{faker.pystr()}.nc": os.urandom(4096) for _ in range(2)}
+        server = HTTPStandIn(files)
+        downloads: List[DownloadType] = [
+            {
+                "url": server.url(remote_path),
+                "filename": remote_path.rpartition("/")[2],
+                "order_line": faker.pystr(),
+            }
+            for remote_path in files
+        ]
+
+        try:
+            # Execution interrupted after downloading the lines, before the build
+            results = download_datafiles(path, cache, downloads)
+            entries: manifest.Manifest = {}
+            for d, result in zip(downloads, results):
+                assert result["entry"] is not None
+                entries[d["filename"]] = result["entry"]
+            manifest.update(path, entries)
+            count = len(server.requests)
+
+            # Resubmitted => the lines are skipped (not even revalidated)
+            # but the datafiles are archived anyway
+            for d in downloads:
+                d["order_line"] = faker.pystr()
+            response = self.send_task(
+                app, TASK_NAME, request_id, marine_id, order_number, downloads, True
+            )
+            assert response is not None
+            assert response["errors"] == []
+            assert len(server.requests) == count
+
+            with zipfile.ZipFile(path.joinpath("output.zip"), "r") as zipref:
+                for d, content in zip(downloads, files.values()):
+                    assert zipref.read(d["filename"]) == content
+
+            # ... with the new order lines, without extending their freshness
+            for d in downloads:
+                entry = manifest.load(path)[d["filename"]]
+                assert entry["order_line"] == d["order_line"]
+                assert entry["timestamp"] == entries[d["filename"]]["timestamp"]
+
+        finally:
+            server.close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ["ZIP_MERGE_DELAY"] = merge_delay
+
+    def test_reschedule(
+        self, app: Flask, faker: Faker, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+
+        request_id = faker.pyint()
+        marine_id = faker.pystr()
+        order_number = faker.pystr()
+        path = DATA_PATH.joinpath(marine_id, order_number)
+        path.mkdir(parents=True)
+
+        # All the datafiles in a single zip archive
+        max_zip_size = os.environ["MAX_ZIP_SIZE"]
+        merge_delay = os.environ.get("ZIP_MERGE_DELAY", "5")
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["MAX_ZIP_SIZE"] = str(64 * 1024 * 1024)
+        os.environ["ZIP_MERGE_DELAY"] = "0"
+
+        failing = f"/data/{faker.pystr()}.nc"
+        completed = f"/data/{faker.pystr()}.nc"
+        retried = f"/data/{faker.pystr()}.nc"
+        files = {
+            failing: os.urandom(4194304),
+            completed: os.urandom(4096),
+            retried: os.urandom(4194304),
+        }
+        server = HTTPStandIn(files)
+        # Interrupted transfers are transient errors
+        server.truncated[failing] = NETWORK_RETRIES
+        server.truncated[retried] = 1
+
+        downloads: List[DownloadType] = [
+            {
+                "url": server.url(remote_path),
+                "filename": remote_path.rpartition("/")[2],
+                "order_line": faker.pystr(),
+            }
+            for remote_path in (failing, completed, retried, "/data/missing.nc")
+        ]
+
+        # The rescheduled executions are captured instead of sent to the broker
+        scheduled: List[Tuple[List[Any], int]] = []
+        task = celery.get_instance().celery_app.tasks[TASK_NAME]
+        monkeypatch.setattr(
+            task,
+            "apply_async",
+            lambda args, countdown: scheduled.append((args, countdown)),
+        )
+
+        try:
+            response = self.send_task(
+                app, TASK_NAME, request_id, marine_id, order_number, downloads, True
+            )
+
+            # Transient errors => the lines are rescheduled with a backoff,
+            # the order is finalized by the last execution
+            assert not path.joinpath("output.zip").exists()
+            assert len(scheduled) == 1
+            args, countdown = scheduled[0]
+            assert 0 <= countdown <= Env.get_int("DOWNLOAD_RETRY_BACKOFF_MAX", 300)
+            assert args[3] == [downloads[0], downloads[2]]
+            state = args[5]
+            assert state["attempt"] == 2
+            assert state["lines"] == [0, 2]
+            assert state["downloaded"] == 1
+            assert [e["line"] for e in state["errors"]] == [3]
+
+            executions = 1
+            while scheduled:
+                args, _ = scheduled.pop()
+                response = self.send_task(app, TASK_NAME, *args)
+                executions += 1
+            assert executions == NETWORK_RETRIES
+
+            # The errors of all the executions are reported in order-line order
+            assert response is not None
+            errors = response["errors"]
+            assert [e["order_line"] for e in errors] == [
+                downloads[0]["order_line"],
+                downloads[3]["order_line"],
+            ]
+            assert [e["error_number"] for e in errors] == ["999", "002"]
+
+            # ... and the files downloaded by all the executions are archived
+            zippath = path.joinpath("output.zip")
+            assert zippath.exists()
+            with zipfile.ZipFile(zippath, "r") as zipref:
+                names = zipref.namelist()
+                assert downloads[1]["filename"] in names
+                assert downloads[2]["filename"] in names
+                assert downloads[0]["filename"] not in names
+                assert zipref.read(downloads[2]["filename"]) == files[retried]
+
+            # Builds delayed while merging => the execution is rescheduled
+            # without downloads, to build the archives once no other merge
+            # is registered (at once if the merges are not registered)
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ["ZIP_MERGE_DELAY"] = "1"
+            merged: DownloadType = {
+                "url": downloads[1]["url"],
+                "filename": faker.file_name(extension="nc"),
+                "order_line": faker.pystr(),
+            }
+            response = self.send_task(
+                app, TASK_NAME, request_id, marine_id, order_number, [merged], True
+            )
+            if scheduled:
+                args, countdown = scheduled.pop()
+                assert countdown == 1
+                assert args[3] == []
+                assert args[5]["downloaded"] == 1
+                assert args[5]["merge"]["delays"] == 1
+                # Not archived until the delayed build
+                with zipfile.ZipFile(zippath, "r") as zipref:
+                    assert merged["filename"] not in zipref.namelist()
+                response = self.send_task(app, TASK_NAME, *args)
+            assert not scheduled
+            assert response is not None
+            assert response["errors"] == []
+            with zipfile.ZipFile(zippath, "r") as zipref:
+                assert zipref.read(merged["filename"]) == files[completed]
+
+        finally:
+            server.close()
+
+            Env.get_int.cache_clear()
+            Env.get.cache_clear()
+            os.environ["MAX_ZIP_SIZE"] = max_zip_size
+            os.environ["ZIP_MERGE_DELAY"] = merge_delay
@@ -0,0 +1,67 @@
+import os
+from pathlib import Path
+
+from bluecloud.tasks import merges
+from faker import Faker
+from restapi.env import Env
+from restapi.tests import BaseTests
+
+
+class TestApp(BaseTests):
+    def test_merges(self, faker: Faker, tmp_path: Path) -> None:
+
+        path = tmp_path.joinpath(faker.pystr())
+
+        assert merges.get_registered(path) is None
+        first = merges.register(path)
+        second = merges.register(path)
+        assert first == 1
+        assert second == 2
+
+        assert not merges.is_built(path, first)
+        assert not merges.is_built(path, None)
+
+        # A build started after the second merge covers both
+        registered = merges.get_registered(path)
+        assert registered == 2
+        merges.set_built(path, registered)
+        assert merges.is_built(path, first)
+        assert merges.is_built(path, second)
+
+        third = merges.register(path)
+        assert third == 3
+        assert not merges.is_built(path, third)
+
+        # Builds are delayed while new merges are registered
+        merge_delay = os.environ.get("ZIP_MERGE_DELAY")
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["ZIP_MERGE_DELAY"] = "1"
+
+        delayed = merges.debounce(path, third, None)
+        assert delayed == {"merge": third, "last": third, "delays": 1}
+        assert merges.debounce(path, third, delayed) is None
+
+        fourth = merges.register(path)
+        delayed = merges.debounce(path, third, delayed)
+        assert delayed == {"merge": third, "last": fourth, "delays": 2}
+        assert merges.debounce(path, third, delayed) is None
+
+        # ... up to MAX_DELAYS times
+        delayed = {"merge": third, "last": third, "delays": merges.MAX_DELAYS}
+        assert merges.debounce(path, third, delayed) is None
+
+        # Unregistered merges are not delayed
+        assert merges.debounce(path, None, None) is None
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["ZIP_MERGE_DELAY"] = "0"
+        assert merges.debounce(path, third, None) is None
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        if merge_delay is None:
+            os.environ.pop("ZIP_MERGE_DELAY")
+        else:
+            os.environ["ZIP_MERGE_DELAY"] = merge_delay
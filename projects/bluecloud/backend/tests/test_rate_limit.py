@@ -0,0 +1,53 @@
+import json
+import os
+
+from bluecloud.tasks import rate_limit
+from faker import Faker
+from restapi.env import Env
+from restapi.tests import BaseTests
+
+
+class TestApp(BaseTests):
+    def test_rate_limit(self, faker: Faker) -> None:
+
+        host = faker.domain_name()
+        other_host = faker.domain_name()
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["DOWNLOAD_RATE_LIMITS"] = json.dumps(
+            {host: {"requests": 2, "bytes": 1000000}}
+        )
+
+        assert rate_limit.get_limits(other_host) is None
+        assert rate_limit.get_limits(f"{host}:2121") == {
+            "requests": 2,
+            "bytes": 1000000,
+        }
+
+        # Hosts not matching any pattern are never limited
+        for _ in range(10):
+            assert rate_limit.reserve(other_host, rate_limit.REQUESTS, 1) == 0
+
+        # The bucket holds up to one second of tokens...
+        assert rate_limit.reserve(host, rate_limit.REQUESTS, 1) == 0
+        assert rate_limit.reserve(host, rate_limit.REQUESTS, 1) == 0
+        # ... then requests are delayed
+        wait = rate_limit.reserve(host, rate_limit.REQUESTS, 1)
+        assert 0 < wait <= 0.5
+        wait = rate_limit.reserve(host, rate_limit.REQUESTS, 1)
+        assert 0.5 < wait <= 1
+
+        # Bytes are reserved in batches of 1/10 of the allowed bandwidth
+        throttle = rate_limit.Throttle(host)
+        assert throttle.batch == 100000
+        assert throttle.consume(50000) == 0
+        assert throttle.reserved == 50000
+        assert throttle.consume(50000) == 0
+        assert throttle.consume(2000000) > 1
+
+        assert rate_limit.Throttle(other_host).consume(2000000) == 0
+
+        Env.get_int.cache_clear()
+        Env.get.cache_clear()
+        os.environ["DOWNLOAD_RATE_LIMITS"] = ""
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+from bluecloud.tasks import zip_planner, zip_writer
+from faker import Faker
+from restapi.tests import BaseTests
+
+MAX_SIZE = 262144
+
+
+class TestApp(BaseTests):
+    def test_plan(self, faker: Faker) -> None:
+
+        assert zip_planner.plan({}, MAX_SIZE) == []
+
+        # Sequential packing would need three chunks
+        sizes = {
+            "a": int(MAX_SIZE * 0.45),
+            "b": int(MAX_SIZE * 0.55),
+            "c": int(MAX_SIZE * 0.45),
+            "d": int(MAX_SIZE * 0.35),
+            "e": MAX_SIZE * 2,
+        }
+        layout = zip_planner.plan(sizes, MAX_SIZE)
+        assert [sorted(c["files"]) for c in layout] == [["b", "d"], ["a", "c"], ["e"]]
+        assert [c["oversize"] for c in layout] == [False, False, True]
+        assert all(c["size"] <= MAX_SIZE for c in layout if not c["oversize"])
+
+        # Files are packed by estimated compressed size
+        sizes = {faker.pystr(): 100000 for _ in range(10)}
+        estimates = {name: 10000 for name in sizes}
+        assert len(zip_planner.plan(sizes, MAX_SIZE)) == 5
+        assert len(zip_planner.plan(sizes, MAX_SIZE, estimates)) == 1
+
+    def test_estimate_size(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        path.mkdir()
+
+        text = path.joinpath("text.csv")
+        text.write_bytes(b"temperature,salinity,depth\n" * 10000)
+        assert zip_planner.estimate_size(text) < 27 * 10000 / 10
+
+        binary = path.joinpath("binary.bin")
+        binary.write_bytes(os.urandom(100000))
+        assert zip_planner.estimate_size(binary) == 100000
+
+        empty = path.joinpath("empty")
+        empty.touch()
+        assert zip_planner.estimate_size(empty) == 0
+
+        # Files not fitting in the planned chunk once compressed are not kept
+        writer = zip_writer.ChunkedZipWriter(path.joinpath("chunks"), MAX_SIZE)
+        chunk = writer.new_chunk()
+        files = [path.joinpath(f"{n}.bin") for n in range(2)]
+        for f in files:
+            f.write_bytes(os.urandom(MAX_SIZE // 2))
+        assert writer.add_files([(f, chunk) for f in files], 2) == [files[1]]
+        writer.add_file(files[1])
+
+        chunks = writer.close()
+        assert len(chunks) == 2
+        for z, f in zip(chunks, files):
+            with zipfile.ZipFile(z, "r") as myzip:
+                assert myzip.testzip() is None
+                assert myzip.namelist() == [f.name]
+
+    def test_get_compression(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        path.mkdir()
+
+        text = path.joinpath("text.csv")
+        text.write_bytes(b"temperature,salinity,depth\n" * 10000)
+        compress_type, estimate = zip_planner.get_compression(text)
+        assert compress_type == zipfile.ZIP_DEFLATED
+        assert estimate < 27 * 10000 / 10
+
+        # Compressed by extension, without probing the content
+        gzipped = path.joinpath("text.csv.GZ")
+        gzipped.write_bytes(b"temperature,salinity,depth\n" * 4000)
+        assert zip_planner.get_compression(gzipped) == (zipfile.ZIP_STORED, 108000)
+
+        # Compressed by content
+        binary = path.joinpath("binary.nc")
+        binary.write_bytes(os.urandom(100000))
+        assert zip_planner.get_compression(binary) == (zipfile.ZIP_STORED, 100000)
+
+        writer = zip_writer.ChunkedZipWriter(path.joinpath("chunks"), MAX_SIZE)
+        chunk = writer.new_chunk()
+        files = [text, gzipped, binary]
+        stored = {gzipped, binary}
+        assert writer.add_files([(f, chunk) for f in files], 2, stored) == []
+
+        chunks = writer.close()
+        assert len(chunks) == 1
+        with zipfile.ZipFile(chunks[0], "r") as myzip:
+            assert myzip.testzip() is None
+            for f in files:
+                info = myzip.getinfo(f.name)
+                assert info.compress_type == (
+                    zipfile.ZIP_STORED if f in stored else zipfile.ZIP_DEFLATED
+                )
+                assert myzip.read(f.name) == f.read_bytes()
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Dict
+
+from bluecloud.tasks import zip_writer
+from faker import Faker
+from restapi.tests import BaseTests
+
+MAX_SIZE = 262144
+
+
+def verify_chunk(z: Path, files: Dict[str, bytes]) -> None:
+    with zipfile.ZipFile(z, "r") as myzip:
+        assert myzip.testzip() is None
+        assert sorted(myzip.namelist()) == sorted(files.keys())
+        for name, content in files.items():
+            assert myzip.read(name) == content
+
+
+class TestApp(BaseTests):
+    def test_chunked_zip_writer(self, faker: Faker) -> None:
+
+        path = Path(tempfile.gettempdir(), faker.pystr())
+        writer = zip_writer.ChunkedZipWriter(path.joinpath("stream"), MAX_SIZE)
+
+        files = {f"{faker.pystr()}.bin": os.urandom(65536) for _ in range(5)}
+        names = list(files.keys())
+
+        # Concurrent entries are written in different chunks
+        entries = [writer.open(name, len(files[name])) for name in names[0:3]]
+        assert len(writer.chunks) == 3
+        for name, entry in zip(names, entries):
+            entry.write(files[name])
+            entry.close()
+
+        # Failed transfers are discarded from the chunk
+        entry = writer.open(faker.pystr(), 65536)
+        entry.write(os.urandom(1024))
+        entry.discard()
+
+        # ... and following entries fill the free chunks, until MAX_SIZE
+        for name in names[3:]:
+            entry = writer.open(name, len(files[name]))
+            entry.write(files[name])
+            entry.close()
+
+        assert len(writer.chunks) == 3
+
+        # Oversize zip files are written as they are, as dedicated chunks
+        raw = writer.open(f"{faker.pystr()}.zip", MAX_SIZE + 1)
+        assert isinstance(raw, zip_writer.RawEntry)
+        raw.discard()
+        assert not raw.path.exists()
+
+        # Chunks filled in part are merged
+        chunks = writer.close()
+        assert len(chunks) == 2
+        assert all(z.stat().st_size <= MAX_SIZE for z in chunks)
+
+        with zipfile.ZipFile(chunks[0], "r") as myzip:
+            first = {n: files[n] for n in myzip.namelist()}
+        assert len(first) == 3
+        verify_chunk(chunks[0], first)
+        verify_chunk(chunks[1], {n: c for n, c in files.items() if n not in first})
+
+        # Entries are removed by copying the others, without recompressing them
+        removed = next(iter(first))
+        assert zip_writer.remove_entries(chunks[0], {removed})
+        assert not zip_writer.remove_entries(chunks[0], {removed})
+        first.pop(removed)
+        verify_chunk(chunks[0], first)
+
+        # Trailing entries are replaced by appending the new ones
+        with zip_writer.open_append(chunks[0]) as myzip:
+            myzip.writestr("checksums.md5", "old")
+        size = chunks[0].stat().st_size
+        with zip_writer.open_append(chunks[0], {"checksums.md5"}) as myzip:
+            myzip.writestr("checksums.md5", "new")
+        assert chunks[0].stat().st_size == size
+        verify_chunk(chunks[0], {**first, "checksums.md5": b"new"})
+
+        # Local files are archived with their modification time
+        local_file = path.joinpath(faker.pystr())
+        local_file.write_bytes(os.urandom(1024))
+        os.utime(local_file, (946684800, 946684800))
+        writer = zip_writer.ChunkedZipWriter(path.joinpath("files"), MAX_SIZE)
+        writer.add_file(local_file)
+        chunks = writer.close()
+        with zipfile.ZipFile(chunks[0], "r") as myzip:
+            assert myzip.getinfo(local_file.name).date_time[0] in (1999, 2000)
+
+        # Blocks of the files are compressed in parallel
+        files = {
+            "large.csv": b"depth,temperature\n" * (zip_writer.BLOCK_SIZE // 9),
+            "random.bin": os.urandom(zip_writer.BLOCK_SIZE + 1),
+            "empty.txt": b"",
+        }
+        for name, content in files.items():
+            path.joinpath(name).write_bytes(content)
+        writer = zip_writer.ChunkedZipWriter(path.joinpath("parallel"), MAX_SIZE * 100)
+        chunk = writer.new_chunk()
+        local_files = [(path.joinpath(name), chunk) for name in files]
+        assert writer.add_files(local_files, 3) == []
+        chunks = writer.close()
+        assert len(chunks) == 1
+        verify_chunk(chunks[0], files)
+
+        # Local oversize zip files are written as chunks without copying them
+        oversize = path.joinpath(f"{faker.pystr()}.zip")
+        with zipfile.ZipFile(oversize, "w") as myzip:
+            myzip.writestr(faker.pystr(), os.urandom(MAX_SIZE * 2))
+        content = oversize.read_bytes()
+        writer = zip_writer.ChunkedZipWriter(path.joinpath("raw"), MAX_SIZE)
+        writer.add_raw(oversize)
+        chunks = writer.close()
+        assert len(chunks) == 1
+        assert chunks[0].read_bytes() == content
+        assert writer.copied == 0
+
+        # Hardlinked chunks share the content of the datafile
+        if zip_writer.is_linked(chunks[0]):
+            assert chunks[0].stat().st_ino == oversize.stat().st_ino
+
+        # Oversize files are split in parts of up to MAX_SIZE once compressed
+        content = os.urandom(MAX_SIZE * 3)
+        split_file = path.joinpath(faker.pystr())
+        split_file.write_bytes(content)
+        writer = zip_writer.ChunkedZipWriter(path.joinpath("parts"), MAX_SIZE)
+        parts = writer.add_parts(split_file)
+        chunks = writer.close()
+        assert len(chunks) == parts
+        assert parts > 3
+
+        joined = b""
+        for z in chunks:
+            assert z.stat().st_size <= MAX_SIZE
+            with zipfile.ZipFile(z, "r") as myzip:
+                assert myzip.testzip() is None
+                for name in myzip.namelist():
+                    if not name.endswith(zip_writer.PARTS_SUFFIX):
+                        joined += myzip.read(name)
+                assert zip_writer.get_split_name(myzip.namelist()) == split_file.name
+        assert joined == content